@@ -0,0 +1,346 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://cbg.isi.edu/>
+# For license information, see LICENSE
+
+
+import os
+import sys
+import time
+import random
+import argparse
+import datetime
+import multiprocessing
+import twcodec
+import twplan
+import twbuffer
+import twstorage
+import anyjson as json
+
+from collections import OrderedDict
+
+
+def read_settings(filepath="scrapy-settings.json"):
+    json_file = open(filepath, "r")
+    settings = json.loads(json_file.read())
+    json_file.close()
+    return settings
+
+
+def make_tweet(tweet_id, ts):
+    # Keys in the order of Twitter's stream, which the lazy decoder uses.
+    user_id = random.randint(1, 10 ** 9)
+    tweet = OrderedDict()
+    tweet["created_at"] = ts.strftime("%a %b %d %H:%M:%S +0000 %Y")
+    tweet["id"] = tweet_id
+    tweet["id_str"] = str(tweet_id)
+    tweet["text"] = u"Fixture tweet #%d about the #NBADraft\tand\nmore" % tweet_id
+    tweet["source"] = "<a href=\"http://twitter.com\">Twitter for iPhone</a>"
+    tweet["in_reply_to_status_id"] = None
+    tweet["in_reply_to_user_id"] = None
+    tweet["user"] = OrderedDict([
+        ("id", user_id),
+        ("id_str", str(user_id)),
+        ("name", "Fixture user %d" % user_id),
+        ("screen_name", "user%d" % user_id),
+        ("description", "Basketball fan. " * 8),
+        ("followers_count", random.randint(0, 10000)),
+        ("friends_count", random.randint(0, 1000)),
+        ("created_at", "Mon Feb 02 17:08:54 +0000 2009"),
+        ("geo_enabled", True),
+        ("profile_image_url", "http://a0.twimg.com/profile_images/%d/"
+                              "fixture_normal.jpg" % user_id),
+        ("lang", "en"),
+    ])
+    tweet["geo"] = None
+    if tweet_id % 20 == 0:
+        tweet["geo"] = {
+            "type": "Point",
+            "coordinates": [34.0 + random.random(), -118.0 - random.random()],
+        }
+    tweet["entities"] = {
+        "hashtags": [{"text": "NBADraft", "indices": [24, 33]}],
+        "urls": [],
+        "user_mentions": [],
+    }
+    tweet["lang"] = "en"
+    return tweet
+
+
+def make_batch(size, duplicates=0.2, seed=2013):
+    # Same framing as the ScrapyAPI spool: tweet lines, match frames for
+    # tweets delivered by several filters, and limit notices.
+    random.seed(seed)
+    base_id = random.randint(10 ** 17, 9 * 10 ** 17)
+    ts = datetime.datetime.utcnow()
+    frames = []
+    tweet_ids = []
+    for i in xrange(size):
+        filter_id = random.randint(1, 12)
+        if tweet_ids and random.random() < duplicates:
+            frames.append(twbuffer.pack(twbuffer.MATCH, filter_id,
+                                        random.choice(tweet_ids)))
+        else:
+            tweet = make_tweet(base_id + i, ts)
+            tweet_ids.append(tweet["id"])
+            frames.append(twbuffer.pack(twbuffer.TWEET, filter_id,
+                                        tweet["id"], json.dumps(tweet)))
+        if i % 1000 == 0:
+            frames.append(twbuffer.pack(twbuffer.LIMIT, 1,
+                                        random.randint(1, 100)))
+    return "".join(frames)
+
+
+def bench_storage(args):
+    twstorage.init(read_settings(args.settings))
+    storage = twstorage.STORAGE
+    batch = make_batch(args.size)
+    print "batch: %d bytes" % len(batch)
+    for writer in args.writers:
+        timings = []
+        for _ in xrange(args.repeat):
+            t0 = time.time()
+            limits, tweets, tjsons, _ = twstorage.read_cache(
+                batch, twstorage.next_batch())
+            limits, _ = twstorage.new_limits(limits, None)
+            twstorage.WRITERS[writer](limits, tweets, tjsons)
+            timings.append(time.time() - t0)
+            # Nothing is kept, so the benchmark is safe against a live DB.
+            storage.session.rollback()
+        best = min(timings)
+        print "%-6s best %.3fs  mean %.3fs  %.0f frames/s" % (
+            writer,
+            best,
+            sum(timings) / len(timings),
+            args.size / best,
+        )
+
+
+def read_lines(filepath, size):
+    lines = []
+    with open(filepath, "rb") as fp:
+        for line in fp:
+            line = line.strip()
+            if line:
+                lines.append(line)
+            if len(lines) >= size:
+                break
+    return lines
+
+
+def bench_codec(args):
+    if args.file:
+        lines = read_lines(args.file, args.size)
+    else:
+        ts = datetime.datetime.utcnow()
+        lines = [json.dumps(make_tweet(i, ts)) for i in xrange(args.size)]
+    print "lines: %d, %d bytes" % (len(lines), sum(len(l) for l in lines))
+    decoders = [(name, decode) for name, decode, _ in twcodec.BACKENDS]
+    decoders.append(("lazy", twcodec.lazy_loads))
+    sample = lines[:200] + [twcodec.SAMPLE]
+    loose = set(name for name, decode, _ in twcodec.BACKENDS
+                if not twcodec.agrees(decode, sample))
+    for name, decode in decoders:
+        best = twcodec.measure(decode, lines, args.repeat)
+        print "%-10s best %.3fs  %.0f lines/s%s" % (
+            name, best, len(lines) / best,
+            "  (differs from json)" if name in loose else "")
+    print "auto backend: %s" % twcodec.fastest(lines[:200])[0]
+
+
+def bench_ingest(args):
+    # Compares parsing on the calling (reactor) thread with handing chunks
+    # to a ParsePool-like process pool. "main cpu" is the CPU time the
+    # calling process spends per line, which is what the reactor saves.
+    if args.file:
+        lines = read_lines(args.file, args.size)
+    else:
+        ts = datetime.datetime.utcnow()
+        lines = [json.dumps(make_tweet(i, ts)) for i in xrange(args.size)]
+    twcodec.configure(lazy=args.lazy)
+    chunks = [lines[i:i + args.chunk_size]
+              for i in xrange(0, len(lines), args.chunk_size)]
+    pool = multiprocessing.Pool(processes=args.workers)
+    pool.map(twcodec.parse_lines, chunks[:args.workers])
+
+    for name in ("inline", "pool"):
+        cpu0 = sum(os.times()[:2])
+        t0 = time.time()
+        if name == "inline":
+            for chunk in chunks:
+                twcodec.parse_lines(chunk)
+        else:
+            pending = [pool.apply_async(twcodec.parse_lines, [chunk])
+                       for chunk in chunks]
+            for result in pending:
+                result.get()
+        wall = time.time() - t0
+        cpu = sum(os.times()[:2]) - cpu0
+        print "%-6s wall %.3fs  %.0f lines/s  main cpu %.1fus/line" % (
+            name,
+            wall,
+            len(lines) / wall,
+            cpu / len(lines) * 10 ** 6,
+        )
+    pool.close()
+
+
+def naive_follow_plan(streams, user_ids, limit, free_fids):
+    # The policy FollowStreamer had before twplan: rebuild every stream above
+    # the limit and, when there are new users, one more open stream, then
+    # slice the users into streams of `limit`.
+    following = set()
+    for follow in streams.itervalues():
+        following.update(follow)
+    user_ids = [uid for uid in user_ids if uid not in following]
+    added = len(user_ids)
+    restart = [fid for fid, follow in streams.iteritems() if len(follow) > limit]
+    for fid in restart:
+        user_ids.extend(streams[fid])
+    launch = []
+    if user_ids:
+        open_streams = [fid for fid, follow in streams.iteritems()
+                        if len(follow) < limit and fid not in restart]
+        if open_streams:
+            restart.append(open_streams.pop())
+            user_ids.extend(streams[restart[-1]])
+        free_fids = list(free_fids)
+        for i in xrange(0, len(user_ids), limit):
+            launch.append({"id": free_fids.pop(0),
+                           "follow": user_ids[i:i + limit]})
+    return {"restart": restart, "launch": launch, "added": added}
+
+
+def planner_scenario(users, limit, cycles, growth, packed=False, seed=2013):
+    # Streams of random sizes (or full ones when `packed`) for `users`
+    # users, and the `growth` new users of each of `cycles` streamer runs.
+    random.seed(seed)
+    initial = {}
+    next_user = 0
+    next_fid = 0
+    while next_user < users:
+        size = limit if packed else random.randint(1, limit)
+        initial[next_fid] = range(next_user, next_user + size)
+        next_user += size
+        next_fid += 1
+    arrivals = []
+    for _ in xrange(cycles):
+        arrivals.append(range(next_user, next_user + growth))
+        next_user += growth
+    return initial, arrivals
+
+
+def replay_plans(policy, initial, arrivals, limit):
+    # Applies the plan of every run to a simulated assignment.
+    streams = dict((fid, list(follow)) for fid, follow in initial.items())
+    next_fid = max(streams) + 1 if streams else 0
+    desired = [uid for follow in streams.itervalues() for uid in follow]
+    restarts = launches = 0
+    timings = []
+    for new_users in arrivals:
+        desired.extend(new_users)
+        free_fids = xrange(next_fid, next_fid + len(desired))
+        t0 = time.time()
+        plan = policy(streams, desired, limit, free_fids)
+        timings.append(time.time() - t0)
+        for fid in plan["restart"]:
+            del streams[fid]
+        for stream in plan["launch"]:
+            streams[stream["id"]] = stream["follow"]
+            next_fid = max(next_fid, stream["id"] + 1)
+        restarts += len(plan["restart"])
+        launches += len(plan["launch"])
+    followed = set(uid for follow in streams.itervalues() for uid in follow)
+    assert followed == set(desired)
+    return {
+        "restarts": restarts,
+        "launches": launches,
+        "streams": len(streams),
+        "timings": timings,
+    }
+
+
+def bench_planner(args):
+    # Replays `cycles` streamer runs in which `growth` new users show up.
+    policies = [
+        ("naive", naive_follow_plan),
+        ("twplan", lambda streams, user_ids, limit, free_fids:
+            twplan.plan_follow(streams, user_ids, limit, free_fids,
+                               spare=args.spare)),
+    ]
+    initial, arrivals = planner_scenario(args.users, args.limit, args.cycles,
+                                         args.growth, args.packed, args.seed)
+    print "users: %d, streams: %d, limit: %d" % (
+        sum(len(follow) for follow in initial.itervalues()), len(initial),
+        args.limit)
+    for name, policy in policies:
+        result = replay_plans(policy, initial, arrivals, args.limit)
+        timings = result["timings"]
+        print "%-7s restarts %5d  launches %5d  streams %4d  " \
+              "plan mean %.2fms max %.2fms" % (
+            name,
+            result["restarts"],
+            result["launches"],
+            result["streams"],
+            sum(timings) / len(timings) * 1000,
+            max(timings) * 1000,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--settings", default="scrapy-settings.json",
+                        help="Settings file with the database section")
+    subparsers = parser.add_subparsers()
+
+    storage_parser = subparsers.add_parser("storage",
+                                           help="twstorage writer paths")
+    storage_parser.add_argument("-n", "--size", type=int, default=50000,
+                                help="Fixture batch size")
+    storage_parser.add_argument("-r", "--repeat", type=int, default=3)
+    storage_parser.add_argument("-w", "--writers", nargs="+",
+                                default=["orm", "copy"],
+                                choices=sorted(twstorage.WRITERS))
+    storage_parser.set_defaults(func=bench_storage)
+
+    codec_parser = subparsers.add_parser("codec",
+                                         help="twcodec JSON backends")
+    codec_parser.add_argument("-f", "--file",
+                              help="Recorded stream, one tweet per line")
+    codec_parser.add_argument("-n", "--size", type=int, default=20000,
+                              help="Number of lines")
+    codec_parser.add_argument("-r", "--repeat", type=int, default=3)
+    codec_parser.set_defaults(func=bench_codec)
+
+    ingest_parser = subparsers.add_parser("ingest",
+                                          help="inline vs pooled parsing")
+    ingest_parser.add_argument("-f", "--file",
+                               help="Recorded stream, one tweet per line")
+    ingest_parser.add_argument("-n", "--size", type=int, default=50000,
+                               help="Number of lines")
+    ingest_parser.add_argument("-w", "--workers", type=int, default=2)
+    ingest_parser.add_argument("-c", "--chunk-size", type=int, default=500)
+    ingest_parser.add_argument("--lazy", action="store_true",
+                               help="Use the lazy decoder")
+    ingest_parser.set_defaults(func=bench_ingest)
+
+    planner_parser = subparsers.add_parser("planner",
+                                           help="follow stream placement")
+    planner_parser.add_argument("-u", "--users", type=int, default=5000,
+                                help="Users followed at start")
+    planner_parser.add_argument("-l", "--limit", type=int, default=400,
+                                help="Users per stream")
+    planner_parser.add_argument("-c", "--cycles", type=int, default=100)
+    planner_parser.add_argument("-g", "--growth", type=int, default=20,
+                                help="New users per cycle")
+    planner_parser.add_argument("--spare", type=int, default=1)
+    planner_parser.add_argument("--packed", action="store_true",
+                                help="Start from full streams instead of "
+                                     "random sizes")
+    planner_parser.add_argument("--seed", type=int, default=2013)
+    planner_parser.set_defaults(func=bench_planner)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
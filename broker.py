@@ -9,17 +9,22 @@
 import os
 import sys
 import csv
+import time
 import logging
 import datetime
 import argparse
 import requests
+import twmetrics
+import twlog
+import twprofile
 import traceback
 import anyjson as json
 
 from twisted.python import log
-from twisted.internet import reactor
+from twisted.internet import reactor, task, threads
 from twisted.web import server, resource
 from twisted.python.logfile import DailyLogFile
+from collections import deque
 
 global LOG_FILE
 
@@ -33,6 +38,179 @@ def read_settings(filepath="broker-settings.json"):
     return settings
 
 
+def iso_time(ts):
+    return datetime.datetime.utcfromtimestamp(ts).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def scrapy_urls(scrapy_settings):
+    nodes = scrapy_settings.get("nodes") or [scrapy_settings["api"]]
+    return ["http://%s:%d" % (n["host"], n["port"]) for n in nodes]
+
+
+class TokenIndex(object):
+    # Tokens from the accounts CSV, kept in memory and reloaded only when the
+    # file's mtime changes. A token is free, leased (handed out by /get/ but
+    # not seen on a scrapy node yet) or used (listed by a node's /list/).
+    # Leases expire after `ttl` seconds, so the tokens of streams that never
+    # started go back to the free set.
+    #
+    # Free tokens whose streams lost more than `max_loss` of their tweets to
+    # Twitter's limit notices within the last `window` seconds are kept in
+    # `limited` and handed out only when no other token is free.
+
+    def __init__(self, accounts_file, ttl=120, max_loss=0.01, window=3600,
+                 history=360):
+        self.accounts_file = accounts_file
+        self.ttl = ttl
+        self.max_loss = max_loss
+        self.window = window
+        self.history_size = history
+        self.mtime = None
+        self.secrets = {}
+        self.free = set()
+        self.limited = set()
+        self.used = set()
+        self.leases = {}
+        self.lease_order = deque([])
+        self.history = {}
+        self.counters = None
+
+    def reload(self):
+        mtime = os.stat(self.accounts_file).st_mtime
+        if mtime == self.mtime:
+            return
+        with open(self.accounts_file, 'rb') as fp:
+            accounts = csv.reader(fp, delimiter=',')
+            self.secrets = dict((acc[2], acc[3]) for acc in accounts)
+        self.mtime = mtime
+        for key in self.leases.keys():
+            if key not in self.secrets: del self.leases[key]
+        self.free = set()
+        self.limited = set()
+        for key in self.secrets:
+            if key not in self.leases:
+                self._release(key)
+        log.msg("Loaded %d tokens from %s" % (len(self.secrets),
+                                              self.accounts_file))
+
+    def _release(self, key):
+        if key in self.secrets and key not in self.used:
+            if self.loss(key) > self.max_loss:
+                self.limited.add(key)
+            else:
+                self.free.add(key)
+
+    def loss(self, key, now=None):
+        # Share of the tweets matched by the token's streams that Twitter
+        # held back within the window.
+        now = now or time.time()
+        limits = received = 0
+        for ts, limit_count, received_count in self.history.get(key, ()):
+            if ts >= now - self.window:
+                limits += limit_count
+                received += received_count
+        if limits + received == 0:
+            return 0.0
+        return float(limits) / (limits + received)
+
+    def record(self, counters, now=None):
+        # counters: token -> (total_limits, total_received) from the nodes'
+        # /list/. The first call only sets the baseline.
+        now = now or time.time()
+        if self.counters is not None:
+            for key, (limits, received) in counters.items():
+                last = self.counters.get(key, (0, 0))
+                if limits < last[0] or received < last[1]:
+                    # The scraper was recreated and its totals restarted.
+                    last = (0, 0)
+                if key not in self.history:
+                    self.history[key] = deque([], maxlen=self.history_size)
+                self.history[key].append((now, limits - last[0],
+                                          received - last[1]))
+        self.counters = counters
+        for key in list(self.limited):
+            if self.loss(key, now) <= self.max_loss:
+                self.limited.remove(key)
+                self.free.add(key)
+
+    def expire(self, now=None):
+        # lease_order is sorted by expiry because every lease has the same
+        # ttl; entries of released or renewed leases are skipped.
+        now = now or time.time()
+        while self.lease_order and self.lease_order[0][0] <= now:
+            expiry, key = self.lease_order.popleft()
+            if self.leases.get(key) == expiry:
+                del self.leases[key]
+                self._release(key)
+
+    def allocate(self, n=1):
+        self.reload()
+        now = time.time()
+        self.expire(now)
+        tokens = []
+        while (self.free or self.limited) and len(tokens) < n:
+            if self.free:
+                key = self.free.pop()
+            else:
+                key = min(self.limited, key=lambda k: self.loss(k, now))
+                self.limited.remove(key)
+            expiry = now + self.ttl
+            self.leases[key] = expiry
+            self.lease_order.append((expiry, key))
+            tokens.append({
+                "token" : key,
+                "secret" : self.secrets[key],
+                })
+        return tokens
+
+    def release(self, key):
+        if self.leases.pop(key, None) is not None:
+            self._release(key)
+            return True
+        return False
+
+    def sync(self, used):
+        # Tokens a node lists are used and their leases are done; tokens
+        # no node lists any more are free again unless they are leased.
+        self.reload()
+        used = set(used)
+        for key in used:
+            self.free.discard(key)
+            self.limited.discard(key)
+            self.leases.pop(key, None)
+        previous = self.used
+        self.used = used
+        for key in previous - used:
+            if key not in self.leases:
+                self._release(key)
+
+    def stats(self):
+        self.reload()
+        self.expire()
+        used = len(self.used.intersection(self.secrets))
+        return {
+            "total": len(self.secrets),
+            "available": len(self.free) + len(self.limited),
+            "used" : used,
+            "leased": len(self.leases),
+            "limited": len(self.limited),
+            }
+
+    def limit_history(self, keys=None):
+        now = time.time()
+        keys = keys or self.history.keys()
+        history = {}
+        for key in keys:
+            if key not in self.history:
+                continue
+            history[key] = {
+                "loss": self.loss(key, now),
+                "history": [[iso_time(ts), limits, received]
+                            for ts, limits, received in self.history[key]],
+            }
+        return history
+
+
 class BrokerAPI(resource.Resource):
     isLeaf = True
 
@@ -40,54 +218,160 @@ class BrokerAPI(resource.Resource):
         resource.Resource.__init__(self)
         settings = read_settings("broker-settings.json")
         scrapy_settings = read_settings("scrapy-settings.json")
+        lease_settings = settings.get("lease", {})
         self.accounts_file = settings["csv"]["filename"]
-        self.scrapy_url = "http://%s:%d" % (scrapy_settings["api"]["host"], scrapy_settings["api"]["port"])
+        self.scrapy_urls = scrapy_urls(scrapy_settings)
+        limit_settings = settings.get("limits", {})
+        self.index = TokenIndex(
+            self.accounts_file,
+            ttl=lease_settings.get("ttl", 120),
+            max_loss=limit_settings.get("max_loss", 0.01),
+            window=limit_settings.get("window", 3600),
+            history=limit_settings.get("history", 360),
+        )
+        self.sync_interval = lease_settings.get("sync_interval", 10)
+        self.syncing = False
+        self.nodes = []
+        self.profiler = twprofile.from_settings(settings)
+        self.metrics = twmetrics.Registry("broker")
+        self.metrics.collector(self._collect_metrics)
+        self.sync_seconds = self.metrics.histogram(
+            "sync_seconds", "Time to poll every scrapy node.")
+        self.leased = 0
+        # Blocking once at start, before the reactor runs, so that no token a
+        # node already uses is handed out.
+        self._set_nodes(self._get_nodes())
 
     def _get_all_tokens(self):
-        with open(self.accounts_file, 'rb') as fp:
-            accounts = csv.reader(fp, delimiter=',')
-            tokens = dict((acc[2], acc[3]) for acc in accounts)
-        return tokens
-            
-    def _get_used_tokens(self):
-        tokens = []
-        while(True):
-            text_response = requests.get("%s/list/" % self.scrapy_url).text
+        self.index.reload()
+        return self.index.secrets
+
+    def _get_node_streams(self, scrapy_url, attempts=3):
+        for _ in xrange(attempts):
+            text_response = requests.get("%s/list/" % scrapy_url,
+                                         timeout=10).text
             response = json.loads(text_response)
             if len(response) == 0 or "token" in response[0]:
-                break;
-        for stream in response:
-            tokens.append(str(stream["token"]))
-        return tokens
+                return response
+        raise ValueError("Bad /list/ response from %s" % scrapy_url)
+
+    def _get_nodes(self):
+        nodes = []
+        for scrapy_url in self.scrapy_urls:
+            try:
+                streams = self._get_node_streams(scrapy_url)
+            except Exception:
+                log.msg("Scrapy node %s is not reachable" % scrapy_url,
+                        logLevel=logging.WARNING)
+                continue
+            nodes.append({
+                "url": scrapy_url,
+                "streams": len(streams),
+                "rate": sum(stream.get("rate", 0.0) for stream in streams),
+                "tokens": [str(stream["token"]) for stream in streams],
+                "counters": dict((str(stream["token"]),
+                                  (stream.get("total_limits", 0),
+                                   stream.get("total_received", 0)))
+                                 for stream in streams),
+            })
+        return nodes
+
+    def _set_nodes(self, nodes):
+        self.nodes = nodes
+        tokens = []
+        counters = {}
+        for node in nodes:
+            tokens.extend(node["tokens"])
+            counters.update(node["counters"])
+        self.index.record(counters)
+        self.index.sync(tokens)
+
+    def sync(self):
+        # Polls the nodes off the reactor thread; /get/, /available/ and
+        # /used/ answer from the last snapshot.
+        if self.syncing:
+            return
+        self.syncing = True
+        ts_start = time.time()
+
+        def done(result):
+            self.syncing = False
+            self.sync_seconds.observe(time.time() - ts_start)
+            return result
+
+        def failed(failure):
+            log.msg("Sync with scrapy nodes failed: %s" % failure.getErrorMessage(),
+                    logLevel=logging.WARNING)
 
-    def get_nused_token(self):
-        alltok = self._get_all_tokens()
-        usedtok = self._get_used_tokens()
-        for key in usedtok:
-            if key in alltok: del alltok[key]
-        if len(alltok) > 0:
-            tok = alltok.items().pop()
-            token = {
-                "token" : tok[0],
-                "secret" : tok[1]
-                }
-            return token
+        d = threads.deferToThread(self._get_nodes)
+        d.addCallback(self._set_nodes)
+        d.addErrback(failed)
+        d.addBoth(done)
+        return d
+
+    def _get_used_tokens(self):
+        return list(self.index.used)
+
+    def get_node(self, nodes=None):
+        # Least loaded node: lowest total tweet rate, then fewest streams.
+        nodes = nodes if nodes is not None else self.nodes
+        if not nodes:
+            return None
+        node = min(nodes, key=lambda n: (n["rate"], n["streams"]))
+        return node
+
+    def get_nused_token(self, n=None):
+        tokens = self.index.allocate(n or 1)
+        self.leased += len(tokens)
+        for token in tokens:
+            node = self.get_node()
+            token["node"] = node["url"] if node else None
+            if node:
+                # Counted until the next sync, so that a batch is spread
+                # over the nodes.
+                node["streams"] += 1
+        if n is not None:
+            return tokens
+        if len(tokens) > 0:
+            return tokens[0]
         else:
             return {"error" : "none"}
 
+    def release(self, keys):
+        return dict((key, self.index.release(key)) for key in keys)
+
     def get_available(self):
-        alltok = self._get_all_tokens()
-        usedtok = self._get_used_tokens()
-        available = {
-            "total": len(alltok),
-            "available": len(alltok),
-            "used" : 0,
-            }
-        for key in usedtok:
-            if key in alltok: available["used"] += 1
-        available["available"] -= available["used"]
+        available = self.index.stats()
+        available["nodes"] = []
+        for node in self.nodes:
+            available["nodes"].append({
+                "url": node["url"],
+                "streams": node["streams"],
+                "rate": node["rate"],
+            })
         return available
 
+    def _collect_metrics(self):
+        stats = self.index.stats()
+        return [
+            ("tokens", "gauge", "Tokens of the accounts CSV, by state.",
+             [({"state": state}, stats[state])
+              for state in ("total", "available", "used", "leased",
+                            "limited")]),
+            ("leased_total", "counter", "Tokens handed out by /get/.",
+             [({}, self.leased)]),
+            ("node_streams", "gauge", "Streams a scrapy node runs.",
+             [({"node": node["url"]}, node["streams"])
+              for node in self.nodes]),
+            ("node_tweets_per_minute", "gauge",
+             "Tweets per minute of all streams of a scrapy node.",
+             [({"node": node["url"]}, node["rate"]) for node in self.nodes]),
+        ]
+
+    def render(self, request):
+        self.metrics.time_request(request)
+        return resource.Resource.render(self, request)
+
     def render_GET(self, request):
         try:
             #log.msg("Handle request: %s" % request.path, logLevel=logging.DEBUG)
@@ -95,7 +379,11 @@ class BrokerAPI(resource.Resource):
             request.setHeader("Access-Control-Allow-Origin", "*")
 
             if request.path == "/get/":
-                response = self.get_nused_token()
+                n = int(request.args["n"][0]) if "n" in request.args else None
+                response = self.get_nused_token(n)
+                return json.dumps(response)
+            elif request.path == "/release/":
+                response = self.release(request.args.get("token", []))
                 return json.dumps(response)
 
             elif request.path == "/available/":
@@ -108,14 +396,25 @@ class BrokerAPI(resource.Resource):
             elif request.path == "/used/":
                 response = self._get_used_tokens()
                 return json.dumps(response)
+            elif request.path == "/limits/":
+                response = self.index.limit_history(request.args.get("token"))
+                return json.dumps(response)
+            elif request.path == "/node/":
+                node = self.get_node()
+                response = {"node": node["url"] if node else None}
+                return json.dumps(response)
+
+            elif request.path.startswith("/profile/"):
+                return self.profiler.render(request)
+            elif request.path in ("/metrics", "/metrics/"):
+                request.setHeader("Content-Type",
+                                  "text/plain; version=0.0.4")
+                return self.metrics.render()
 
             elif request.path == "/ping/":
                 return "pong"
             elif request.path == "/log/":
-                logfile = open("log-broker/daily-log.log")
-                log_message = logfile.read()
-                logfile.close()
-                return log_message
+                return twlog.serve(request, "log-broker/daily-log.log")
             else:
                 #log.msg("Wrong API path '%s'" % request.path, logLevel=logging.DEBUG)
                 return json.dumps({
@@ -152,7 +451,7 @@ Started on: %s UTC
 PORT: %d
 LOG: %r
 PID: %d
-SCRAPER: %s:%s/\n
+SCRAPER: %s\n
 """
 
 if __name__ == "__main__":
@@ -176,8 +475,7 @@ if __name__ == "__main__":
         api_port,
         log_file,
         os.getpid(),
-        scrapy_settings["api"]["host"],
-        scrapy_settings["api"]["port"],
+        ", ".join(scrapy_urls(scrapy_settings)),
     )
     sys.stdout.write(MSG)
     log.startLogging(log_file)
@@ -185,6 +483,8 @@ if __name__ == "__main__":
     api = BrokerAPI()
     site = server.Site(api)
     reactor.listenTCP(api_port, site)
+    lc = task.LoopingCall(api.sync)
+    lc.start(api.sync_interval, now=False)
     reactor.run()
 
     log_file.close()
\ No newline at end of file
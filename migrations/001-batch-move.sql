@@ -0,0 +1,24 @@
+-- Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+-- URL: <http://cbg.isi.edu/>
+-- For license information, see LICENSE
+
+-- Replaces the status-flip SQL_MOVE with per-batch moves.
+-- Stop scrapy.py before running it, start the new version afterwards.
+
+BEGIN WORK;
+
+-- Rows the old SQL_MOVE has not copied yet.
+INSERT INTO "nba_tweet" (id, user_id, timestamp, text, geo)
+SELECT t.id, t.user_id, t.timestamp, t.text, t.geo
+FROM "nba_tmp_tweet" t
+WHERE t.status <> 2
+AND NOT EXISTS (SELECT 1 FROM "nba_tweet" f WHERE f.id = t.id);
+
+DROP INDEX "nba_tmp_tweet_status_idx";
+ALTER TABLE "nba_tmp_tweet" DROP COLUMN "status";
+
+ALTER TABLE "nba_tmp_tweet" ADD COLUMN "batch" int8;
+CREATE SEQUENCE "nba_tmp_tweet_batch_seq";
+CREATE INDEX "nba_tmp_tweet_batch_idx" ON "nba_tmp_tweet" USING btree(batch);
+
+COMMIT WORK;
@@ -0,0 +1,14 @@
+-- Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+-- URL: <http://cbg.isi.edu/>
+-- For license information, see LICENSE
+
+-- Switches de-duplication from per-row rules to the staged merge.
+-- Set "dedup": "merge" in scrapy-settings.json before restarting scrapy.py;
+-- with the rules gone the plain ORM path would fail on duplicate ids.
+
+BEGIN WORK;
+
+DROP RULE IF EXISTS "tmp_tweet_ignore_dublicates" ON "nba_tmp_tweet";
+DROP RULE IF EXISTS "nba_tmp_tweet_json_ignore_duplicates" ON "nba_tmp_tweet_json";
+
+COMMIT WORK;
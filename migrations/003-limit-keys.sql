@@ -0,0 +1,16 @@
+-- Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+-- URL: <http://cbg.isi.edu/>
+-- For license information, see LICENSE
+
+-- Keys limit rows by the buffer segment they came from, so a part stored
+-- twice does not count its limit notices twice. Rows written before keep
+-- NULL keys, which never collide.
+-- Stop scrapy.py before running it, start the new version afterwards.
+
+BEGIN WORK;
+
+ALTER TABLE "nba_tmp_limit" ADD COLUMN "segment" varchar(255);
+ALTER TABLE "nba_tmp_limit" ADD COLUMN "position" int4;
+CREATE UNIQUE INDEX "nba_tmp_limit_segment_idx" ON "nba_tmp_limit" USING btree(segment, filter_id, position);
+
+COMMIT WORK;
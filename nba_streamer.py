@@ -9,26 +9,45 @@
 import os
 import sys
 import csv
+import time
 import logging
 import datetime
 import argparse
-import requests
-import psycopg2
+import twplan
+import twhttp
+import twmetrics
+import twlog
+import twprofile
 import traceback
-import multiprocessing
 import anyjson as json
 
 from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 from hoopshype import HoopsHype
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
+from twisted.enterprise import adbapi
 from twisted.web import server, resource
-from twisted.internet.task import LoopingCall
+from twisted.internet.task import LoopingCall, deferLater
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import gatherResults, maybeDeferred
+from twisted.internet.defer import Deferred, TimeoutError
 from twisted.python.logfile import DailyLogFile
 
 global LOG_FILE
+global HTTP
+global DB
+global WORKER
+global JOBS
 
 VERSION = "1.0"
 
+HTTP = None
+DB = None
+WORKER = None
+JOBS = {}
+METRICS = twmetrics.Registry("nba")
+
 
 def read_settings(filepath="nba-settings.json"):
     json_file = open(filepath, "r")
@@ -40,7 +59,267 @@ def iso_time(ts):
     return ts.strftime("%Y-%m-%dT%H:%M:%S")
 
 
+def scrapy_urls(scrapy_settings):
+    nodes = scrapy_settings.get("nodes") or [scrapy_settings["api"]]
+    return ["http://%s:%d" % (n["host"], n["port"]) for n in nodes]
+
+
+def db_string(settings):
+    return "host='{host}' dbname='{dbname}' user='{user}' \
+            password='{password}'".format(
+                password = settings["database"]["password"],
+                user = settings["database"]["username"],
+                dbname = settings["database"]["name"],
+                host = settings["database"]["host"],
+                port = settings["database"]["port"])
+
+
+def get_http():
+    # One keep-alive client for the scrapy nodes and the broker.
+    global HTTP
+    if HTTP is None:
+        settings = read_settings("nba-settings.json")
+        http_settings = settings.get("http", {})
+        HTTP = twhttp.JsonClient(
+            max_per_host=http_settings.get("max_per_host", 4),
+            timeout=http_settings.get("timeout", 30),
+        )
+    return HTTP
+
+
+def get_db():
+    # Queries run on the connections of an adbapi pool, off the reactor.
+    global DB
+    if DB is None:
+        settings = read_settings("nba-settings.json")
+        DB = adbapi.ConnectionPool(
+            "psycopg2",
+            db_string(settings),
+            cp_min=1,
+            cp_max=settings["database"].get("pool_size", 3),
+            cp_reconnect=True,
+        )
+    return DB
+
+
+def get_worker():
+    # One thread, started once, for the blocking HoopsHype scraper.
+    global WORKER
+    if WORKER is None:
+        WORKER = ThreadPool(1, 1, "hoopshype")
+        WORKER.start()
+        reactor.addSystemEventTrigger("before", "shutdown", WORKER.stop)
+    return WORKER
+
+
+@inlineCallbacks
+def snapshot(urls):
+    # One versioned /list/ per scrapy node: {scrapy url: {"version": ...,
+    # "streams": [...]}}. A streamer run plans from a single snapshot.
+    ts_start = time.time()
+    responses = yield gatherResults([
+        get_http().get("%s/list/" % scrapy_url, {"since": 0})
+        for scrapy_url in urls
+    ], consumeErrors=True)
+    nodes = {}
+    for scrapy_url, response in zip(urls, responses):
+        if "streams" not in response:
+            raise ValueError("Bad /list/ response from %s: %r" % (
+                scrapy_url, response))
+        nodes[scrapy_url] = response
+    METRICS.histogram("reconcile_seconds", "Time of a reconcile step.",
+                      step="snapshot").observe(time.time() - ts_start)
+    returnValue(nodes)
+
+
+def list_streams(nodes):
+    # (scrapy url, stream) for every stream of a snapshot
+    streams = []
+    for scrapy_url, response in nodes.iteritems():
+        for stream in response["streams"]:
+            streams.append((scrapy_url, stream))
+    return streams
+
+
+@inlineCallbacks
+def apply_changes(nodes, adds, removes, broker_url):
+    # adds: [(scrapy url, stream options)], removes: [(scrapy url, token)].
+    # Two rounds of POST /apply/, each checked against the node's version: a
+    # node that changed since rejects its batch and the next run plans
+    # again. The adds of every node go first; the removes are only sent
+    # once all adds were applied, so a stream is never stopped before its
+    # replacement runs. When an add is rejected, its tokens go back to the
+    # broker and nothing is removed: the adds applied elsewhere run next to
+    # the streams they were to replace until the next run.
+    versions = dict((scrapy_url, node["version"])
+                    for scrapy_url, node in nodes.iteritems())
+    added = {}
+    for scrapy_url, opt in adds:
+        added.setdefault(scrapy_url, {"add": [], "remove": []}) \
+            ["add"].append(opt)
+    removed = {}
+    for scrapy_url, key in removes:
+        # A token that is added again is restarted by the node in one step.
+        batch = added.get(scrapy_url)
+        if batch and key in [opt["oauth"]["token"] for opt in batch["add"]]:
+            batch["remove"].append(key)
+        else:
+            removed.setdefault(scrapy_url, []).append(key)
+
+    def post(scrapy_url, batch):
+        if scrapy_url in versions:
+            batch["version"] = versions[scrapy_url]
+        d = get_http().post("%s/apply/" % scrapy_url, batch)
+        d.addErrback(lambda failure: {"error": True,
+                                      "message": failure.getErrorMessage()})
+        return d.addCallback(lambda status: (scrapy_url, batch, status))
+
+    ts_start = time.time()
+    try:
+        results = yield gatherResults([post(scrapy_url, batch)
+                                       for scrapy_url, batch in
+                                       added.iteritems()])
+        failed = False
+        releases = []
+        for scrapy_url, batch, status in results:
+            if "success" in status:
+                for opt in batch["add"]:
+                    log.msg("Added stream %s: %r, " % (opt["filter"]["id"],
+                                                       json.dumps(opt)))
+                if batch["remove"]:
+                    log.msg("Restarted streams %r" % batch["remove"])
+                if "version" in status:
+                    versions[scrapy_url] = status["version"]
+                else:
+                    versions.pop(scrapy_url, None)
+                continue
+            failed = True
+            log.msg("Error applying changes on %s: %r, " % (
+                scrapy_url, json.dumps(status)))
+            releases.extend(release_token(broker_url, opt["oauth"])
+                            for opt in batch["add"])
+        if releases:
+            yield gatherResults(releases, consumeErrors=True)
+        if failed:
+            if removed:
+                log.msg("Kept streams %r: not all adds were applied" %
+                        [key for keys in removed.values() for key in keys])
+            return
+
+        results = yield gatherResults([post(scrapy_url, {"remove": keys})
+                                       for scrapy_url, keys in
+                                       removed.iteritems()])
+        for scrapy_url, batch, status in results:
+            if "success" in status:
+                log.msg("Stopped streams %r" % batch["remove"])
+            else:
+                log.msg("Error applying changes on %s: %r, " % (
+                    scrapy_url, json.dumps(status)))
+    finally:
+        METRICS.histogram("reconcile_seconds", "Time of a reconcile step.",
+                          step="apply").observe(time.time() - ts_start)
+
+
+@inlineCallbacks
+def take_token(broker_url, token=None, wait=1, tries=60):
+    # (scrapy url or None, token); waits for the broker to have one
+    for _ in xrange(tries):
+        if token is not None:
+            break
+        token = yield get_http().get("%s/get/" % broker_url)
+        if not ("token" in token and "secret" in token):
+            token = None
+            yield deferLater(reactor, wait, lambda: None)
+    if token is None:
+        raise ValueError("No token available from the broker")
+    returnValue((token.pop("node", None), token))
+
+
+def limit_loss(stream):
+    # Share of the stream's matched tweets that Twitter held back since it
+    # connected, from the limit notices counted by scrapy.
+    limits = stream.get("limits", 0)
+    total = limits + stream.get("received", 0)
+    if total == 0:
+        return 0.0
+    return float(limits) / total
+
+
+def make_follow_plan(streamer, nodes, streams, losses, user_ids):
+    used_fids = set(int(stream["filter"]["id"])
+                    for _, stream in list_streams(nodes))
+    free_fids = [fid for fid in xrange(streamer.id_from, 100)
+                 if fid not in used_fids]
+    locked = [fid for fid in streams if losses[fid] > streamer.max_loss]
+    return twplan.plan_follow(streams, user_ids, streamer.limit, free_fids,
+                              spare=streamer.spare, locked=locked)
+
+
+@inlineCallbacks
+def apply_follow_plan(streamer, plan, nodes):
+    # New streams are added before the restarted ones are removed, so the
+    # users that move are followed throughout.
+    log.msg("Follow plan: keep %d, restart %d, launch %d streams" % (
+        len(plan["keep"]), len(plan["restart"]), len(plan["launch"])))
+    launch = plan["launch"]
+    tokens = []
+    if launch:
+        tokens = yield get_tokens(streamer.broker_url, len(launch))
+    adds = []
+    for stream in launch:
+        token = tokens.pop() if tokens else None
+        add = yield streamer._make_stream(str(stream["id"]),
+                                          stream["follow"], token)
+        adds.append(add)
+    restart = set(str(fid) for fid in plan["restart"])
+    removes = [(scrapy_url, stream["token"])
+               for scrapy_url, stream in list_streams(nodes)
+               if str(stream["filter"]["id"]) in restart]
+    yield apply_changes(nodes, adds, removes, streamer.broker_url)
+
+
+def split_track(track, n):
+    # Contiguous parts of nearly equal size: neighbouring terms in
+    # default_streams.csv name the same team, and keeping them together
+    # keeps a team's tweets in one part.
+    size, extra = divmod(len(track), n)
+    parts = []
+    start = 0
+    for i in xrange(n):
+        end = start + size + (1 if i < extra else 0)
+        parts.append(track[start:end])
+        start = end
+    return parts
+
+
+def get_tokens(broker_url, n):
+    # Leases up to n tokens from the broker in one call.
+    def tokens(response):
+        if type(response) is list:
+            return response
+        return []
+
+    return get_http().get("%s/get/" % broker_url, {"n": n}) \
+        .addCallback(tokens)
+
+
+def release_token(broker_url, token):
+    return get_http().get("%s/release/" % broker_url,
+                          {"token": token["token"]})
+
+
 class DefaultStreamer(object):
+    # A track filter whose streams lose more than `split_loss` of their tweets
+    # to limit notices for `split_after` runs in a row is split over twice as
+    # many streams, up to `max_parts`. The parts keep the filter id, so the
+    # stored tweets still point at the CSV filter. When the parts together
+    # receive fewer than `merge_rate` tweets per minute per stream of the
+    # merged filter for `merge_after` runs, they are merged back in halves.
+    # A new streamer is created for every run, so the run counters are kept
+    # on the class.
+
+    overloaded = {}
+    underloaded = {}
 
     class Status(object):
 
@@ -53,25 +332,111 @@ class DefaultStreamer(object):
         scrapy_settings = read_settings("scrapy-settings.json")
         broker_settings = read_settings("broker-settings.json")
         self.default_file = settings["default"]["filename"]
-        self.scrapy_url = "http://%s:%d" % (scrapy_settings["api"]["host"], 
-                                            scrapy_settings["api"]["port"])
+        self.split_loss = settings["default"].get("split_loss", 0.05)
+        self.split_after = settings["default"].get("split_after", 5)
+        self.max_parts = settings["default"].get("max_parts", 4)
+        self.merge_rate = settings["default"].get("merge_rate", 1500)
+        self.merge_after = settings["default"].get("merge_after", 30)
+        self.scrapy_urls = scrapy_urls(scrapy_settings)
+        self.scrapy_url = self.scrapy_urls[0]
         self.broker_url = "http://%s:%d" % (broker_settings["api"]["host"], 
                                             broker_settings["api"]["port"])
 
+    @inlineCallbacks
     def stream(self):
         log.msg("Default streamer started.")
-        running_fltr = self._get_running_filters()
+        nodes = yield snapshot(self.scrapy_urls)
+        running_fltr = self._get_running_filters(nodes)
         default_fltr = self._load_default_filters()
+        launches = []
+        replaced = []
         for fid in default_fltr:
-            if fid not in running_fltr:
-                self._launch_stream(str(fid), default_fltr[fid])
+            parts = running_fltr.get(fid, [])
+            n = self._plan_parts(fid, default_fltr[fid], parts)
+            complete = self._complete(default_fltr[fid], parts)
+            if parts and not complete:
+                log.msg("Relaunch filter %s: %d of %d streams running" % (
+                    fid, len(parts), self._intended_parts(parts)))
+            elif n != len(parts) and parts:
+                log.msg("Resize filter %s from %d to %d streams" % (
+                    fid, len(parts), n))
+            if n != len(parts) or not complete:
+                launches.extend((fid, track, (i + 1, n)) for i, track in
+                                enumerate(split_track(default_fltr[fid], n)))
+                replaced.extend(parts)
+        tokens = []
+        if launches:
+            tokens = yield get_tokens(self.broker_url, len(launches))
+        adds = []
+        for fid, track, part in launches:
+            token = tokens.pop() if tokens else None
+            add = yield self._make_stream(str(fid), track, token, part)
+            adds.append(add)
+        # apply_changes removes the old streams only after every new one was
+        # added; tweets both deliver meanwhile have the same filter id and
+        # are dropped as repeats.
+        removes = [(scrapy_url, stream["token"])
+                   for scrapy_url, stream in replaced]
+        yield apply_changes(nodes, adds, removes, self.broker_url)
+
+    def _intended_parts(self, parts):
+        # The number of streams the filter was launched on, as recorded in
+        # every part; a stream that was lost does not lower it.
+        return max(stream["filter"].get("part", [1, 1])[1]
+                   for _, stream in parts)
+
+    def _complete(self, track, parts):
+        # Every part from 1 to n runs once, and together they track exactly
+        # what the CSV does.
+        if not parts:
+            return False
+        n = self._intended_parts(parts)
+        indexes = sorted(stream["filter"].get("part", [1, 1])[0]
+                         for _, stream in parts)
+        if indexes != range(1, n + 1):
+            return False
+        running = set()
+        for _, stream in parts:
+            running.update(stream["filter"].get("track", []))
+        return running == set(track)
+
+    def _plan_parts(self, fid, track, parts):
+        # Number of streams the filter should run on.
+        if not parts:
+            return 1
+        n = self._intended_parts(parts)
+        streams = [stream for _, stream in parts]
+        loss = limit_loss({
+            "limits": sum(stream.get("limits", 0) for stream in streams),
+            "received": sum(stream.get("received", 0) for stream in streams),
+        })
+        rate = sum(stream.get("rate", 0.0) for stream in streams)
+        if loss > self.split_loss and n < min(self.max_parts, len(track)):
+            self.overloaded[fid] = self.overloaded.get(fid, 0) + 1
+        else:
+            self.overloaded[fid] = 0
+        if n > 1 and loss <= self.split_loss \
+        and rate < self.merge_rate * (n // 2):
+            self.underloaded[fid] = self.underloaded.get(fid, 0) + 1
+        else:
+            self.underloaded[fid] = 0
 
-    def _get_running_filters(self):
+        if self.overloaded[fid] >= self.split_after:
+            n = min(n * 2, self.max_parts, len(track))
+        elif self.underloaded[fid] >= self.merge_after:
+            n = n // 2
+        else:
+            return n
+        self.overloaded[fid] = 0
+        self.underloaded[fid] = 0
+        return n
+
+    def _get_running_filters(self, nodes):
+        # filter id -> [(scrapy url, stream)], one entry per part
         filters = {}
-        text_response = requests.get("%s/list/" % self.scrapy_url).text
-        response = json.loads(text_response)
-        for stream in response:
-            filters[stream["filter"]["id"]] = stream["filter"]
+        for scrapy_url, stream in list_streams(nodes):
+            filters.setdefault(stream["filter"]["id"], []).append(
+                (scrapy_url, stream))
         return filters
 
     def _load_default_filters(self):
@@ -82,12 +447,9 @@ class DefaultStreamer(object):
                 filters[fltr.pop(0)] = fltr
         return filters
 
-    def _launch_stream(self, fid, track):
-        while(True):
-            text_response = requests.get("%s/get/" % self.broker_url).text
-            token = json.loads(text_response)
-            if "token" in token and "secret" in token:
-                break;
+    @inlineCallbacks
+    def _make_stream(self, fid, track, token=None, part=(1, 1)):
+        scrapy_url, token = yield take_token(self.broker_url, token)
 
         opt = {
             "name": "Default scraper " + str(fid),
@@ -97,15 +459,10 @@ class DefaultStreamer(object):
                 "track": track,
             }
         }
-        scrapy_params = {"data": json.dumps([opt])}
-        status = json.loads(requests.get("%s/add/" % self.scrapy_url, 
-                                        params=scrapy_params).text)
-        if "success" in status:
-            log.msg("Added stream %s: %r, " % (fid, json.dumps(opt)))
-        elif "error" in status:
-            log.msg("Error adding stream %s: %r, " % (fid, json.dumps(opt)))
-        else:
-            log.msg("Unknown status of stream %s: %r, " % (fid, json.dumps(opt)))
+        if part[1] > 1:
+            opt["name"] += " (%d/%d)" % part
+            opt["filter"]["part"] = list(part)
+        returnValue((scrapy_url or self.scrapy_url, opt))
 
 
 class FollowStreamer(object):
@@ -123,117 +480,55 @@ class FollowStreamer(object):
         self.id_from = settings["follow"]["id_from"]
         self.limit = settings["follow"]["limit"]
         self.min_tweets = settings["follow"]["min_tweets"]
-        self.db_string = "host='{host}' dbname='{dbname}' user='{user}' \
-                        password='{password}'".format(
-                            password = settings["database"]["password"],
-                            user = settings["database"]["username"],
-                            dbname = settings["database"]["name"],
-                            host = settings["database"]["host"],
-                            port = settings["database"]["port"],
-                            )
+        self.max_loss = settings["follow"].get("max_loss", 0.01)
+        self.spare = settings["follow"].get("spare", 1)
         self.tweet_table = settings["database"]["tweet_table"]
-        self.scrapy_url = "http://%s:%d" % (scrapy_settings["api"]["host"], 
-                                            scrapy_settings["api"]["port"])
+        self.scrapy_urls = scrapy_urls(scrapy_settings)
+        self.scrapy_url = self.scrapy_urls[0]
         self.broker_url = "http://%s:%d" % (broker_settings["api"]["host"], 
                                             broker_settings["api"]["port"])
 
+    @inlineCallbacks
     def stream(self):
         log.msg("Follow streamer started.")
-        following, streams = self._get_following_list()
-        user_ids = self._find_interesting_users()
-        user_ids = [uid for uid in user_ids if uid not in following]
-
-        if len(streams) > 0:
-        # stop and rebuild ALL streams with follow > limit
-            for fid, count in streams.items():
-                if count > self.limit:
-                    user_ids.extend(self._stop_stream(fid))
-                    del streams[fid]
-
-        if len(user_ids) > 0:
-            if len(streams) > 0:
-                # stop and rebuild ONlY ONE streams with follow < limit
-                fid, count = streams.items().pop()
-                user_ids.extend(self._stop_stream(fid))
-
-            splits = []
-            while(True):
-                # prepare splits of size <= limit
-                if len(user_ids) <= self.limit:
-                    splits.append(user_ids[:self.limit])
-                    break
-                splits.append(user_ids[:self.limit])
-                user_ids = user_ids[self.limit:]
-
-            used_fids = self._get_used_fids()
-            new_fids = range(self.id_from, 100)
-            new_fids.reverse()
-            for fid in used_fids:
-                if fid >= self.id_from: new_fids.remove(fid)
-            for follow in splits:
-                fid = str(new_fids.pop())
-                self._launch_stream(fid, follow)
-
-    def _get_following_list(self):
+        nodes = yield snapshot(self.scrapy_urls)
+        plan = yield self.plan(nodes)
+        yield apply_follow_plan(self, plan, nodes)
+
+    @inlineCallbacks
+    def plan(self, nodes=None):
+        if nodes is None:
+            nodes = yield snapshot(self.scrapy_urls)
+        streams, losses = self._get_following_list(nodes)
+        user_ids = yield self._find_interesting_users()
+        returnValue(make_follow_plan(self, nodes, streams, losses, user_ids))
+
+    def _get_following_list(self, nodes):
         streams = {}
-        following = []
-        text_response = requests.get("%s/list/" % self.scrapy_url).text
-        response = json.loads(text_response)
-        for stream in response:
+        losses = {}
+        for _, stream in list_streams(nodes):
             if int(stream["filter"]["id"]) >= self.id_from \
             and "follow" in stream["filter"]:
-                following.extend(stream["filter"]["follow"])
-                l = len(stream["filter"]["follow"])
-                if l != self.limit:
-                    streams[stream["filter"]["id"]] = l
-
-        return following, streams
-
-    def _get_used_fids(self):
-        while(True):
-            text_response = requests.get("%s/list/" % self.scrapy_url).text
-            response = json.loads(text_response)
-            if type(response) is list:
-                break;
-        fids = [int(stream["filter"]["id"]) for stream in response]
-        return fids
+                fid = int(stream["filter"]["id"])
+                streams.setdefault(fid, []).extend(stream["filter"]["follow"])
+                losses[fid] = max(losses.get(fid, 0.0), limit_loss(stream))
+
+        return streams, losses
 
     def _find_interesting_users(self):
         SQL = '''SELECT user_id, COUNT(*) AS c
                 FROM {rel_tweet}
                 GROUP BY user_id
                 ORDER BY c'''.format(rel_tweet=self.tweet_table)
-        con = psycopg2.connect(self.db_string)
-        cur = con.cursor()
-        cur.execute(SQL)
-        recs = cur.fetchall()
-        user_ids = [str(rec[0]) for rec in recs if rec[1] > self.min_tweets]
-        con.close()
-        return user_ids
 
-    def _stop_stream(self, fid):
-        text_response = requests.get("%s/list/" % self.scrapy_url).text
-        slist = json.loads(text_response)
-        tokens = []
-        user_ids = []
-        for stream in slist:
-            if stream["filter"]["id"] == fid:
-                tokens.append(stream["token"])
-                if "follow" in stream["filter"]:
-                    user_ids.extend(stream["filter"]["follow"])
-
-        scrapy_params = {"data": json.dumps(tokens)}
-        status = json.loads(requests.get("%s/remove/" % self.scrapy_url, params=scrapy_params).text)
-        log.msg("Stopped stream %s: %r, " % (fid, json.dumps(status)))
-
-        return user_ids
-
-    def _launch_stream(self, fid, follow):
-        while(True):
-            text_response = requests.get("%s/get/" % self.broker_url).text
-            token = json.loads(text_response)
-            if "token" in token and "secret" in token:
-                break;
+        def user_ids(recs):
+            return [str(rec[0]) for rec in recs if rec[1] > self.min_tweets]
+
+        return get_db().runQuery(SQL).addCallback(user_ids)
+
+    @inlineCallbacks
+    def _make_stream(self, fid, follow, token=None):
+        scrapy_url, token = yield take_token(self.broker_url, token)
 
         opt = {
             "name": "Follow scraper " + str(fid),
@@ -243,15 +538,7 @@ class FollowStreamer(object):
                 "follow": follow,
             }
         }
-        scrapy_params = {"data": json.dumps([opt])}
-        status = json.loads(requests.get("%s/add/" % self.scrapy_url, 
-                                        params=scrapy_params).text)
-        if "success" in status:
-            log.msg("Added stream %s: %r, " % (fid, json.dumps(opt)))
-        elif "error" in status:
-            log.msg("Error adding stream %s: %r, " % (fid, json.dumps(opt)))
-        else:
-            log.msg("Unknown status of stream %s: %r, " % (fid, json.dumps(opt)))
+        returnValue((scrapy_url or self.scrapy_url, opt))
 
 
 class HoopshypeStreamer(object):
@@ -269,102 +556,49 @@ class HoopshypeStreamer(object):
         self.id_from = settings["follow"]["id_from"]
         self.limit = settings["follow"]["limit"]
         self.min_tweets = settings["follow"]["min_tweets"]
-        self.scrapy_url = "http://%s:%d" % (scrapy_settings["api"]["host"], 
-                                            scrapy_settings["api"]["port"])
+        self.max_loss = settings["follow"].get("max_loss", 0.01)
+        self.spare = settings["follow"].get("spare", 1)
+        self.scrapy_urls = scrapy_urls(scrapy_settings)
+        self.scrapy_url = self.scrapy_urls[0]
         self.broker_url = "http://%s:%d" % (broker_settings["api"]["host"], 
                                             broker_settings["api"]["port"])
 
+    @inlineCallbacks
     def stream(self):
         log.msg("Hoopshype streamer started.")
-        hoops = HoopsHype()
-        user_ids = hoops.get()
-        following, streams = self._get_following_list()
-        user_ids = [uid for uid in user_ids if uid not in following]
+        nodes = yield snapshot(self.scrapy_urls)
+        plan = yield self.plan(nodes)
         hcount = int(open('hoopshype.txt','rb').read())
-        hcount += len(user_ids)
+        hcount += plan["added"]
         open('hoopshype.txt','wb').write(str(hcount))
+        yield apply_follow_plan(self, plan, nodes)
+
+    @inlineCallbacks
+    def plan(self, nodes=None):
+        if nodes is None:
+            nodes = yield snapshot(self.scrapy_urls)
+        # HoopsHype scrapes pages and looks names up with blocking clients.
+        hoops = HoopsHype()
+        user_ids = yield threads.deferToThreadPool(reactor, get_worker(),
+                                                   hoops.get)
+        streams, losses = self._get_following_list(nodes)
+        returnValue(make_follow_plan(self, nodes, streams, losses, user_ids))
 
-        if len(streams) > 0:
-        # stop and rebuild ALL streams with follow > limit
-            for fid, count in streams.items():
-                if count > self.limit:
-                    user_ids.extend(self._stop_stream(fid))
-                    del streams[fid]
-
-        if len(user_ids) > 0:
-            if len(streams) > 0:
-                # stop and rebuild ONlY ONE streams with follow < limit
-                fid, count = streams.items().pop()
-                user_ids.extend(self._stop_stream(fid))
-
-            splits = []
-            while(True):
-                # prepare splits of size <= limit
-                if len(user_ids) <= self.limit:
-                    splits.append(user_ids[:self.limit])
-                    break
-                splits.append(user_ids[:self.limit])
-                user_ids = user_ids[self.limit:]
-
-            used_fids = self._get_used_fids()
-            new_fids = range(self.id_from, 100)
-            new_fids.reverse()
-            for fid in used_fids:
-                if fid >= self.id_from: new_fids.remove(fid)
-            for follow in splits:
-                fid = str(new_fids.pop())
-                self._launch_stream(fid, follow)
-
-    def _get_following_list(self):
+    def _get_following_list(self, nodes):
         streams = {}
-        following = []
-        while(True):
-            text_response = requests.get("%s/list/" % self.scrapy_url).text
-            response = json.loads(text_response)
-            if type(response) is list:
-                break;
-        for stream in response:
+        losses = {}
+        for _, stream in list_streams(nodes):
             if int(stream["filter"]["id"]) >= self.id_from \
             and "follow" in stream["filter"]:
-                following.extend(stream["filter"]["follow"])
-                l = len(stream["filter"]["follow"])
-                if l != self.limit:
-                    streams[stream["filter"]["id"]] = l
-
-        return following, streams
-
-    def _get_used_fids(self):
-        while(True):
-            text_response = requests.get("%s/list/" % self.scrapy_url).text
-            response = json.loads(text_response)
-            if type(response) is list:
-                break;
-        fids = [int(stream["filter"]["id"]) for stream in response]
-        return fids
-
-    def _stop_stream(self, fid):
-        text_response = requests.get("%s/list/" % self.scrapy_url).text
-        slist = json.loads(text_response)
-        tokens = []
-        user_ids = []
-        for stream in slist:
-            if stream["filter"]["id"] == fid:
-                tokens.append(stream["token"])
-                if "follow" in stream["filter"]:
-                    user_ids.extend(stream["filter"]["follow"])
-
-        scrapy_params = {"data": json.dumps(tokens)}
-        status = json.loads(requests.get("%s/remove/" % self.scrapy_url, params=scrapy_params).text)
-        log.msg("Stopped stream %s: %r, " % (fid, json.dumps(status)))
-
-        return user_ids
-
-    def _launch_stream(self, fid, follow):
-        while(True):
-            text_response = requests.get("%s/get/" % self.broker_url).text
-            token = json.loads(text_response)
-            if "token" in token and "secret" in token:
-                break;
+                fid = int(stream["filter"]["id"])
+                streams.setdefault(fid, []).extend(stream["filter"]["follow"])
+                losses[fid] = max(losses.get(fid, 0.0), limit_loss(stream))
+
+        return streams, losses
+
+    @inlineCallbacks
+    def _make_stream(self, fid, follow, token=None):
+        scrapy_url, token = yield take_token(self.broker_url, token)
 
         opt = {
             "name": "Follow scraper " + str(fid),
@@ -374,62 +608,36 @@ class HoopshypeStreamer(object):
                 "follow": follow,
             }
         }
-        scrapy_params = {"data": json.dumps([opt])}
-        status = json.loads(requests.get("%s/add/" % self.scrapy_url, 
-                                        params=scrapy_params).text)
-        if "success" in status:
-            log.msg("Added stream %s: %r, " % (fid, json.dumps(opt)))
-        elif "error" in status:
-            log.msg("Error adding stream %s: %r, " % (fid, json.dumps(opt)))
-        else:
-            log.msg("Unknown status of stream %s: %r, " % (fid, json.dumps(opt)))
+        returnValue((scrapy_url or self.scrapy_url, opt))
 
 
 def get_data():
-    try:
-        settings = read_settings("nba-settings.json")
-        db_string = "host='{host}' dbname='{dbname}' user='{user}' \
-                    password='{password}'".format(
-                        password = settings["database"]["password"],
-                        user = settings["database"]["username"],
-                        dbname = settings["database"]["name"],
-                        host = settings["database"]["host"],
-                        port = settings["database"]["port"])
-        tweet_table = settings["database"]["tweet_table"]
-        SQL = '''SELECT count(*)
-            FROM {rel_tweet}
-            GROUP BY timestamp::date, EXTRACT(hour FROM timestamp)
-            ORDER BY timestamp::date, EXTRACT(hour FROM timestamp)
-            '''.format(rel_tweet=tweet_table)
-        con = psycopg2.connect(db_string)
-        cur = con.cursor()
-        cur.execute(SQL)
-        recs = cur.fetchall()
-        counts = [rec[0] for rec in recs]
-        con.close()
-        return counts
-    except Exception:
-        log.msg("Error, get_data: %s" % traceback.format_exc())
+    settings = read_settings("nba-settings.json")
+    tweet_table = settings["database"]["tweet_table"]
+    SQL = '''SELECT count(*)
+        FROM {rel_tweet}
+        GROUP BY timestamp::date, EXTRACT(hour FROM timestamp)
+        ORDER BY timestamp::date, EXTRACT(hour FROM timestamp)
+        '''.format(rel_tweet=tweet_table)
+
+    def counts(recs):
+        return [rec[0] for rec in recs]
+
+    def failed(failure):
+        log.msg("Error, get_data: %s" % failure.getTraceback())
         return {"error" : True}
 
+    return get_db().runQuery(SQL).addCallbacks(counts, failed)
+
 def get_collected():
-    try:
+    settings = read_settings("nba-settings.json")
+    tweet_table = settings["database"]["tweet_table"]
+
+    def count(cur):
         resp = {
             "total": 0,
             "geo": 0
             }
-        settings = read_settings("nba-settings.json")
-        db_string = "host='{host}' dbname='{dbname}' user='{user}' \
-                    password='{password}'".format(
-                        password = settings["database"]["password"],
-                        user = settings["database"]["username"],
-                        dbname = settings["database"]["name"],
-                        host = settings["database"]["host"],
-                        port = settings["database"]["port"])
-        tweet_table = settings["database"]["tweet_table"]
-        con = psycopg2.connect(db_string)
-        cur = con.cursor()
-
         SQL = '''SELECT count(*)
             FROM {rel_tweet}'''.format(rel_tweet=tweet_table)
         cur.execute(SQL)
@@ -442,18 +650,39 @@ def get_collected():
         cur.execute(SQL)
         recs = cur.fetchall()
         resp["geo"] = recs[0][0]
-        con.close()
         return resp
-    except Exception:
-        log.msg("Error, get_collected: %s" % traceback.format_exc())
+
+    def failed(failure):
+        log.msg("Error, get_collected: %s" % failure.getTraceback())
         return {"error" : True}
 
+    return get_db().runInteraction(count).addErrback(failed)
+
 
 class NbaAPI(resource.Resource):
+    # Paths that talk to scrapy, the broker or the database answer when
+    # their deferred fires; the reactor keeps serving other requests.
     isLeaf = True
 
     def __init__(self):
         resource.Resource.__init__(self)
+        self.profiler = twprofile.from_settings(
+            read_settings("nba-settings.json"))
+
+    def render(self, request):
+        METRICS.time_request(request)
+        return resource.Resource.render(self, request)
+
+    def _respond(self, response, request):
+        request.write(response)
+        request.finish()
+
+    def _fail(self, failure, request):
+        request.write(json.dumps({
+            "error": True,
+            "message": failure.getTraceback(),
+        }))
+        request.finish()
 
     def render_GET(self, request):
         try:
@@ -462,33 +691,42 @@ class NbaAPI(resource.Resource):
             request.setHeader("Access-Control-Allow-Origin", "*")
 
             if request.path == "/restart/":
-                st1 = DefaultStreamer()
-                st1.stream()
-                st2 = FollowStreamer()
-                st2.stream()
-                return "done"
+                d = JOBS["default"].run()
+                d.addCallback(lambda _: JOBS["follow"].run())
+                d.addCallback(lambda _: "done")
             elif request.path == "/data/":
-                response = get_data()
-                return json.dumps(response)
+                d = get_data().addCallback(json.dumps)
             elif request.path == "/collected/":
-                response = get_collected()
-                return json.dumps(response)
+                d = get_collected().addCallback(json.dumps)
 
             elif request.path == "/hoops_users/":
                 hcount = int(open('hoopshype.txt','rb').read())
                 return str(hcount)
+            elif request.path == "/plan/":
+                streamer = request.args.get("streamer", ["follow"])[0]
+                if streamer == "hoopshype":
+                    d = HoopshypeStreamer().plan()
+                else:
+                    d = FollowStreamer().plan()
+                d.addCallback(json.dumps)
             elif request.path == "/restart_hoops/":
-                st3 = HoopshypeStreamer()
-                st3.stream()
-                return "done"
+                d = JOBS["hoopshype"].run()
+                d.addCallback(lambda _: "done")
+            elif request.path == "/jobs/":
+                return json.dumps(dict((name, job.status())
+                                       for name, job in JOBS.iteritems()))
+
+            elif request.path.startswith("/profile/"):
+                return self.profiler.render(request)
+            elif request.path in ("/metrics", "/metrics/"):
+                request.setHeader("Content-Type",
+                                  "text/plain; version=0.0.4")
+                return METRICS.render()
 
             elif request.path == "/ping/":
                 return "pong"
             elif request.path == "/log/":
-                logfile = open("log-nba/daily-log.log")
-                log_message = logfile.read()
-                logfile.close()
-                return log_message
+                return twlog.serve(request, "log-nba/daily-log.log")
             else:
                 #log.msg("Wrong API path '%s'" % request.path, logLevel=logging.DEBUG)
                 return json.dumps({
@@ -496,6 +734,10 @@ class NbaAPI(resource.Resource):
                     "message": "Wrong API path '%s'" % request.path,
                 })
 
+            d.addCallbacks(self._respond, self._fail,
+                           callbackArgs=(request,), errbackArgs=(request,))
+            return server.NOT_DONE_YET
+
         except Exception:
             #log.msg("Error: %s" % traceback.format_exc())
             return json.dumps({
@@ -504,31 +746,166 @@ class NbaAPI(resource.Resource):
             })
 
 
-def restart_default():
-    try:
-        st1 = DefaultStreamer()
-        st1.stream()
-    except Exception:
-        log.msg("Error, restart default: %s" % traceback.format_exc())
+class Job(object):
+    # A streamer run every `interval` seconds. Only one run of a job goes at a
+    # time: ticks and /restart/ requests that come while it runs are
+    # coalesced into one run right after it. A run still going after
+    # `timeout` seconds fails its callers with a TimeoutError, but is not
+    # cancelled: the thread or request it waits on would go on all the same,
+    # and the next run would overlap it. The job stays running until the run
+    # really ends.
+
+    def __init__(self, name, func, interval, timeout=300):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.timeout = timeout
+        self.loop = LoopingCall(self.tick)
+        self.running = False
+        self.waiting = []
+        self.last_start = None
+        self.last_duration = None
+        self.last_success = None
+        self.last_error = None
+        self.runs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.coalesced = 0
+
+    def start(self):
+        self.loop.start(self.interval)
+
+    def tick(self):
+        # Errors are logged by _finished; the loop keeps its own schedule.
+        self.run().addErrback(lambda _: None)
+
+    def run(self):
+        # Fires when a run that started at or after this call finishes.
+        d = Deferred()
+        if self.running:
+            self.coalesced += 1
+            self.waiting.append(d)
+        else:
+            self._start([d])
+        return d
+
+    def _start(self, waiters):
+        self.running = True
+        self.last_start = time.time()
+        d = maybeDeferred(self.func)
+        timer = None
+        if self.timeout:
+            timer = reactor.callLater(self.timeout, self._timed_out, waiters)
+        d.addBoth(self._finished, timer, waiters)
+
+    def _error(self, message):
+        self.failures += 1
+        self.last_error = {
+            "time": iso_time(datetime.datetime.utcnow()),
+            "message": message,
+        }
+
+    def _timed_out(self, waiters):
+        self.timeouts += 1
+        message = "Timed out after %d seconds" % self.timeout
+        self._error(message)
+        log.msg("Error, %s job: %s, still waiting for it to end" %
+                (self.name, message))
+        failure = Failure(TimeoutError(message))
+        pending = list(waiters)
+        del waiters[:]
+        for d in pending:
+            d.errback(failure)
+
+    def _finished(self, result, timer, waiters):
+        timed_out = timer is not None and not timer.active()
+        if timer is not None and timer.active():
+            timer.cancel()
+        now = time.time()
+        self.last_duration = now - self.last_start
+        self.runs += 1
+        if timed_out:
+            outcome = "timeout"
+        elif isinstance(result, Failure):
+            outcome = "error"
+        else:
+            outcome = "success"
+        METRICS.histogram(
+            "job_seconds", "Duration of a streamer run.", job=self.name,
+            outcome=outcome,
+        ).observe(self.last_duration)
+        if isinstance(result, Failure):
+            if not timed_out:
+                self._error(result.getErrorMessage())
+            log.msg("Error, %s job: %s" % (self.name, result.getTraceback()))
+        else:
+            self.last_success = now
+        self.running = False
+        if self.waiting:
+            pending, self.waiting = self.waiting, []
+            self._start(pending)
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def status(self):
+        def stamp(ts):
+            if ts is None:
+                return None
+            return iso_time(datetime.datetime.utcfromtimestamp(ts))
+
+        next_run = None
+        if self.loop.running and self.loop.call is not None:
+            next_run = self.loop.call.getTime()
+        return {
+            "interval": self.interval,
+            "timeout": self.timeout,
+            "running": self.running,
+            "queued": len(self.waiting),
+            "last_start": stamp(self.last_start),
+            "last_duration": self.last_duration,
+            "last_success": stamp(self.last_success),
+            "last_error": self.last_error,
+            "next_run": stamp(next_run),
+            "runs": self.runs,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "coalesced": self.coalesced,
+        }
 
 
-def restart_follow():
-    try:
-        st2 = FollowStreamer()
-        st2.stream()
-    except Exception:
-        log.msg("Error, restart follow: %s" % traceback.format_exc())
+def collect_job_metrics():
+    jobs = sorted(JOBS.items())
+    return [
+        ("job_running", "gauge", "1 while a streamer run is going.",
+         [({"job": name}, int(job.running)) for name, job in jobs]),
+        ("job_failures_total", "counter", "Streamer runs that failed.",
+         [({"job": name}, job.failures) for name, job in jobs]),
+        ("job_timeouts_total", "counter",
+         "Streamer runs cancelled after their timeout.",
+         [({"job": name}, job.timeouts) for name, job in jobs]),
+        ("job_coalesced_total", "counter",
+         "Ticks and restarts that came while a run was going.",
+         [({"job": name}, job.coalesced) for name, job in jobs]),
+    ]
 
-def restart_hoopshype():
-    try:
-        st3 = HoopshypeStreamer()
-        st3.stream()
-    except Exception:
-        log.msg("Error, restart hoopshype: %s" % traceback.format_exc())
 
-def restart_hoopshype_async():
-    pool = multiprocessing.Pool(processes=1)
-    pool.apply_async(restart_hoopshype)
+METRICS.collector(collect_job_metrics)
+
+
+def make_jobs(settings):
+    for name, streamer in (("default", DefaultStreamer),
+                           ("follow", FollowStreamer),
+                           ("hoopshype", HoopshypeStreamer)):
+        JOBS[name] = Job(
+            name,
+            lambda streamer=streamer: streamer().stream(),
+            settings[name]["interval"],
+            settings[name].get("timeout", 300),
+        )
+    return JOBS
 
 
 MSG = \
@@ -552,7 +929,7 @@ Started on: %s UTC
 PORT: %d
 LOG: %r
 PID: %d
-SCRAPER: %s:%s/
+SCRAPER: %s
 BROKER: %s:%s/\n
 """
 
@@ -579,8 +956,7 @@ if __name__ == "__main__":
         api_port,
         log_file,
         os.getpid(),
-        scrapy_settings["api"]["host"],
-        scrapy_settings["api"]["port"],
+        ", ".join(scrapy_urls(scrapy_settings)),
         broker_settings["api"]["host"],
         broker_settings["api"]["port"],
     )
@@ -591,14 +967,8 @@ if __name__ == "__main__":
     site = server.Site(api)
     reactor.listenTCP(api_port, site)
 
-    lc1 = LoopingCall(lambda: restart_default())
-    lc1.start(settings["default"]["interval"])
-
-    lc2 = LoopingCall(lambda: restart_follow())
-    lc2.start(settings["follow"]["interval"])
-
-    lc3 = LoopingCall(lambda: restart_hoopshype_async())
-    lc3.start(settings["hoopshype"]["interval"])
+    for job in make_jobs(settings).itervalues():
+        job.start()
     
     reactor.run()
 
@@ -8,10 +8,19 @@
 
 import os
 import sys
+import time
+import random
+import socket
+import urllib
 import logging
 import datetime
 import argparse
 import traceback
+import twcodec
+import twbuffer
+import twmetrics
+import twlog
+import twprofile
 import twstorage
 import multiprocessing
 import oauth2 as oauth
@@ -19,9 +28,11 @@ import anyjson as json
 
 from collections import deque
 from twisted.python import log
-from twisted.internet import reactor
+from twisted.web.client import getPage
 from twisted.web import server, resource
+from twisted.internet import reactor, protocol
 from twisted.internet.task import LoopingCall
+from twisted.internet.defer import gatherResults
 from twisted.python.logfile import DailyLogFile
 from twforce.streams import TwClientFactory, TwHandler, connect_api
 
@@ -56,27 +67,661 @@ class TweetHandler(TwHandler):
     def connection_made(self):
         self.scraper.status = self.scraper.Status.CONNECTED
         self.scraper.ts_connect = datetime.datetime.utcnow()
+        self.scraper.last_limit = 0
         log.msg("Connection made %r" % self.scraper,
                 logLevel=logging.WARNING)
 
     def connection_lost(self, reason):
         self.scraper.received = 0
         self.scraper.limits = 0
+        self.scraper.last_limit = 0
         self.scraper.status = self.scraper.Status.FAILED
         log.msg("Connection lost %r\nReason:%r" % (self.scraper, reason),
                 logLevel=logging.WARNING)
 
     def handle(self, line):
         try:
-            jsn = json.loads(line)
-            if "text" in jsn:
-                self.scraper.add_tweet(jsn)
-            elif "limit" in jsn:
-                self.scraper.add_limit(jsn)
+            if self.scraper.parser is not None:
+                self.scraper.parser.add(self.scraper, line)
+            else:
+                kind, value = twcodec.parse_line(line)
+                self.scraper.add_parsed(kind, value, line)
         except Exception:
             pass
 
 
+class ParsePool(object):
+    # Decodes stream lines in worker processes instead of the reactor
+    # thread. The reactor only gathers raw lines into chunks and applies the
+    # (kind, value) pairs that come back. Chunks are numbered and applied in
+    # the order the lines arrived, whatever order the workers finish in, so
+    # a stream's tweets and limit notices keep their order. With
+    # max_in_flight chunks already being parsed, new chunks wait; past
+    # max_waiting of them, the oldest is parsed inline. A chunk a worker has
+    # not answered within `timeout` seconds (it died, or hangs) gives its
+    # slot back and is parsed inline.
+
+    def __init__(self, workers=2, chunk_size=500, max_in_flight=8,
+                 max_waiting=32, timeout=10):
+        self.pool = multiprocessing.Pool(processes=workers)
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.chunk = []
+        self.waiting = deque([])
+        self.sent = {}
+        self.parsed = {}
+        self.next_chunk = 0
+        self.next_apply = 0
+        self.in_flight = 0
+        self.offloaded = 0
+        self.inline = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.latency = 0.0
+
+    def add(self, scraper, line):
+        self.chunk.append((scraper, line))
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.chunk:
+            return
+        self.waiting.append((self.next_chunk, self.chunk))
+        self.next_chunk += 1
+        self.chunk = []
+        self._send()
+        while len(self.waiting) > self.max_waiting:
+            seq, chunk = self.waiting.popleft()
+            self._parse_inline(seq, chunk)
+
+    def _send(self):
+        while self.waiting and self.in_flight < self.max_in_flight:
+            seq, chunk = self.waiting.popleft()
+            self.in_flight += 1
+            ts_sent = time.time()
+            timer = reactor.callLater(self.timeout, self._timed_out, seq)
+            self.sent[seq] = (chunk, timer)
+            self.pool.apply_async(
+                twcodec.parse_lines,
+                [[line for _, line in chunk]],
+                callback=lambda results, seq=seq, ts_sent=ts_sent:
+                    reactor.callFromThread(self._parsed, seq, results,
+                                           ts_sent),
+            )
+
+    def _parse_inline(self, seq, chunk):
+        self.inline += len(chunk)
+        self.parsed[seq] = (chunk, twcodec.parse_lines(
+            [line for _, line in chunk]))
+        self._apply_ready()
+
+    def _parsed(self, seq, results, ts_sent):
+        sent = self.sent.pop(seq, None)
+        if sent is None:
+            # Parsed inline after it timed out.
+            return
+        chunk, timer = sent
+        timer.cancel()
+        self.in_flight -= 1
+        self.offloaded += len(chunk)
+        self.latency = 0.8 * self.latency + 0.2 * (time.time() - ts_sent)
+        self.parsed[seq] = (chunk, results)
+        self._apply_ready()
+        self._send()
+
+    def _timed_out(self, seq):
+        chunk, _ = self.sent.pop(seq)
+        self.in_flight -= 1
+        self.timeouts += 1
+        log.msg("Parsing %d lines timed out after %ds, parsed inline" % (
+            len(chunk), self.timeout), logLevel=logging.WARNING)
+        self._parse_inline(seq, chunk)
+        self._send()
+
+    def _apply_ready(self):
+        while self.next_apply in self.parsed:
+            chunk, results = self.parsed.pop(self.next_apply)
+            self.next_apply += 1
+            self.apply(chunk, results)
+
+    def apply(self, chunk, results):
+        for (scraper, line), (kind, value) in zip(chunk, results):
+            if kind == twcodec.ERROR:
+                self.errors += 1
+                continue
+            scraper.add_parsed(kind, value, line)
+
+    def stats(self):
+        return {
+            "queued": len(self.chunk),
+            "waiting": len(self.waiting),
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "offloaded": self.offloaded,
+            "inline": self.inline,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "latency": self.latency,
+        }
+
+
+class TweetFilter(object):
+    # Ids seen in the last `window` seconds, at most `size` of them, so the
+    # memory it takes is bounded no matter how bursty the streams are.
+
+    NEW = 0
+    MATCH = 1
+    REPEAT = 2
+
+    def __init__(self, window=600, size=100000):
+        self.window = window
+        self.size = size
+        self.ids = {}
+        self.order = deque([])
+        self.hits = 0
+        self.misses = 0
+
+    def expire(self, now):
+        deadline = now - self.window
+        while self.order and \
+              (len(self.order) > self.size or self.order[0][0] < deadline):
+            _, tweet_id = self.order.popleft()
+            del self.ids[tweet_id]
+
+    def add(self, tweet_id, filter_id):
+        # NEW for an unseen id, MATCH for a repeat delivered by another
+        # filter, REPEAT when this filter has delivered it already.
+        filters = self.ids.get(tweet_id)
+        if filters is not None:
+            self.hits += 1
+            if filter_id in filters:
+                return self.REPEAT
+            filters.append(filter_id)
+            return self.MATCH
+        now = time.time()
+        self.misses += 1
+        filters = [filter_id]
+        self.ids[tweet_id] = filters
+        self.order.append((now, tweet_id))
+        self.expire(now)
+        return self.NEW
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.ids),
+            "max_size": self.size,
+            "window": self.window,
+        }
+
+
+class FlushPolicy(object):
+    # Decides when collect_received sends the buffer to storage: as soon as
+    # it holds max_items or max_bytes, or its oldest item is max_age seconds
+    # old. Below that, a batch of at least min_items goes out once it is
+    # older than target_age(), which follows the measured commit latency:
+    # fast commits give short batches, slow commits give fewer, bigger ones.
+
+    def __init__(self, max_items=20000, max_bytes=32 * 1024 * 1024,
+                 max_age=300, min_age=5, min_items=500, utilization=0.5):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.min_age = min_age
+        self.min_items = min_items
+        self.utilization = utilization
+        self.latency = 0.0
+        self.commits = 0
+        self.last_reason = None
+
+    def commit_done(self, seconds):
+        if self.commits == 0:
+            self.latency = seconds
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * seconds
+        self.commits += 1
+
+    def target_age(self):
+        age = self.latency / self.utilization
+        return min(self.max_age, max(self.min_age, age))
+
+    def reason(self, buffer, now):
+        if buffer.segments:
+            return "backlog"
+        if not buffer.memory:
+            return None
+        if len(buffer.memory) >= self.max_items:
+            return "items"
+        if buffer.memory_bytes >= self.max_bytes:
+            return "bytes"
+        age = now - buffer.memory_since
+        if age >= self.max_age:
+            return "max_age"
+        if age >= self.target_age() and len(buffer.memory) >= self.min_items:
+            return "age"
+        return None
+
+    def stats(self):
+        return {
+            "commit_latency": self.latency,
+            "commits": self.commits,
+            "target_age": self.target_age(),
+            "last_reason": self.last_reason,
+        }
+
+
+class ReconnectPolicy(object):
+    # Decides which scrapers reconnect and when. A connected scraper is
+    # reconnected only when it looks unhealthy after its first `grace`
+    # seconds:
+    #
+    #   * "stalled": nothing arrived for `stall_after` seconds, or for
+    #     `stall_gaps` times the gap its usual rate leads to expect,
+    #     whichever is longer;
+    #   * "collapsed": its rate stays below `collapse_ratio` of its usual
+    #     rate (when that is at least `min_rate` per minute) for `strikes`
+    #     checks in a row;
+    #   * "limited": limit notices hold back more than `flood_loss` of its
+    #     tweets for `strikes` checks in a row.
+    #
+    # The usual rate is a moving average of the rate seen at healthy checks.
+    # The reconnect happens at a random time within `spread` seconds, so
+    # streams that go bad together do not reconnect together. A failed
+    # scraper, or one still connecting `grace` seconds after its last
+    # attempt, is retried after `backoff_min` seconds, doubled after every
+    # failure up to `backoff_max`, with jitter; the count is reset once it
+    # passes a check healthy.
+
+    def __init__(self, spread=300, grace=300, stall_after=300, stall_gaps=10,
+                 collapse_ratio=0.1, min_rate=10, flood_loss=0.5, strikes=3,
+                 smoothing=0.1, backoff_min=30, backoff_max=960):
+        self.spread = spread
+        self.grace = grace
+        self.stall_after = stall_after
+        self.stall_gaps = stall_gaps
+        self.collapse_ratio = collapse_ratio
+        self.min_rate = min_rate
+        self.flood_loss = flood_loss
+        self.strikes = strikes
+        self.smoothing = smoothing
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.planned = {}
+        self.retries = 0
+
+    def delay(self):
+        return random.uniform(0, self.spread)
+
+    def backoff(self, failures):
+        delay = min(self.backoff_max, self.backoff_min * 2 ** failures)
+        return random.uniform(delay / 2.0, delay)
+
+    def stuck(self, scraper):
+        # True for a connecting scraper whose last attempt never got through.
+        if scraper.ts_attempt is None:
+            return False
+        waited = datetime.datetime.utcnow() - scraper.ts_attempt
+        return waited.total_seconds() > self.grace
+
+    def check(self, scraper, now):
+        # Reason to reconnect a connected scraper, or None.
+        checked = scraper.checked
+        scraper.checked = (now, scraper.total_received, scraper.total_limits)
+        if checked is None or scraper.ts_connect is None:
+            return None
+        elapsed = now - checked[0]
+        if elapsed <= 0:
+            return None
+        received = scraper.total_received - checked[1]
+        limits = scraper.total_limits - checked[2]
+        rate = received / elapsed * 60
+        utcnow = datetime.datetime.utcnow()
+        if (utcnow - scraper.ts_connect).total_seconds() < self.grace:
+            self._learn(scraper, rate)
+            return None
+
+        baseline = scraper.baseline
+        if baseline > 0:
+            last = max(scraper.last_received or scraper.ts_connect,
+                       scraper.ts_connect)
+            silent = (utcnow - last).total_seconds()
+            if silent > max(self.stall_after, self.stall_gaps * 60 / baseline):
+                return "stalled"
+        bad = None
+        if baseline >= self.min_rate and rate < baseline * self.collapse_ratio:
+            bad = "collapsed"
+        elif limits and float(limits) / (limits + received) > self.flood_loss:
+            bad = "limited"
+        if bad is None:
+            scraper.strikes = 0
+            scraper.failures = 0
+            self._learn(scraper, rate)
+            return None
+        scraper.strikes += 1
+        if scraper.strikes >= self.strikes:
+            return bad
+        return None
+
+    def _learn(self, scraper, rate):
+        if scraper.baseline == 0:
+            scraper.baseline = rate
+        else:
+            scraper.baseline += self.smoothing * (rate - scraper.baseline)
+
+    def stats(self):
+        return {
+            "planned": dict(self.planned),
+            "retries": self.retries,
+            "spread": self.spread,
+            "backoff_min": self.backoff_min,
+            "backoff_max": self.backoff_max,
+        }
+
+
+def shard_items(frames, shards):
+    # Tweets and their match frames are placed by tweet id, so everything
+    # about one tweet reaches the same worker; limit notices by filter id.
+    # Each part is handed over as a single framed string.
+    if shards == 1:
+        return ["".join(frames)]
+    parts = [[] for _ in xrange(shards)]
+    for frame in frames:
+        kind, filter_id, value, _ = twbuffer.HEADER.unpack_from(frame)
+        key = filter_id if kind == twbuffer.LIMIT else value
+        parts[key % shards].append(frame)
+    return ["".join(part) for part in parts]
+
+
+class StorageBatch(object):
+
+    def __init__(self, key, done):
+        self.key = key
+        self.done = done
+        self.pending = set()
+        self.reports = {}
+        self.attempts = {}
+        self.ts_start = time.time()
+
+
+class StoragePool(object):
+    # A pool of single-process storage workers, each with its own database
+    # session. Every batch is split into one part per worker; it is
+    # acknowledged once all parts are committed, and batches are
+    # acknowledged in the order they were submitted. A part that is rolled
+    # back, or not stored within `timeout` seconds, is sent again to the same
+    # worker after `retry_delay` seconds. After `max_attempts` it is handed to
+    # `dead_letter(key, worker, part)` and counted as stored, so that one bad
+    # part does not hold back every later batch. Parts are stored with their
+    # host and segment path, which lets twstorage skip the limit notices of a
+    # part that was already committed.
+
+    def __init__(self, workers=1, max_in_flight=2, retry_delay=5,
+                 max_attempts=5, timeout=600, dead_letter=None,
+                 metrics=None):
+        init = lambda: twstorage.init(read_settings())
+        self.workers = [multiprocessing.Pool(processes=1, initializer=init)
+                        for _ in xrange(workers)]
+        self.max_in_flight = max_in_flight
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.dead_letter = dead_letter
+        self.host = socket.gethostname()
+        self.in_flight = deque([])
+        self.worker_stats = [{
+            "worker": i,
+            "queued": 0,
+            "batches": 0,
+            "items": 0,
+            "failures": 0,
+            "timeouts": 0,
+            "dead_letters": 0,
+            "matches_orphaned": 0,
+            "limits_duplicates": 0,
+            "tweets_inserted": 0,
+            "tweets_duplicates": 0,
+            "busy": 0.0,
+            "latency": 0.0,
+            "last_latency": 0.0,
+        } for i in xrange(workers)]
+        metrics = metrics or twmetrics.Registry("scrapy")
+        self.commit_seconds = [
+            metrics.histogram("storage_commit_seconds",
+                              "Time from sending a part to a storage worker "
+                              "to its commit.", worker=str(i))
+            for i in xrange(workers)]
+
+    def full(self):
+        return len(self.in_flight) >= self.max_in_flight
+
+    def submit(self, key, items, done):
+        batch = StorageBatch(key, done)
+        self.in_flight.append(batch)
+        parts = shard_items(items, len(self.workers))
+        for worker, part in enumerate(parts):
+            if part:
+                batch.pending.add(worker)
+                self._send(batch, worker, part)
+        if not batch.pending:
+            self._acknowledge()
+
+    def _send(self, batch, worker, part):
+        if worker not in batch.pending:
+            # A late answer to an attempt that timed out stored the part.
+            return
+        attempt = batch.attempts.get(worker, 0) + 1
+        batch.attempts[worker] = attempt
+        ts_sent = time.time()
+        self.worker_stats[worker]["queued"] += 1
+        timer = reactor.callLater(self.timeout, self._timed_out,
+                                  batch, worker, part, attempt)
+        self.workers[worker].apply_async(
+            twstorage.save,
+            [part, "%s:%s" % (self.host, batch.key)],
+            callback=lambda report: reactor.callFromThread(
+                self._stored, batch, worker, part, ts_sent, report,
+                attempt, timer),
+        )
+
+    def _timed_out(self, batch, worker, part, attempt):
+        # A worker that died or hangs never calls back.
+        stats = self.worker_stats[worker]
+        stats["queued"] -= 1
+        if worker not in batch.pending:
+            return
+        stats["timeouts"] += 1
+        log.msg("Storing %s on worker %d timed out after %ds (attempt %d)" %
+                (batch.key, worker, self.timeout, attempt),
+                logLevel=logging.WARNING)
+        self._retry(batch, worker, part)
+
+    def _retry(self, batch, worker, part):
+        if batch.attempts[worker] < self.max_attempts:
+            reactor.callLater(self.retry_delay,
+                              self._send, batch, worker, part)
+            return
+        self.worker_stats[worker]["dead_letters"] += 1
+        log.msg("Storing %s on worker %d failed %d times, dead-lettered" %
+                (batch.key, worker, batch.attempts[worker]),
+                logLevel=logging.WARNING)
+        if self.dead_letter is not None:
+            self.dead_letter(batch.key, worker, part)
+        batch.pending.discard(worker)
+        self._acknowledge()
+
+    def _stored(self, batch, worker, part, ts_sent, report, attempt, timer):
+        # Only an attempt whose timer is still armed retries on a failure:
+        # for one that timed out, the retry is already scheduled. A late
+        # success is kept all the same.
+        stats = self.worker_stats[worker]
+        armed = timer.active()
+        if armed:
+            timer.cancel()
+            stats["queued"] -= 1
+        if worker not in batch.pending or (report is None and not armed):
+            return
+        latency = time.time() - ts_sent
+        stats["last_latency"] = latency
+        if stats["batches"]:
+            stats["latency"] = 0.8 * stats["latency"] + 0.2 * latency
+        else:
+            stats["latency"] = latency
+        stats["busy"] += latency
+        self.commit_seconds[worker].observe(latency)
+        if report is None:
+            # twstorage.save returns None when the part was rolled back.
+            stats["failures"] += 1
+            log.msg("Storing %s on worker %d failed (attempt %d)" %
+                    (batch.key, worker, attempt), logLevel=logging.WARNING)
+            self._retry(batch, worker, part)
+            return
+        stats["batches"] += 1
+        stats["items"] += report["tweets"] + report["limits"]
+        stats["matches_orphaned"] += report.get("matches_orphaned", 0)
+        stats["limits_duplicates"] += report.get("limits_duplicates", 0)
+        stats["tweets_inserted"] += report.get("tweets_inserted", 0)
+        stats["tweets_duplicates"] += report.get("tweets_duplicates", 0)
+        report["ts_sent"] = ts_sent
+        batch.reports[worker] = report
+        batch.pending.discard(worker)
+        self._acknowledge()
+
+    def _acknowledge(self):
+        while self.in_flight and not self.in_flight[0].pending:
+            batch = self.in_flight.popleft()
+            batch.done(batch.key, time.time() - batch.ts_start,
+                       batch.reports)
+
+    def purge(self):
+        self.workers[0].apply_async(twstorage.purge)
+
+    def stats(self):
+        workers = []
+        for stats in self.worker_stats:
+            stats = dict(stats)
+            busy = stats.pop("busy")
+            stats["throughput"] = stats["items"] / busy if busy else 0.0
+            workers.append(stats)
+        return {
+            "in_flight": len(self.in_flight),
+            "max_in_flight": self.max_in_flight,
+            "workers": workers,
+        }
+
+
+class LatencyTracer(object):
+    # Follows one in `sample_every` new tweets from Twitter to final_table and
+    # keeps the seconds spent in each stage for the last `keep` of them:
+    #
+    #   stream  created (from the tweet id) -> received by the scraper
+    #   cache   received -> taken from the buffer in a batch
+    #   queue   sent to a storage worker -> the worker starts on it
+    #   write   worker start -> rows written
+    #   move    rows written -> SQL_MOVE committed, readable in final_table
+    #   total   created -> committed
+    #
+    # A trace is filed under the buffer segment the tweet was written to and
+    # completed when that segment's batch is acknowledged. At most
+    # `max_open` traces wait at a time.
+
+    STAGES = ("stream", "cache", "queue", "write", "move", "total")
+
+    # Twitter's ids start with the milliseconds since this epoch.
+    TWEPOCH = 1288834974657
+
+    def __init__(self, workers=1, sample_every=1000, keep=1000,
+                 max_open=10000, metrics=None):
+        self.workers = workers
+        self.sample_every = sample_every
+        self.countdown = sample_every
+        self.max_open = max_open
+        self.open = {}
+        self.opened = 0
+        self.dropped = 0
+        self.completed = deque([], maxlen=keep)
+        metrics = metrics or twmetrics.Registry("scrapy")
+        self.histograms = [
+            metrics.histogram("tweet_stage_seconds",
+                              "Seconds a sampled tweet spent in a stage.",
+                              stage=stage)
+            for stage in self.STAGES]
+
+    def received(self, tweet_id, path):
+        # Called for every new tweet after it is appended to the buffer
+        # segment at `path`.
+        self.countdown -= 1
+        if self.countdown > 0:
+            return
+        self.countdown = self.sample_every
+        if self.opened >= self.max_open:
+            self.dropped += 1
+            return
+        now = time.time()
+        created = ((tweet_id >> 22) + self.TWEPOCH) / 1000.0
+        if not now - 86400 < created < now + 60:
+            created = None
+        self.open.setdefault(path, []).append(
+            [tweet_id, created, now, None])
+        self.opened += 1
+
+    def popped(self, path):
+        now = time.time()
+        for trace in self.open.get(path, ()):
+            trace[3] = now
+
+    def done(self, path, reports):
+        # reports: storage worker -> the report of twstorage.save, with the
+        # time the part was sent added as "ts_sent".
+        traces = self.open.pop(path, None)
+        if not traces:
+            return
+        self.opened -= len(traces)
+        for tweet_id, created, received, popped in traces:
+            report = reports.get(tweet_id % self.workers)
+            if report is None or popped is None:
+                continue
+            stages = (
+                received - created if created else None,
+                popped - received,
+                report["ts_start"] - report["ts_sent"],
+                report["ts_written"] - report["ts_start"],
+                report["ts_commit"] - report["ts_written"],
+                report["ts_commit"] - created if created else None,
+            )
+            for histogram, seconds in zip(self.histograms, stages):
+                if seconds is not None:
+                    histogram.observe(seconds)
+            self.completed.append(stages)
+
+    def stats(self, recent=10):
+        stages = {}
+        for i, stage in enumerate(self.STAGES):
+            values = sorted(t[i] for t in self.completed if t[i] is not None)
+            if not values:
+                stages[stage] = None
+                continue
+            stages[stage] = {
+                "p50": values[int(0.5 * (len(values) - 1))],
+                "p90": values[int(0.9 * (len(values) - 1))],
+                "p99": values[int(0.99 * (len(values) - 1))],
+                "max": values[-1],
+                "mean": sum(values) / len(values),
+            }
+        return {
+            "sample_every": self.sample_every,
+            "open": self.opened,
+            "dropped": self.dropped,
+            "completed": len(self.completed),
+            "stages": stages,
+            "recent": [dict(zip(self.STAGES, t))
+                       for t in list(self.completed)[-recent:]],
+        }
+
+
 class ScraperState(object):
 
     class Status(object):
@@ -85,7 +730,8 @@ class ScraperState(object):
         CONNECTING = 0
         FAILED = -1
 
-    def __init__(self, name, token, filter, cache_location):
+    def __init__(self, name, token, filter, cache_location, seen,
+                 parser=None, rate_window=60, tracer=None):
         self.handler = TweetHandler(self)
         self.name = name
         self.token = token
@@ -96,14 +742,30 @@ class ScraperState(object):
         self.connector = None
         self.received = 0
         self.limits = 0
+        self.last_limit = 0
         self.last_received = None
         self.ts_start = datetime.datetime.utcnow()
         self.ts_connect = None
+        self.ts_attempt = None
         self.errors = deque([], maxlen=32)
         self.cache = cache_location
         self.total_limits = 0
         self.total_received = 0
+        self.duplicates = 0
         self.rate = 0
+        self.seen = seen
+        self.parser = parser
+        self.tracer = tracer
+        # Health and retry state kept by ReconnectPolicy and ScrapyAPI.
+        self.checked = None
+        self.baseline = 0.0
+        self.strikes = 0
+        self.failures = 0
+        self.reconnects = 0
+        self.pending = None
+        # Sampled by sample_rates, not per tweet.
+        self.received_window = twmetrics.RateWindow(rate_window)
+        self.limits_window = twmetrics.RateWindow(rate_window)
         log.msg("Create new scraper %r" % self)
         log.msg("New scraper filter %r" % json.dumps(filter))
 
@@ -117,6 +779,8 @@ class ScraperState(object):
 
     def connect(self, consumer):
         log.msg("Connect %r" % self, logLevel=logging.DEBUG)
+        self.status = self.Status.CONNECTING
+        self.ts_attempt = datetime.datetime.utcnow()
         if not self.factory:
             self.factory = TwClientFactory.filter_streamer(
                 consumer,
@@ -141,6 +805,8 @@ class ScraperState(object):
         self.factory.stopTrying()
         self.connector.disconnect()
         log.msg("Reconnect %r" % self, logLevel=logging.DEBUG)
+        self.status = self.Status.CONNECTING
+        self.ts_attempt = datetime.datetime.utcnow()
         self.factory = TwClientFactory.filter_streamer(
             consumer,
             self.token,
@@ -151,26 +817,56 @@ class ScraperState(object):
         )
         self.connector = connect_api(self.factory)
 
-    def add_tweet(self, tweet):
+    def add_parsed(self, kind, value, line):
+        if kind == twcodec.TWEET:
+            self.add_tweet(value, line)
+        elif kind == twcodec.LIMIT:
+            self.add_limit(value)
+
+    def add_tweet(self, tweet_id, line):
         #user_id = str(tweet["user"]["id"])
         #if "follow" not in self.filter \
         #or user_id in self.filter.get("follow", []):
         self.received += 1
         self.total_received += 1
-        self.cache.append((self.token.key, self.filter_id, tweet))
-        self.last_received = datetime.datetime.now()
-
-    def add_limit(self, limit):
-        limit_value = 0
-        for n in limit["limit"].values():
-            limit_value += n
-        self.limits += limit_value
-        self.total_limits += limit_value
-        self.cache.append((self.token.key, self.filter_id, limit_value))
+        self.last_received = datetime.datetime.utcnow()
+        # The raw line is what gets stored; a repeat from another filter only
+        # leaves a header-only frame so storage can record the match.
+        seen = self.seen.add(tweet_id, self.filter_id)
+        if seen == TweetFilter.NEW:
+            path = self.cache.append(twbuffer.pack(
+                twbuffer.TWEET, self.filter_id, tweet_id, line))
+            if self.tracer is not None:
+                self.tracer.received(tweet_id, path)
+            return
+        self.duplicates += 1
+        if seen == TweetFilter.MATCH:
+            self.cache.append(twbuffer.pack(
+                twbuffer.MATCH, self.filter_id, tweet_id))
+
+    def add_limit(self, limit_value):
+        # Twitter reports the number of tweets held back since the
+        # connection was opened, so only the growth since the last notice is
+        # counted. The notice itself is stored as it came.
+        if limit_value >= self.last_limit:
+            held_back = limit_value - self.last_limit
+        else:
+            held_back = limit_value
+        self.last_limit = limit_value
+        self.limits += held_back
+        self.total_limits += held_back
+        self.cache.append(twbuffer.pack(
+            twbuffer.LIMIT, self.filter_id, limit_value))
         self.last_received = datetime.datetime.utcnow()
 
     def get_rate(self):
-        d = (datetime.datetime.utcnow() - self.ts_connect).seconds
+        # Tweets per minute over the last metrics.rate_window seconds, or
+        # since the connection until the window has two samples.
+        if self.received_window.ready():
+            return self.received_window.rate() * 60
+        if self.ts_connect is None:
+            return 0.0
+        d = (datetime.datetime.utcnow() - self.ts_connect).total_seconds()
         if d > 0:
             return float(self.received) / d * 60
         return 0.0
@@ -182,71 +878,347 @@ class ScraperState(object):
 class ScrapyAPI(resource.Resource):
     isLeaf = True
 
-    def __init__(self, consumer):
+    # Adds and removes are numbered; /list/?since=<version> answers from the
+    # last MAX_CHANGES of them and falls back to the full list beyond that.
+    MAX_CHANGES = 1024
+
+    def __init__(self, consumer, settings, log_dir="log"):
         resource.Resource.__init__(self)
+        self.log_path = os.path.join(log_dir, "daily-log.log")
         self.scrapers = {}
         self.consumer = consumer
-        self.cache = deque([])
-        init = lambda: twstorage.init(read_settings())
-        self.storage_worker = multiprocessing.Pool(processes=1,
-                                                   initializer=init)
+        # Starting from the clock keeps versions increasing across restarts,
+        # so a version from an earlier run always gets the full list.
+        self.version = int(time.time() * 1000)
+        self.changes = deque([], maxlen=self.MAX_CHANGES)
+        self.metrics = twmetrics.Registry("scrapy")
+        self.metrics.collector(self._collect_metrics)
+        self.profiler = twprofile.from_settings(settings)
+        self.rate_window = settings.get("metrics", {}).get("rate_window", 60)
+        cache_settings = settings.get("cache", {})
+        self.cache = twbuffer.IngestBuffer(
+            spill_dir=cache_settings.get("spill_dir", "spill"),
+            memory_budget=cache_settings.get("memory_budget",
+                                             64 * 1024 * 1024),
+            max_replays=cache_settings.get("max_replays", 3),
+        )
+        for path in self.cache.quarantined:
+            log.msg("Segment sent to storage %d times without a commit, "
+                    "moved to %s" % (self.cache.max_replays, path),
+                    logLevel=logging.WARNING)
+        storage_settings = settings.get("storage", {})
+        self.storage = StoragePool(
+            workers=storage_settings.get("workers", 1),
+            max_in_flight=storage_settings.get("max_in_flight", 2),
+            retry_delay=storage_settings.get("retry_delay", 5),
+            max_attempts=storage_settings.get("max_attempts", 5),
+            timeout=storage_settings.get("timeout", 600),
+            dead_letter=self.cache.dead_letter,
+            metrics=self.metrics,
+        )
+        flush_settings = settings.get("flush", {})
+        self.flush = FlushPolicy(
+            max_items=flush_settings.get("max_items", 20000),
+            max_bytes=flush_settings.get("max_bytes", 32 * 1024 * 1024),
+            max_age=flush_settings.get("max_age",
+                                       settings["database"]["commit_delay"]),
+            min_age=flush_settings.get("min_age", 5),
+            min_items=flush_settings.get("min_items", 500),
+            utilization=flush_settings.get("utilization", 0.5),
+        )
+        self.seen = TweetFilter(
+            window=cache_settings.get("dedup_window", 600),
+            size=cache_settings.get("dedup_size", 100000),
+        )
+        trace_settings = settings.get("trace", {})
+        self.tracer = None
+        if trace_settings.get("sample_every", 1000) > 0:
+            self.tracer = LatencyTracer(
+                workers=len(self.storage.workers),
+                sample_every=trace_settings.get("sample_every", 1000),
+                keep=trace_settings.get("keep", 1000),
+                max_open=trace_settings.get("max_open", 10000),
+                metrics=self.metrics,
+            )
+        ingest_settings = settings.get("ingest", {})
+        self.parser = None
+        if ingest_settings.get("mode", "inline") == "pool":
+            self.parser = ParsePool(
+                workers=ingest_settings.get("workers", 2),
+                chunk_size=ingest_settings.get("chunk_size", 500),
+                max_in_flight=ingest_settings.get("max_in_flight", 8),
+                max_waiting=ingest_settings.get("max_waiting", 32),
+                timeout=ingest_settings.get("timeout", 10),
+            )
+        reconnect_settings = settings.get("reconnect", {})
+        self.reconnect = ReconnectPolicy(
+            spread=reconnect_settings.get("spread", 300),
+            grace=reconnect_settings.get("grace", 300),
+            stall_after=reconnect_settings.get("stall_after", 300),
+            stall_gaps=reconnect_settings.get("stall_gaps", 10),
+            collapse_ratio=reconnect_settings.get("collapse_ratio", 0.1),
+            min_rate=reconnect_settings.get("min_rate", 10),
+            flood_loss=reconnect_settings.get("flood_loss", 0.5),
+            strikes=reconnect_settings.get("strikes", 3),
+            backoff_min=reconnect_settings.get("backoff_min", 30),
+            backoff_max=reconnect_settings.get("backoff_max", 960),
+        )
+
+    def _changed(self, key):
+        self.version += 1
+        self.changes.append((self.version, key))
+
+    def _make_scraper(self, param):
+        token = oauth.Token(
+            key=param["oauth"]["token"],
+            secret=param["oauth"]["secret"]
+        )
+        location = tuple(param["filter"].get("location", []))
+        track = tuple(param["filter"].get("track", []))
+        follow = tuple(param["filter"].get("follow", []))
+        name = param["name"]
+        flt = dict(id=param["filter"]["id"])
+        if len(location) > 0: flt["location"] = location
+        if len(track) > 0: flt["track"] = track
+        if len(follow) > 0: flt["follow"] = follow
+        if "part" in param["filter"]: flt["part"] = param["filter"]["part"]
+        return ScraperState(name, token, flt, self.cache, self.seen,
+                            self.parser, self.rate_window, self.tracer)
+
+    def _start_scraper(self, new_scraper):
+        self.scrapers[new_scraper.token.key] = new_scraper
+        new_scraper.connect(self.consumer)
+        self._changed(new_scraper.token.key)
+
     def __add_scrapers__(self, param_list):
         for param in param_list:
-            token = oauth.Token(
-                key=param["oauth"]["token"],
-                secret=param["oauth"]["secret"]
-            )
-            location = tuple(param["filter"].get("location", []))
-            track = tuple(param["filter"].get("track", []))
-            follow = tuple(param["filter"].get("follow", []))
-            name = param["name"]
-            if token.key not in self.scrapers:
-                flt = dict(id=param["filter"]["id"])
-                if len(location) > 0: flt["location"] = location
-                if len(track) > 0: flt["track"] = track
-                if len(follow) > 0: flt["follow"] = follow
-                new_scraper = ScraperState(name, token, flt, self.cache)
-                self.scrapers[token.key] = new_scraper
-                new_scraper.connect(self.consumer)
+            if param["oauth"]["token"] not in self.scrapers:
+                self._start_scraper(self._make_scraper(param))
 
         return {"success": True}
+
+    def __apply__(self, params):
+        # Adds, then removes, in one reactor turn: either the whole batch is
+        # applied or, when an add is malformed or `version` is given and
+        # the list changed since, nothing is. New scrapers start connecting
+        # before the old ones are stopped; a token that is also removed can
+        # only run once, so it is stopped first and then restarted.
+        version = params.get("version")
+        if version is not None and version != self.version:
+            return {
+                "error": True,
+                "message": "Version conflict",
+                "version": self.version,
+            }
+        new_scrapers = []
+        for param in params.get("add", []):
+            key = param["oauth"]["token"]
+            if key not in self.scrapers or key in params.get("remove", []):
+                new_scrapers.append(self._make_scraper(param))
+        started = set()
+        for new_scraper in new_scrapers:
+            if new_scraper.token.key not in self.scrapers:
+                self._start_scraper(new_scraper)
+                started.add(new_scraper.token.key)
+        self.__remove_scrapers__([key for key in params.get("remove", [])
+                                  if key not in started])
+        for new_scraper in new_scrapers:
+            if new_scraper.token.key not in self.scrapers:
+                self._start_scraper(new_scraper)
+        return {"success": True, "version": self.version}
     
-    def restart_scrapers(self):
-        for scraper in self.scrapers.itervalues():
-            scraper.reconnect(self.consumer)
-            
-    def restart_failed_scrapers(self):
-        for scraper in self.scrapers.itervalues():
+    def check_scrapers(self):
+        # Plans a reconnect for every unhealthy scraper and a retry for
+        # every failed or stuck one that has none pending.
+        now = time.time()
+        for scraper in self.scrapers.values():
+            if scraper.pending is not None:
+                continue
             if scraper.status == ScraperState.Status.FAILED:
-                scraper.reconnect(self.consumer)
-    
+                delay = self.reconnect.backoff(scraper.failures)
+                scraper.failures += 1
+                self._plan_reconnect(scraper, delay, "failed")
+            elif scraper.status == ScraperState.Status.CONNECTING:
+                if self.reconnect.stuck(scraper):
+                    delay = self.reconnect.backoff(scraper.failures)
+                    scraper.failures += 1
+                    self._plan_reconnect(scraper, delay, "connecting")
+            elif scraper.status == ScraperState.Status.CONNECTED:
+                reason = self.reconnect.check(scraper, now)
+                if reason is not None:
+                    self._plan_reconnect(scraper, self.reconnect.delay(),
+                                         reason)
+
+    def _plan_reconnect(self, scraper, delay, reason):
+        if reason == "failed":
+            self.reconnect.retries += 1
+        else:
+            self.reconnect.planned[reason] = \
+                self.reconnect.planned.get(reason, 0) + 1
+            log.msg("Reconnect %r in %ds: %s" % (scraper, delay, reason),
+                    logLevel=logging.WARNING)
+        scraper.pending = reactor.callLater(delay, self._reconnect,
+                                            scraper, reason)
+
+    def _reconnect(self, scraper, reason):
+        scraper.pending = None
+        if self.scrapers.get(scraper.token.key) is not scraper:
+            return
+        # A failed or stuck scraper may have come back on its own meanwhile.
+        if reason == "failed" \
+        and scraper.status != ScraperState.Status.FAILED:
+            return
+        if reason == "connecting" \
+        and scraper.status != ScraperState.Status.CONNECTING:
+            return
+        scraper.reconnects += 1
+        scraper.checked = None
+        scraper.strikes = 0
+        scraper.reconnect(self.consumer)
+
+    def sample_rates(self):
+        now = time.time()
+        for scraper in self.scrapers.itervalues():
+            scraper.received_window.sample(scraper.total_received, now)
+            scraper.limits_window.sample(scraper.total_limits, now)
+
+    def _collect_metrics(self):
+        received = []
+        limits = []
+        tweets = []
+        limited = []
+        duplicates = []
+        connected = []
+        filters = {}
+        for s in self.scrapers.itervalues():
+            labels = {"scraper": s.name, "filter": s.filter_id}
+            rate = s.received_window.rate()
+            received.append((labels, s.total_received))
+            limits.append((labels, s.total_limits))
+            duplicates.append((labels, s.duplicates))
+            tweets.append((labels, rate))
+            limited.append((labels, s.limits_window.rate()))
+            connected.append((labels, int(s.status ==
+                                          ScraperState.Status.CONNECTED)))
+            filters[s.filter_id] = filters.get(s.filter_id, 0.0) + rate
+        cache = self.cache.stats()
+        storage = self.storage.stats()
+        seen = self.seen.stats()
+        reconnect = self.reconnect.stats()
+        return [
+            ("scraper_received_total", "counter",
+             "Tweets received by a scraper.", received),
+            ("scraper_limits_total", "counter",
+             "Tweets held back by limit notices of a scraper.", limits),
+            ("scraper_duplicates_total", "counter",
+             "Tweets a scraper received that another filter had already "
+             "delivered.", duplicates),
+            ("scraper_tweets_per_second", "gauge",
+             "Tweets received per second over the rate window.", tweets),
+            ("scraper_limits_per_second", "gauge",
+             "Tweets held back per second over the rate window.", limited),
+            ("scraper_connected", "gauge",
+             "1 when the scraper is connected.", connected),
+            ("filter_tweets_per_second", "gauge",
+             "Tweets received per second by all parts of a filter.",
+             [({"filter": fid}, rate) for fid, rate in filters.items()]),
+            ("cache_depth", "gauge",
+             "Items in the ingest buffer.", [({}, cache["depth"])]),
+            ("cache_bytes", "gauge",
+             "Bytes in the ingest buffer.",
+             [({"where": "memory"}, cache["memory_bytes"]),
+              ({"where": "spilled"}, cache["spilled_bytes"])]),
+            ("cache_spilled_segments", "gauge",
+             "Sealed segments waiting on disk.",
+             [({}, cache["spilled_segments"])]),
+            ("storage_in_flight", "gauge",
+             "Batches sent to storage and not committed yet.",
+             [({}, storage["in_flight"])]),
+            ("storage_failures_total", "counter",
+             "Parts rolled back by a storage worker.",
+             [({"worker": w["worker"]}, w["failures"])
+              for w in storage["workers"]]),
+            ("storage_timeouts_total", "counter",
+             "Parts a storage worker did not answer in time.",
+             [({"worker": w["worker"]}, w["timeouts"])
+              for w in storage["workers"]]),
+            ("storage_dead_letters_total", "counter",
+             "Parts given up on after the last attempt.",
+             [({"worker": w["worker"]}, w["dead_letters"])
+              for w in storage["workers"]]),
+            ("dedup_hits_total", "counter",
+             "Tweet ids found in the duplicate filter.",
+             [({}, seen["hits"])]),
+            ("dedup_misses_total", "counter",
+             "Tweet ids not found in the duplicate filter.",
+             [({}, seen["misses"])]),
+            ("reconnects_total", "counter",
+             "Reconnects planned, by reason.",
+             [({"reason": reason}, count)
+              for reason, count in reconnect["planned"].items()] +
+             [({"reason": "failed"}, reconnect["retries"])]),
+        ]
+
+    def render(self, request):
+        self.metrics.time_request(request)
+        return resource.Resource.render(self, request)
+
     def __remove_scrapers__(self, params):
         for t in params:
             scraper = self.scrapers.get(t)
             if scraper:
+                if scraper.pending is not None:
+                    scraper.pending.cancel()
+                    scraper.pending = None
                 scraper.disconnect()
                 del self.scrapers[t]
+                self._changed(t)
         return {"success": True}
 
+    def _describe(self, s):
+        return {
+            "name": s.name,
+            "token": s.token.key,
+            "status": s.status,
+            "ts_start": s.ts_starts(),
+            "received": s.received,
+            "total_received": s.total_received,
+            "limits": s.limits,
+            "total_limits": s.total_limits,
+            "duplicates": s.duplicates,
+            "last_received": s.last_receiveds(),
+            "rate": s.get_rate(),
+            "reconnects": s.reconnects,
+            "failures": s.failures,
+            "filter": s.filter,
+            "errors": list(s.errors),
+        }
+
     def __list_scrapers__(self):
         sc_list = []
         for s in self.scrapers.values():
-            sc_list.append({
-                "name": s.name,
-                "token": s.token.key,
-                "status": s.status,
-                "ts_start": s.ts_starts(),
-                "received": s.received,
-                "total_received": s.total_received,
-                "limits": s.limits,
-                "total_limits": s.total_limits,
-                "last_received": s.last_receiveds(),
-                "rate": s.get_rate(),
-                "filter": s.filter,
-                "errors": list(s.errors),
-            })
+            sc_list.append(self._describe(s))
         return sc_list
 
+    def __list_changes__(self, since):
+        # Scrapers added and tokens removed after version `since`.
+        oldest = self.version - len(self.changes)
+        if not oldest <= since <= self.version:
+            return {
+                "version": self.version,
+                "full": True,
+                "streams": self.__list_scrapers__(),
+                "removed": [],
+            }
+        keys = set(key for version, key in self.changes if version > since)
+        return {
+            "version": self.version,
+            "full": False,
+            "streams": [self._describe(self.scrapers[key])
+                        for key in keys if key in self.scrapers],
+            "removed": [key for key in keys if key not in self.scrapers],
+        }
+
     def render_GET(self, request):
         try:
             #log.msg("Handle request: %s" % request.path, logLevel=logging.DEBUG)
@@ -259,20 +1231,47 @@ class ScrapyAPI(resource.Resource):
                 return json.dumps(response)
 
             elif request.path == "/list/":
-                response = self.__list_scrapers__()
+                if "since" in request.args:
+                    since = int(request.args["since"][0])
+                    response = self.__list_changes__(since)
+                else:
+                    response = self.__list_scrapers__()
                 return json.dumps(response)
 
             elif request.path == "/remove/":
                 params = json.loads(request.args["data"][0])
                 response = self.__remove_scrapers__(params)
                 return json.dumps(response)
+            elif request.path == "/buffer/":
+                response = self.cache.stats()
+                response["flush"] = self.flush.stats()
+                return json.dumps(response)
+            elif request.path == "/storage/":
+                return json.dumps(self.storage.stats())
+            elif request.path == "/ingest/":
+                if self.parser is None:
+                    return json.dumps({"mode": "inline"})
+                response = self.parser.stats()
+                response["mode"] = "pool"
+                return json.dumps(response)
+            elif request.path == "/dedup/":
+                return json.dumps(self.seen.stats())
+            elif request.path == "/reconnect/":
+                return json.dumps(self.reconnect.stats())
+            elif request.path.startswith("/profile/"):
+                return self.profiler.render(request)
+            elif request.path == "/trace/":
+                if self.tracer is None:
+                    return json.dumps({"sample_every": 0})
+                return json.dumps(self.tracer.stats())
+            elif request.path in ("/metrics", "/metrics/"):
+                request.setHeader("Content-Type",
+                                  "text/plain; version=0.0.4")
+                return self.metrics.render()
             elif request.path == "/ping/":
                 return "pong"
             elif request.path == "/log/":
-                logfile = open("log/daily-log.log")
-                log_message = logfile.read()
-                logfile.close()
-                return log_message
+                return twlog.serve(request, self.log_path)
             else:
                 #log.msg("Wrong API path '%s'" % request.path,logLevel=logging.DEBUG)
                 return json.dumps({
@@ -288,25 +1287,441 @@ class ScrapyAPI(resource.Resource):
             })
 
 
+    def render_POST(self, request):
+        try:
+            request.setHeader("Content-Type", "application/json")
+            request.setHeader("Access-Control-Allow-Origin", "*")
+
+            if request.path == "/apply/":
+                params = json.loads(request.content.read())
+                response = self.__apply__(params)
+                return json.dumps(response)
+            else:
+                return json.dumps({
+                    "error": True,
+                    "message": "Wrong API path '%s'" % request.path,
+                })
+
+        except Exception:
+            return json.dumps({
+                "error": True,
+                "message": traceback.format_exc(),
+            })
+
+
 def collect_received(api):
-    collected = []
-    d_len = len(api.cache)
-    while d_len:
-        collected.append(api.cache.pop())
-        d_len -= 1
-    if collected:
-        api.storage_worker.map_async(twstorage.save, [collected])
+    # Batches are sent while fewer than storage.max_in_flight are waiting
+    # for their commit; past that, items stay in the spool instead of piling
+    # up in the worker queues. A backlog (or what a previous run left
+    # behind) is drained as fast as commits return.
+    while not api.storage.full():
+        reason = api.flush.reason(api.cache, time.time())
+        if reason is None:
+            return
+        api.flush.last_reason = reason
+        path, collected = api.cache.pop_batch()
+        if path is None:
+            return
+        if api.tracer is not None:
+            api.tracer.popped(path)
+        if collected:
+            api.metrics.histogram(
+                "flush_batch_items", "Items per batch sent to storage.",
+                twmetrics.SIZE_BUCKETS, reason=reason,
+            ).observe(len(collected))
+            api.storage.submit(path, collected,
+                               lambda key, seconds, reports:
+                                   collect_stored(api, key, seconds, reports))
+        else:
+            api.cache.ack(path)
 
 
-def restart_scrapers(api):
-    api.restart_scrapers()
-    log.msg("Scrapers has been restarted (%s)" % len(api.__list_scrapers__()))
+def collect_stored(api, path, seconds, reports):
+    api.flush.commit_done(seconds)
+    if api.tracer is not None:
+        api.tracer.done(path, reports)
+    api.metrics.histogram(
+        "batch_commit_seconds",
+        "Time from sending a batch to storage to its acknowledgement.",
+    ).observe(seconds)
+    api.cache.ack(path)
+    collect_received(api)
 
 
-def restart_failed_scrapers(api):
-    api.restart_failed_scrapers()
-    log.msg("Failed scrapes has been restarted")
-    
+def purge_storage(api):
+    api.storage.purge()
+
+
+def check_scrapers(api):
+    api.check_scrapers()
+
+
+def sample_rates(api):
+    api.sample_rates()
+
+
+class ShardedScrapyAPI(resource.Resource):
+    # Front end of a sharded scraper: the same HTTP API, backed by child
+    # scrapy.py processes (one reactor, cache and storage pool each) on
+    # local ports. Scrapers are placed on the shard running the fewest;
+    # /list/ and the status paths are gathered from every shard. The add
+    # parameters of every scraper are kept, so that a shard restarted after
+    # a crash gets its scrapers back.
+    isLeaf = True
+
+    SHARD_PATHS = ("/buffer/", "/storage/", "/dedup/", "/ingest/",
+                   "/reconnect/", "/trace/")
+
+    def __init__(self, shard_urls, log_dir="log"):
+        resource.Resource.__init__(self)
+        self.shard_urls = shard_urls
+        self.log_dir = log_dir
+        self.assignments = {}
+        self.params = {}
+        self.metrics = twmetrics.Registry("scrapy")
+        self.profiler = twprofile.from_settings(read_settings())
+
+    def _get(self, shard, path, params=None):
+        url = "%s%s" % (self.shard_urls[shard], path)
+        if params:
+            url = "%s?%s" % (url, urllib.urlencode(params))
+        return getPage(url).addCallback(json.loads)
+
+    def _post(self, shard, path, body):
+        url = "%s%s" % (self.shard_urls[shard], path)
+        return getPage(url, method="POST", postdata=json.dumps(body),
+                       headers={"Content-Type": "application/json"}) \
+            .addCallback(json.loads)
+
+    def _least_loaded(self):
+        counts = [0] * len(self.shard_urls)
+        for shard in self.assignments.itervalues():
+            counts[shard] += 1
+        return counts.index(min(counts))
+
+    def __add_scrapers__(self, param_list):
+        groups = {}
+        for param in param_list:
+            key = param["oauth"]["token"]
+            self.params[key] = param
+            if key not in self.assignments:
+                self.assignments[key] = self._least_loaded()
+            groups.setdefault(self.assignments[key], []).append(param)
+        return self._gather_status(groups, "/add/")
+
+    def __remove_scrapers__(self, params):
+        groups = {}
+        for key in params:
+            self.params.pop(key, None)
+            shard = self.assignments.pop(key, None)
+            shards = [shard] if shard is not None \
+                else range(len(self.shard_urls))
+            for shard in shards:
+                groups.setdefault(shard, []).append(key)
+        return self._gather_status(groups, "/remove/")
+
+    def _gather_status(self, groups, path):
+        calls = [self._get(shard, path, {"data": json.dumps(group)})
+                 for shard, group in groups.iteritems()]
+
+        def status(responses):
+            errors = [r for r in responses if "success" not in r]
+            if errors:
+                return {"error": True, "message": errors}
+            return {"success": True}
+
+        return gatherResults(calls).addCallback(status)
+
+    def __apply__(self, params):
+        # Every shard applies its part atomically, but not the batch as a
+        # whole, and `version` is not checked: shard versions are separate.
+        groups = {}
+        for param in params.get("add", []):
+            key = param["oauth"]["token"]
+            self.params[key] = param
+            if key not in self.assignments:
+                self.assignments[key] = self._least_loaded()
+            groups.setdefault(self.assignments[key],
+                              {"add": [], "remove": []})["add"].append(param)
+        for key in params.get("remove", []):
+            shard = self.assignments.get(key)
+            shards = [shard] if shard is not None \
+                else range(len(self.shard_urls))
+            for shard in shards:
+                groups.setdefault(shard, {"add": [], "remove": []}) \
+                    ["remove"].append(key)
+        added = set(param["oauth"]["token"] for param in params.get("add", []))
+        for key in params.get("remove", []):
+            if key not in added:
+                self.assignments.pop(key, None)
+                self.params.pop(key, None)
+        calls = [self._post(shard, "/apply/", group)
+                 for shard, group in groups.iteritems()]
+
+        def status(responses):
+            errors = [r for r in responses if "success" not in r]
+            if errors:
+                return {"error": True, "message": errors}
+            return {"success": True}
+
+        return gatherResults(calls).addCallback(status)
+
+    def __list_changes__(self):
+        # Always the full list. The version is the sum of the shard
+        # versions, which only grows, so it still tells whether anything
+        # changed.
+        calls = [self._get(shard, "/list/", {"since": 0})
+                 for shard in xrange(len(self.shard_urls))]
+
+        def merge(responses):
+            sc_list = []
+            for response in responses:
+                sc_list.extend(response["streams"])
+            self._sync([response["streams"] for response in responses])
+            return {
+                "version": sum(r["version"] for r in responses),
+                "full": True,
+                "streams": sc_list,
+                "removed": [],
+            }
+
+        return gatherResults(calls).addCallback(merge)
+
+    def __list_scrapers__(self):
+        calls = [self._get(shard, "/list/")
+                 for shard in xrange(len(self.shard_urls))]
+
+        def merge(responses):
+            sc_list = []
+            for response in responses:
+                sc_list.extend(response)
+            self._sync(responses)
+            return sc_list
+
+        return gatherResults(calls).addCallback(merge)
+
+    def _sync(self, shard_streams):
+        # Assignments follow what the shards report: a scraper no shard runs
+        # is no longer counted for placement. A scraper that is being added
+        # and not listed yet is assigned again by the next /list/.
+        self.assignments = {}
+        for shard, streams in enumerate(shard_streams):
+            for s in streams:
+                self.assignments[s["token"]] = shard
+
+    def restore(self, shard, wait=1, tries=60):
+        # Adds the scrapers assigned to a restarted shard back once it
+        # answers /ping/.
+        params = [self.params[key]
+                  for key, assigned in self.assignments.items()
+                  if assigned == shard and key in self.params]
+        if not params:
+            return
+        url = "%s/ping/" % self.shard_urls[shard]
+        left = [tries]
+
+        def ping():
+            return getPage(url).addCallbacks(up, down)
+
+        def down(failure):
+            left[0] -= 1
+            if left[0] <= 0:
+                log.msg("Shard %d did not come back, %d scrapers lost" % (
+                    shard, len(params)), logLevel=logging.ERROR)
+                return
+            reactor.callLater(wait, ping)
+
+        def up(_):
+            for param in params:
+                self.assignments[param["oauth"]["token"]] = shard
+            d = self._post(shard, "/apply/", {"add": params})
+            return d.addCallbacks(restored, restored)
+
+        def restored(status):
+            log.msg("Restored %d scrapers on shard %d: %r" % (
+                len(params), shard, status), logLevel=logging.WARNING)
+
+        reactor.callLater(wait, ping)
+
+    def __metrics__(self):
+        # The metrics of every shard with a `shard` label, and the handler
+        # latency of the front end without one.
+        calls = [getPage("%s/metrics" % url) for url in self.shard_urls]
+
+        def merge(texts):
+            pages = [({"shard": shard}, text)
+                     for shard, text in enumerate(texts)]
+            pages.append(({}, self.metrics.render()))
+            return twmetrics.merge(pages)
+
+        return gatherResults(calls).addCallback(merge)
+
+    def _each_shard(self, path):
+        calls = [self._get(shard, path)
+                 for shard in xrange(len(self.shard_urls))]
+        return gatherResults(calls)
+
+    def _respond(self, response, request):
+        request.write(json.dumps(response))
+        request.finish()
+
+    def _respond_text(self, response, request):
+        request.write(response)
+        request.finish()
+
+    def _fail(self, failure, request):
+        request.write(json.dumps({
+            "error": True,
+            "message": failure.getTraceback(),
+        }))
+        request.finish()
+
+    def render(self, request):
+        self.metrics.time_request(request)
+        return resource.Resource.render(self, request)
+
+    def render_GET(self, request):
+        try:
+            request.setHeader("Content-Type", "application/json")
+            request.setHeader("Access-Control-Allow-Origin", "*")
+
+            if request.path == "/add/":
+                params = json.loads(request.args["data"][0])
+                d = self.__add_scrapers__(params)
+            elif request.path == "/list/":
+                if "since" in request.args:
+                    d = self.__list_changes__()
+                else:
+                    d = self.__list_scrapers__()
+            elif request.path == "/remove/":
+                params = json.loads(request.args["data"][0])
+                d = self.__remove_scrapers__(params)
+            elif request.path in self.SHARD_PATHS:
+                d = self._each_shard(request.path)
+            elif request.path in ("/metrics", "/metrics/"):
+                request.setHeader("Content-Type",
+                                  "text/plain; version=0.0.4")
+                self.__metrics__().addCallbacks(
+                    self._respond_text, self._fail,
+                    callbackArgs=(request,), errbackArgs=(request,))
+                return server.NOT_DONE_YET
+            elif request.path.startswith("/profile/"):
+                if "shard" not in request.args:
+                    return self.profiler.render(request)
+                # Profiles of a shard are taken by the shard itself.
+                shard = int(request.args["shard"][0])
+                args = dict((key, values[0])
+                            for key, values in request.args.iteritems()
+                            if key != "shard")
+                url = "%s%s?%s" % (self.shard_urls[shard], request.path,
+                                   urllib.urlencode(args))
+                getPage(url).addCallbacks(
+                    self._respond_text, self._fail,
+                    callbackArgs=(request,), errbackArgs=(request,))
+                return server.NOT_DONE_YET
+            elif request.path == "/ping/":
+                return "pong"
+            elif request.path == "/log/":
+                if "shard" not in request.args:
+                    return twlog.serve(request, os.path.join(
+                        self.log_dir, "daily-log.log"))
+                # A shard's log is read from its own directory.
+                shard = request.args["shard"][0]
+                if shard not in map(str, xrange(len(self.shard_urls))):
+                    return json.dumps({
+                        "error": True,
+                        "message": "No shard %r" % shard,
+                    })
+                return twlog.serve(request, os.path.join(
+                    self.log_dir, "shard-%s" % shard, "daily-log.log"))
+            else:
+                return json.dumps({
+                    "error": True,
+                    "message": "Wrong API path '%s'" % request.path,
+                })
+
+            d.addCallbacks(self._respond, self._fail,
+                           callbackArgs=(request,), errbackArgs=(request,))
+            return server.NOT_DONE_YET
+
+        except Exception:
+            return json.dumps({
+                "error": True,
+                "message": traceback.format_exc(),
+            })
+
+    def render_POST(self, request):
+        try:
+            request.setHeader("Content-Type", "application/json")
+            request.setHeader("Access-Control-Allow-Origin", "*")
+
+            if request.path == "/apply/":
+                params = json.loads(request.content.read())
+                d = self.__apply__(params)
+            else:
+                return json.dumps({
+                    "error": True,
+                    "message": "Wrong API path '%s'" % request.path,
+                })
+
+            d.addCallbacks(self._respond, self._fail,
+                           callbackArgs=(request,), errbackArgs=(request,))
+            return server.NOT_DONE_YET
+
+        except Exception:
+            return json.dumps({
+                "error": True,
+                "message": traceback.format_exc(),
+            })
+
+
+class ShardProcess(protocol.ProcessProtocol):
+
+    def __init__(self, shards, index, port):
+        self.shards = shards
+        self.index = index
+        self.port = port
+
+    def processEnded(self, reason):
+        log.msg("Shard %d exited: %r" % (self.index, reason),
+                logLevel=logging.WARNING)
+        if not self.shards.stopping:
+            reactor.callLater(5, self.shards.restart, self.index, self.port)
+
+
+class ShardSupervisor(object):
+    # Starts the child scrapy.py processes of a sharded front end, restarts
+    # them when they exit and stops them on shutdown. `restarted(index)` is
+    # called after a shard is started again.
+
+    def __init__(self, restarted=None):
+        self.processes = {}
+        self.stopping = False
+        self.restarted = restarted
+
+    def spawn(self, index, port):
+        script = os.path.abspath(__file__)
+        self.processes[index] = reactor.spawnProcess(
+            ShardProcess(self, index, port),
+            sys.executable,
+            [sys.executable, script, "-p", str(port), "--shard", str(index)],
+            env=os.environ,
+            path=os.getcwd(),
+            childFDs={0: 0, 1: 1, 2: 2},
+        )
+
+    def restart(self, index, port):
+        self.spawn(index, port)
+        if self.restarted is not None:
+            self.restarted(index)
+
+    def stop(self):
+        self.stopping = True
+        for process in self.processes.itervalues():
+            try:
+                process.signalProcess("TERM")
+            except Exception:
+                pass
 
 
 MSG = \
@@ -335,12 +1750,25 @@ if __name__ == "__main__":
                         help="HTTP API port")
     parser.add_argument("-l", "--log", type=int, default=1,
                         help="Log-file")
+    shards = settings["api"].get("shards", 0) if "api" in settings else 0
+    parser.add_argument("-s", "--shards", type=int, default=shards,
+                        help="Scraper processes behind this API")
+    parser.add_argument("--shard", type=int, default=None,
+                        help=argparse.SUPPRESS)
     args = parser.parse_args()
     api_port = args.port
+    log_dir = "%s/log" % os.getcwd()
+    if args.shard is not None:
+        log_dir = "%s/shard-%d" % (log_dir, args.shard)
+        cache_settings = settings.setdefault("cache", {})
+        cache_settings["spill_dir"] = "%s/shard-%d" % (
+            cache_settings.get("spill_dir", "spill"), args.shard)
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
     log_file = "daily-log.log" if args.log else sys.stderr
     log_file = log_file
     if log_file is not sys.stderr:
-        log_file = DailyLogFile(log_file, "%s/log" % os.getcwd())
+        log_file = DailyLogFile(log_file, log_dir)
     MSG = MSG % (
         VERSION,
         datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
@@ -353,20 +1781,48 @@ if __name__ == "__main__":
         settings["database"]["name"],
     )
     sys.stdout.write(MSG)
+
+    if args.shards > 0 and args.shard is None:
+        log.startLogging(log_file)
+        shard_urls = ["http://127.0.0.1:%d" % (api_port + 1 + index)
+                      for index in xrange(args.shards)]
+        sharded_api = ShardedScrapyAPI(shard_urls, log_dir)
+        supervisor = ShardSupervisor(restarted=sharded_api.restore)
+        for index in xrange(args.shards):
+            supervisor.spawn(index, api_port + 1 + index)
+        reactor.addSystemEventTrigger("before", "shutdown", supervisor.stop)
+        site = server.Site(sharded_api)
+        reactor.listenTCP(api_port, site)
+        reactor.run()
+        log_file.close()
+        sys.exit(0)
+
+    twcodec.configure(**settings.get("codec", {}))
     consumer = make_oauth_consumer(settings)
     log.startLogging(log_file)
-    api = ScrapyAPI(consumer)
+    api = ScrapyAPI(consumer, settings, log_dir)
     site = server.Site(api)
     reactor.listenTCP(api_port, site)
 
     lc1  = LoopingCall(lambda: collect_received(api))
-    lc1.start(settings["database"]["commit_delay"])
+    lc1.start(settings.get("flush", {}).get("check_interval", 1))
+
+    lc2 = LoopingCall(lambda: check_scrapers(api))
+    lc2.start(settings.get("reconnect", {}).get("check_interval", 30),
+              now=False)
+
+    lc4 = LoopingCall(lambda: purge_storage(api))
+    lc4.start(settings["database"].get("purge_interval", 3600), now=False)
+
+    lc5 = LoopingCall(lambda: api.cache.sync())
+    lc5.start(settings.get("cache", {}).get("sync_interval", 1))
 
-    lc2 = LoopingCall(lambda: restart_scrapers(api))
-    lc2.start(1800)
+    if api.parser is not None:
+        lc6 = LoopingCall(lambda: api.parser.flush())
+        lc6.start(settings["ingest"].get("flush_interval", 0.1))
 
-    lc3 = LoopingCall(lambda: restart_failed_scrapers(api))
-    lc3.start(30)
+    lc7 = LoopingCall(lambda: sample_rates(api))
+    lc7.start(settings.get("metrics", {}).get("sample_interval", 5))
     
     reactor.run()
 
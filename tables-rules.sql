@@ -0,0 +1,26 @@
+-- Author: Nibir Bora <nbora@usc.edu>
+-- URL: <http://cbg.isi.edu/>
+-- For license information, see LICENSE
+
+-- Per-row de-duplication rules for "dedup": "rule". Run after tables.sql
+-- only when using that mode: with the rules in place the "merge" mode
+-- fails, since ON CONFLICT is not allowed on tables with INSERT rules.
+-- migrations/002-merge-dedup.sql drops them again.
+
+CREATE RULE "tmp_tweet_ignore_dublicates" AS 
+    ON INSERT TO "nba_tmp_tweet" 
+    WHERE (EXISTS 
+        (SELECT nba_tmp_tweet.id 
+        FROM nba_tmp_tweet 
+        WHERE (nba_tmp_tweet.id = new.id))) 
+    DO INSTEAD NOTHING;
+
+CREATE RULE "nba_tmp_tweet_json_ignore_duplicates" AS 
+    ON INSERT TO "nba_tmp_tweet_json" 
+    WHERE (EXISTS 
+        (SELECT nba_tmp_tweet_json.id 
+        FROM nba_tmp_tweet_json 
+        WHERE (nba_tmp_tweet_json.id = new.id))) 
+    DO INSTEAD NOTHING;
+
+COMMIT;
\ No newline at end of file
@@ -21,22 +21,16 @@ CREATE TABLE "nba_tmp_tweet" (
     "timestamp" timestamp(6) WITH TIME ZONE NOT NULL,
     "text" varchar(140) NOT NULL,
     "geo" "geometry",
-    "status" int4 NOT NULL DEFAULT 0
+    "batch" int8
 )
 WITH (OIDS=FALSE);
 
 ALTER TABLE "nba_tmp_tweet" ADD CONSTRAINT "nba_tmp_tweets_pkey" PRIMARY KEY ("id");
 
-CREATE INDEX "nba_tmp_tweet_status_idx" ON "nba_tmp_tweet" USING btree(status ASC NULLS LAST);
-CREATE INDEX "nba_tmp_tweet_timestamp_idx" ON "nba_tmp_tweet" USING btree("timestamp" DESC NULLS FIRST);
+CREATE SEQUENCE "nba_tmp_tweet_batch_seq";
 
-CREATE RULE "tmp_tweet_ignore_dublicates" AS 
-    ON INSERT TO "nba_tmp_tweet" 
-    WHERE (EXISTS 
-        (SELECT nba_tmp_tweet.id 
-        FROM nba_tmp_tweet 
-        WHERE (nba_tmp_tweet.id = new.id))) 
-    DO INSTEAD NOTHING;
+CREATE INDEX "nba_tmp_tweet_batch_idx" ON "nba_tmp_tweet" USING btree(batch);
+CREATE INDEX "nba_tmp_tweet_timestamp_idx" ON "nba_tmp_tweet" USING btree("timestamp" DESC NULLS FIRST);
 
 
 -- Limits table
@@ -44,12 +38,16 @@ CREATE TABLE "nba_tmp_limit" (
     "id" serial NOT NULL,
     "filter_id" int4,
     "timestamp" timestamp(6) WITH TIME ZONE NOT NULL,
-    "value" int4 NOT NULL
+    "value" int4 NOT NULL,
+    "segment" varchar(255),
+    "position" int4
 )
 WITH (OIDS=FALSE);
 
 ALTER TABLE "nba_tmp_limit" ADD CONSTRAINT "nba_tmp_limit_pkey" PRIMARY KEY ("id");
 
+CREATE UNIQUE INDEX "nba_tmp_limit_segment_idx" ON "nba_tmp_limit" USING btree(segment, filter_id, position);
+
 
 -- Tweet JSON table
 CREATE TABLE "nba_tmp_tweet_json" (
@@ -61,12 +59,4 @@ WITH (OIDS=FALSE);
 
 ALTER TABLE "nba_tmp_tweet_json" ADD CONSTRAINT "nba_tmp_tweet_json_pkey" PRIMARY KEY ("id");
 
-CREATE RULE "nba_tmp_tweet_json_ignore_duplicates" AS 
-    ON INSERT TO "nba_tmp_tweet_json" 
-    WHERE (EXISTS 
-        (SELECT nba_tmp_tweet_json.id 
-        FROM nba_tmp_tweet_json 
-        WHERE (nba_tmp_tweet_json.id = new.id))) 
-    DO INSTEAD NOTHING;
-
 COMMIT;
\ No newline at end of file
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+# Gambit collector
+#
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://cbg.isi.edu/>
+# For license information, see LICENSE
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import twbuffer
+
+
+class IngestBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spill_dir)
+
+    def test_append_reaches_file_before_sync(self):
+        cache = twbuffer.IngestBuffer(spill_dir=self.spill_dir)
+        frame = twbuffer.pack(twbuffer.TWEET, 1, 42, '{"id":42}')
+        path = cache.append(frame)
+        self.assertEqual(os.path.getsize(path), len(frame))
+        self.assertTrue(cache.unsynced)
+        cache.sync()
+        self.assertFalse(cache.unsynced)
+
+    def test_frames_replayed_after_process_crash(self):
+        cache = twbuffer.IngestBuffer(spill_dir=self.spill_dir)
+        frames = [twbuffer.pack(twbuffer.TWEET, 1, i, '{"id":%d}' % i)
+                  for i in xrange(3)]
+        for frame in frames:
+            cache.append(frame)
+        # Neither synced nor closed, as after a kill.
+        replayed = twbuffer.IngestBuffer(spill_dir=self.spill_dir)
+        self.assertEqual(len(replayed), 3)
+        self.assertEqual(replayed.pop_batch()[1], frames)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+# Gambit collector
+#
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://cbg.isi.edu/>
+# For license information, see LICENSE
+
+
+import json
+import time
+import unittest
+
+import twcodec
+
+
+def slow_loads(line):
+    time.sleep(0.0001)
+    return json.loads(line)
+
+
+class FastestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backends = twcodec.BACKENDS
+
+    def tearDown(self):
+        twcodec.BACKENDS = self.backends
+
+    def test_loose_backend_dropped(self):
+        # Fast, but keeps the backslash of "\/" as cjson does.
+        loose = lambda line: json.loads(line.replace("\\/", "\\\\/"))
+        twcodec.BACKENDS = [("json", slow_loads, json.dumps),
+                            ("loose", loose, json.dumps)]
+        self.assertEqual(twcodec.fastest()[0], "json")
+
+    def test_rounding_backend_dropped(self):
+        rounding = lambda line: json.loads(line, parse_float=lambda f:
+                                           round(float(f), 4))
+        twcodec.BACKENDS = [("json", slow_loads, json.dumps),
+                            ("rounding", rounding, json.dumps)]
+        self.assertEqual(twcodec.fastest()[0], "json")
+
+    def test_installed_backends_agree_or_are_skipped(self):
+        name, decode, _ = twcodec.fastest()
+        self.assertEqual(decode(twcodec.SAMPLE), json.loads(twcodec.SAMPLE))
+
+
+class LazyLoadsTest(unittest.TestCase):
+
+    def setUp(self):
+        twcodec.configure("json")
+
+    def check(self, line):
+        full = json.loads(line)
+        lazy = twcodec.lazy_loads(line)
+        self.assertEqual(lazy["id"], full["id"])
+        self.assertEqual(lazy["user"]["id"], full["user"]["id"])
+        self.assertEqual(lazy["created_at"], full["created_at"])
+        self.assertEqual(lazy["text"], full["text"])
+        self.assertEqual(lazy["geo"], full["geo"])
+        return lazy
+
+    def test_stream_order(self):
+        lazy = self.check(twcodec.SAMPLE)
+        self.assertEqual(set(lazy), set(["id", "user", "created_at", "text",
+                                         "geo"]))
+
+    def test_retweet_before_user(self):
+        line = ('{"created_at":"Thu Jun 27 23:30:12 +0000 2013","id":3,'
+                '"text":"RT @b: hi","retweeted_status":{"created_at":'
+                '"Thu Jun 27 23:00:00 +0000 2013","id":2,"text":"hi",'
+                '"user":{"id":11},"geo":null},"user":{"id":7},'
+                '"geo":{"type":"Point","coordinates":[1.5,2.5]}}')
+        lazy = self.check(line)
+        self.assertEqual(lazy["user"]["id"], 7)
+
+    def test_geo_after_nested_object(self):
+        line = ('{"created_at":"Thu Jun 27 23:30:12 +0000 2013","id":3,'
+                '"text":"RT @b: hi","user":{"id":7},"retweeted_status":'
+                '{"id":2,"geo":{"type":"Point","coordinates":[1.5,2.5]}},'
+                '"geo":null}')
+        self.assertEqual(self.check(line)["geo"], None)
+
+    def test_nested_object_in_user(self):
+        line = ('{"created_at":"Thu Jun 27 23:30:12 +0000 2013","id":3,'
+                '"text":"hi","user":{"entities":{"url":{"id":5}},"id":7},'
+                '"geo":null}')
+        self.assertEqual(self.check(line)["user"]["id"], 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
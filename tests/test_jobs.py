@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# Gambit collector
+#
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://cbg.isi.edu/>
+# For license information, see LICENSE
+
+
+import unittest
+
+try:
+    import nba_streamer
+    from twisted.internet.task import Clock
+    from twisted.internet.defer import Deferred, TimeoutError
+except ImportError:
+    nba_streamer = None
+
+
+@unittest.skipIf(nba_streamer is None, "nba_streamer dependencies not installed")
+class JobTimeoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = nba_streamer.reactor
+        self.clock = nba_streamer.reactor = Clock()
+        self.runs = []
+        self.job = nba_streamer.Job("test", self.work, 60, timeout=5)
+
+    def tearDown(self):
+        nba_streamer.reactor = self.reactor
+
+    def work(self):
+        d = Deferred()
+        self.runs.append(d)
+        return d
+
+    def outcome(self, d):
+        result = []
+        d.addBoth(result.append)
+        return result
+
+    def test_timeout_then_retrigger(self):
+        first = self.outcome(self.job.run())
+        self.clock.advance(5)
+        self.assertEqual(len(first), 1)
+        self.assertTrue(first[0].check(TimeoutError))
+        self.assertEqual(self.job.status()["timeouts"], 1)
+
+        # The timed out run has not ended: a new trigger waits for it.
+        second = self.outcome(self.job.run())
+        self.assertTrue(self.job.running)
+        self.assertEqual(len(self.runs), 1)
+        self.assertEqual(self.job.status()["queued"], 1)
+
+        self.runs[0].callback("late")
+        self.assertEqual(len(self.runs), 2)
+        self.assertEqual(second, [])
+        self.runs[1].callback("done")
+        self.assertEqual(second, ["done"])
+        self.assertFalse(self.job.running)
+        self.assertEqual(self.job.status()["failures"], 1)
+        self.assertEqual(self.job.status()["runs"], 2)
+
+    def test_run_within_timeout(self):
+        result = self.outcome(self.job.run())
+        self.runs[0].callback("done")
+        self.clock.advance(5)
+        self.assertEqual(result, ["done"])
+        self.assertEqual(self.job.status()["timeouts"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
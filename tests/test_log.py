@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+# Gambit collector
+#
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://cbg.isi.edu/>
+# For license information, see LICENSE
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import anyjson as json
+    import twlog
+    from twisted.web import server
+    from twisted.web.test.requesthelper import DummyRequest
+except ImportError:
+    twlog = None
+
+
+def open_files():
+    return len(os.listdir("/proc/self/fd"))
+
+
+@unittest.skipIf(twlog is None, "twisted is not installed")
+@unittest.skipIf(not os.path.isdir("/proc/self/fd"), "needs /proc")
+class ServeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.log_dir, "daily-log.log")
+        with open(self.path, "wb") as fp:
+            fp.write("one\ntwo\nthree\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def serve(self, **args):
+        request = DummyRequest(["log"])
+        request.args = dict((key, [value]) for key, value in args.items())
+        return twlog.serve(request, self.path)
+
+    def test_bad_parameters(self):
+        before = open_files()
+        for args in ({"tail": "x"}, {"offset": "1.5"}, {"tail": ""}):
+            response = json.loads(self.serve(**args))
+            self.assertTrue(response["error"])
+            self.assertIn("integers", response["message"])
+        self.assertEqual(open_files(), before)
+
+    def test_missing_file(self):
+        os.remove(self.path)
+        response = json.loads(self.serve(tail="2"))
+        self.assertIn("No log file", response["message"])
+
+
+if __name__ == "__main__":
+    unittest.main()
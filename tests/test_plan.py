@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+# Gambit collector
+#
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://cbg.isi.edu/>
+# For license information, see LICENSE
+
+
+import unittest
+
+try:
+    import benchmark
+    import twplan
+except ImportError:
+    benchmark = None
+
+
+# (users, limit, cycles, growth, packed, spare) of the benchmark runs quoted
+# in the README.
+SCENARIOS = [
+    (5000, 400, 100, 20, False, 1),
+    (5000, 400, 100, 20, False, 2),
+    (5000, 400, 100, 5, False, 1),
+    (20000, 400, 100, 50, False, 1),
+    (5000, 400, 100, 100, False, 1),
+    (5000, 400, 100, 20, True, 1),
+]
+
+
+@unittest.skipIf(benchmark is None, "benchmark dependencies not installed")
+class PlanFollowTest(unittest.TestCase):
+
+    def test_no_more_restarts_than_naive(self):
+        for users, limit, cycles, growth, packed, spare in SCENARIOS:
+            initial, arrivals = benchmark.planner_scenario(
+                users, limit, cycles, growth, packed)
+            naive = benchmark.replay_plans(
+                benchmark.naive_follow_plan, initial, arrivals, limit)
+            planned = benchmark.replay_plans(
+                lambda streams, user_ids, limit, free_fids:
+                    twplan.plan_follow(streams, user_ids, limit, free_fids,
+                                       spare=spare),
+                initial, arrivals, limit)
+            self.assertLessEqual(planned["restarts"], naive["restarts"],
+                                 (users, growth, packed, spare))
+            self.assertLessEqual(planned["streams"], naive["streams"] + spare,
+                                 (users, growth, packed, spare))
+
+    def test_new_users_fill_spare_stream(self):
+        streams = {1: range(400), 2: range(400, 500)}
+        plan = twplan.plan_follow(streams, range(520), 400, [3, 4], spare=1)
+        self.assertEqual(plan["restart"], [])
+        self.assertEqual(plan["launch"], [{"id": 3, "follow": range(500, 520)}])
+
+    def test_smallest_open_stream_takes_new_users(self):
+        streams = {1: range(400), 2: range(400, 790), 3: range(790, 800)}
+        plan = twplan.plan_follow(streams, range(820), 400, [4, 5], spare=0)
+        self.assertEqual(plan["restart"], [3])
+        self.assertEqual(plan["launch"],
+                         [{"id": 4, "follow": range(800, 820) + range(790, 800)}])
+
+    def test_over_limit_streams_restarted(self):
+        streams = {1: range(500)}
+        plan = twplan.plan_follow(streams, range(500), 400, [2, 3])
+        self.assertEqual(plan["restart"], [1])
+        self.assertEqual(len(plan["launch"]), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
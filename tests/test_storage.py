@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+# Gambit collector
+#
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://cbg.isi.edu/>
+# For license information, see LICENSE
+
+
+# Needs a scratch database loaded with tables.sql, and tables-rules.sql for
+# "dedup": "rule": GAMBIT_TEST_SETTINGS names a scrapy-settings.json for it.
+# Rows written here are left in place.
+
+
+import os
+import time
+import random
+import datetime
+import unittest
+import multiprocessing
+
+SETTINGS = os.environ.get("GAMBIT_TEST_SETTINGS")
+# Ids of their own on every run, whoever seeded the random module.
+RANDOM = random.SystemRandom()
+
+try:
+    import anyjson as json
+    import twbuffer
+    import twstorage
+    import sqlalchemy
+except ImportError:
+    twstorage = None
+
+
+def read_settings():
+    with open(SETTINGS) as fp:
+        return json.loads(fp.read())
+
+
+def make_part(tweet_ids, filter_id=1):
+    ts = datetime.datetime.utcnow().strftime("%a %b %d %H:%M:%S +0000 %Y")
+    frames = []
+    for tweet_id in tweet_ids:
+        line = json.dumps({
+            "created_at": ts,
+            "id": tweet_id,
+            "text": "tweet %d" % tweet_id,
+            "user": {"id": 7},
+            "geo": None,
+        })
+        frames.append(twbuffer.pack(twbuffer.TWEET, filter_id, tweet_id,
+                                    line))
+    frames.append(twbuffer.pack(twbuffer.LIMIT, filter_id, 3))
+    return "".join(frames)
+
+
+def hold_commit(data, written, release, result):
+    # save(), with the commit held back until `release` is set.
+    twstorage.init(read_settings())
+    try:
+        batch = twstorage.next_batch()
+        limits, tweets, tjsons, _ = twstorage.read_cache(data, batch)
+        limits, _ = twstorage.new_limits(limits, None)
+        twstorage.WRITERS[twstorage.STORAGE.writer](limits, tweets, tjsons)
+        twstorage.move_batch(batch)
+        written.set()
+        release.wait(30)
+        twstorage.STORAGE.session.commit()
+        result.put(True)
+    except Exception:
+        written.set()
+        result.put(False)
+
+
+def save(data, result):
+    twstorage.init(read_settings())
+    result.put(twstorage.save(data))
+
+
+@unittest.skipIf(twstorage is None or not SETTINGS,
+                 "GAMBIT_TEST_SETTINGS is not set")
+class ConcurrentSaveTest(unittest.TestCase):
+
+    def wait_for_lock(self, engine, timeout=30):
+        # True once some session waits for a lock: the second insert
+        # blocked on the first one's uncommitted rows.
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            waiting = engine.execute(
+                "SELECT count(*) FROM pg_stat_activity "
+                "WHERE wait_event_type = 'Lock'").scalar()
+            if waiting:
+                return True
+            time.sleep(0.05)
+        return False
+
+    def test_same_tweets_from_two_shards(self):
+        # The second committer inserts rows the first one has written but
+        # not committed yet; both must commit, each tweet stored once.
+        base = RANDOM.randint(10 ** 15, 10 ** 16)
+        first = make_part([base, base + 1, base + 2])
+        second = make_part([base + 1, base + 2, base + 3], filter_id=2)
+        written = multiprocessing.Event()
+        release = multiprocessing.Event()
+        held = multiprocessing.Queue()
+        saved = multiprocessing.Queue()
+        holder = multiprocessing.Process(
+            target=hold_commit, args=(first, written, release, held))
+        holder.start()
+        self.assertTrue(written.wait(30))
+        saver = multiprocessing.Process(target=save, args=(second, saved))
+        saver.start()
+        settings = read_settings()
+        twstorage.init(settings)
+        self.assertTrue(self.wait_for_lock(twstorage.STORAGE.engine))
+        release.set()
+        self.assertTrue(held.get(timeout=30))
+        report = saved.get(timeout=30)
+        holder.join()
+        saver.join()
+        self.assertIsNotNone(report)
+
+        database = settings["database"]
+        ids = {"ids": tuple(range(base, base + 4))}
+        for table in (database["tweet_table"], database["jsons_table"],
+                      database.get("final_table", "nba_tweet")):
+            count = twstorage.STORAGE.session.execute(
+                "SELECT count(*) FROM %s WHERE id IN :ids" % table,
+                ids).scalar()
+            self.assertEqual(count, 4, table)
+
+
+@unittest.skipIf(twstorage is None or not SETTINGS,
+                 "GAMBIT_TEST_SETTINGS is not set")
+class StoredTwiceTest(unittest.TestCase):
+
+    def test_limits_of_a_part_stored_twice(self):
+        # A late commit of a timed out attempt, or a replay after a crash,
+        # stores the same part of the same segment again.
+        settings = read_settings()
+        twstorage.init(settings)
+        base = RANDOM.randint(10 ** 15, 10 ** 16)
+        data = make_part([base]) + twbuffer.pack(twbuffer.LIMIT, 1, 5) + \
+               twbuffer.pack(twbuffer.LIMIT, 2, 8)
+        segment = "test:%d.seg" % base
+        first = twstorage.save(data, segment)
+        second = twstorage.save(data, segment)
+        self.assertEqual((first["limits"], first["limits_duplicates"]),
+                         (3, 0))
+        self.assertEqual((second["limits"], second["limits_duplicates"]),
+                         (0, 3))
+        rows = twstorage.STORAGE.session.execute(
+            "SELECT filter_id, position, value FROM %s WHERE segment = :s "
+            "ORDER BY filter_id, position" %
+            settings["database"]["limit_table"], {"s": segment}).fetchall()
+        self.assertEqual([tuple(row) for row in rows],
+                         [(1, 0, 3), (1, 1, 5), (2, 0, 8)])
+
+    def test_counts_of_a_batch_stored_twice(self):
+        # Every dedup mode reports what it inserted and what it skipped.
+        twstorage.init(read_settings())
+        base = RANDOM.randint(10 ** 15, 10 ** 16)
+        first = twstorage.save(make_part([base, base + 1]))
+        second = twstorage.save(make_part([base + 1, base + 2]))
+        for report, inserted in ((first, 2), (second, 1)):
+            for key in ("tweets", "jsons"):
+                self.assertEqual(report["%s_inserted" % key], inserted)
+                self.assertEqual(report["%s_duplicates" % key], 2 - inserted)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+# Gambit collector
+#
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://cbg.isi.edu/>
+# For license information, see LICENSE
+
+
+import os
+import time
+import struct
+
+from collections import deque
+
+
+SEGMENT_SUFFIX = ".seg"
+# Next to a segment: how many times it was sent to storage.
+TRIES_SUFFIX = ".tries"
+# Subdirectory of spill_dir for what storage gave up on; never replayed.
+DEAD_DIR = "dead"
+
+# Frame kinds. A TWEET frame carries the raw stream line and the tweet id,
+# a MATCH frame records that another filter delivered the same tweet id,
+# a LIMIT frame carries the number of tweets Twitter held back.
+TWEET = 1
+LIMIT = 2
+MATCH = 3
+
+# kind, filter id, tweet id or limit value, payload length
+HEADER = struct.Struct("!BiqI")
+
+
+def pack(kind, filter_id, value, payload=""):
+    if isinstance(payload, unicode):
+        payload = payload.encode("utf-8")
+    return HEADER.pack(kind, int(filter_id), value, len(payload)) + payload
+
+
+def frames(data):
+    # Yields (kind, filter_id, value, payload) and stops at a torn frame,
+    # which is what a crash leaves at the end of the active segment.
+    offset = 0
+    end = len(data)
+    while offset + HEADER.size <= end:
+        kind, filter_id, value, length = HEADER.unpack_from(data, offset)
+        start = offset + HEADER.size
+        if start + length > end:
+            break
+        yield kind, filter_id, value, data[start:start + length]
+        offset = start + length
+
+
+def split_frames(data):
+    result = []
+    offset = 0
+    end = len(data)
+    while offset + HEADER.size <= end:
+        length = HEADER.unpack_from(data, offset)[3]
+        stop = offset + HEADER.size + length
+        if stop > end:
+            break
+        result.append(data[offset:stop])
+        offset = stop
+    return result
+
+
+def read_segment(path):
+    with open(path, "rb") as fp:
+        return split_frames(fp.read())
+
+
+def read_tries(path):
+    try:
+        with open(path + TRIES_SUFFIX, "rb") as fp:
+            return int(fp.read().strip() or 0)
+    except (IOError, ValueError):
+        return 0
+
+
+class IngestBuffer(object):
+    # Append-only write-ahead spool of collected frames. Every frame is written
+    # to the active segment file in `spill_dir` and kept in memory until the
+    # memory copy exceeds `memory_budget` bytes; the segment is then sealed
+    # and read back from disk when its turn comes. A segment file is removed
+    # only after storage acknowledges its batch, so whatever is found in
+    # `spill_dir` at start has not been committed and is replayed. Frames
+    # storage gives up on are kept in `spill_dir`/dead for a manual look, and
+    # so is a segment that was already sent `max_replays` times without being
+    # acknowledged: it likely took the process down with it.
+    #
+    # Every frame is flushed to the OS as it is appended, so a crash of the
+    # process loses nothing. sync() fsyncs the active segment and is called
+    # every `cache.sync_interval` seconds, and when a segment is sealed: a
+    # crash of the machine loses at most the frames of that last interval.
+    #
+    # Segments are numbered from the clock, so a name is not used again after
+    # the spill_dir was emptied: storage keys limit notices by it.
+
+    def __init__(self, spill_dir="spill", memory_budget=64 * 1024 * 1024,
+                 max_replays=3):
+        self.spill_dir = spill_dir
+        self.memory_budget = memory_budget
+        self.max_replays = max_replays
+        self.memory = deque([])
+        self.memory_bytes = 0
+        self.memory_since = None
+        self.active_path = None
+        self.active_fp = None
+        self.unsynced = False
+        self.segments = deque([])
+        self.in_flight = {}
+        self.spilled_items = 0
+        self.spilled_bytes = 0
+        self.next_segment = int(time.time() * 1000)
+        self.dead_dir = os.path.join(spill_dir, DEAD_DIR)
+        self.dead_letters = 0
+        if not os.path.exists(self.dead_dir):
+            os.makedirs(self.dead_dir)
+        self.quarantined = []
+        names = sorted(os.listdir(spill_dir))
+        for name in names:
+            if name.endswith(TRIES_SUFFIX) \
+            and name[:-len(TRIES_SUFFIX)] not in names:
+                os.remove(os.path.join(spill_dir, name))
+        for name in names:
+            if name.endswith(SEGMENT_SUFFIX):
+                path = os.path.join(spill_dir, name)
+                self.next_segment = max(self.next_segment,
+                                        int(name[:-len(SEGMENT_SUFFIX)]) + 1)
+                if read_tries(path) >= max_replays:
+                    self._quarantine(path)
+                else:
+                    self._add_segment(path, len(read_segment(path)))
+
+    def __len__(self):
+        return len(self.memory) + self.spilled_items
+
+    def append(self, frame):
+        # Returns the path of the segment the frame was written to, which
+        # stays its key after the segment is spilled.
+        if self.active_fp is None:
+            self.active_path = os.path.join(
+                self.spill_dir,
+                "%012d%s" % (self.next_segment, SEGMENT_SUFFIX),
+            )
+            self.active_fp = open(self.active_path, "ab")
+            self.next_segment += 1
+        self.active_fp.write(frame)
+        self.active_fp.flush()
+        self.unsynced = True
+        path = self.active_path
+        if not self.memory:
+            self.memory_since = time.time()
+        self.memory.append(frame)
+        self.memory_bytes += len(frame)
+        if self.memory_bytes > self.memory_budget:
+            self.spill()
+        return path
+
+    def sync(self):
+        if self.active_fp is not None and self.unsynced:
+            os.fsync(self.active_fp.fileno())
+            self.unsynced = False
+
+    def _seal(self):
+        self.sync()
+        self.active_fp.close()
+        path = self.active_path
+        self.active_fp = None
+        self.active_path = None
+        return path
+
+    def _add_segment(self, path, items):
+        size = os.path.getsize(path)
+        self.segments.append((path, items, size))
+        self.spilled_items += items
+        self.spilled_bytes += size
+
+    def spill(self):
+        if self.active_fp is None:
+            return
+        self._add_segment(self._seal(), len(self.memory))
+        self.memory.clear()
+        self.memory_bytes = 0
+
+    def _quarantine(self, path):
+        dead_path = os.path.join(self.dead_dir, os.path.basename(path))
+        os.rename(path, dead_path)
+        os.remove(path + TRIES_SUFFIX)
+        self.quarantined.append(dead_path)
+        self.dead_letters += 1
+
+    def _tried(self, path):
+        tries = read_tries(path) + 1
+        with open(path + TRIES_SUFFIX, "wb") as fp:
+            fp.write("%d" % tries)
+
+    def pop_batch(self):
+        # Returns (segment path, frames): the oldest sealed segment first,
+        # then the in-memory frames. The segment stays on disk until ack().
+        if self.segments:
+            segment = self.segments.popleft()
+            path, items, size = segment
+            self.spilled_items -= items
+            self.spilled_bytes -= size
+            self.in_flight[path] = segment
+            self._tried(path)
+            return path, read_segment(path)
+        if self.active_fp is None:
+            return None, []
+        path = self._seal()
+        batch = list(self.memory)
+        self.in_flight[path] = (path, len(batch), os.path.getsize(path))
+        self.memory.clear()
+        self.memory_bytes = 0
+        self._tried(path)
+        return path, batch
+
+    def dead_letter(self, path, worker, data):
+        # Keeps the frames of one storage part of the segment at `path`.
+        name = os.path.basename(path)[:-len(SEGMENT_SUFFIX)]
+        dead_path = os.path.join(self.dead_dir, "%s-%d%s" % (
+            name, worker, SEGMENT_SUFFIX))
+        with open(dead_path, "wb") as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.dead_letters += 1
+        return dead_path
+
+    def ack(self, path):
+        del self.in_flight[path]
+        if os.path.exists(path + TRIES_SUFFIX):
+            os.remove(path + TRIES_SUFFIX)
+        os.remove(path)
+
+    def stats(self):
+        return {
+            "depth": len(self),
+            "memory_items": len(self.memory),
+            "memory_bytes": self.memory_bytes,
+            "memory_budget": self.memory_budget,
+            "spilled_segments": len(self.segments),
+            "spilled_items": self.spilled_items,
+            "spilled_bytes": self.spilled_bytes,
+            "in_flight": len(self.in_flight),
+            "dead_letters": self.dead_letters,
+        }
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+# Gambit collector
+#
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://cbg.isi.edu/>
+# For license information, see LICENSE
+
+
+import time
+import json as stdlib_json
+
+from json.decoder import WHITESPACE, scanstring
+
+
+global BACKEND
+global LAZY
+global loads
+global dumps
+
+
+SAMPLE = \
+"""{"created_at":"Thu Jun 27 23:30:12 +0000 2013","id":350400000000000001,\
+"id_str":"350400000000000001","text":"With the 1st pick in the 2013 #NBADraft \
+the Cleveland Cavaliers select Anthony Bennett","source":"<a href=\\"http:\\/\\/\
+twitter.com\\" rel=\\"nofollow\\">Twitter for iPhone<\\/a>","truncated":false,\
+"in_reply_to_status_id":null,"in_reply_to_user_id":null,"user":{"id":19923144,\
+"id_str":"19923144","name":"NBA","screen_name":"NBA","location":"",\
+"description":"News and notes from the NBA","followers_count":6000000,\
+"friends_count":1000,"listed_count":50000,"created_at":"Mon Feb 02 17:08:54 \
++0000 2009","favourites_count":10,"utc_offset":-14400,"geo_enabled":true,\
+"verified":true,"statuses_count":40000,"lang":"en"},"geo":{"type":"Point",\
+"coordinates":[40.75051234567891,-73.99341234567891]},"coordinates":{"type":\
+"Point","coordinates":[-73.99341234567891,40.75051234567891]},"place":null,"contributors":null,"retweet_count":0,\
+"favorite_count":0,"entities":{"hashtags":[{"text":"NBADraft","indices":[30,39]}],\
+"urls":[],"user_mentions":[]},"favorited":false,"retweeted":false,\
+"filter_level":"medium","lang":"en"}"""
+
+
+def _backends():
+    backends = [("json", stdlib_json.loads, stdlib_json.dumps)]
+    try:
+        import simplejson
+        backends.append(("simplejson", simplejson.loads, simplejson.dumps))
+    except ImportError:
+        pass
+    try:
+        import cjson
+        backends.append(("cjson", cjson.decode, cjson.encode))
+    except ImportError:
+        pass
+    try:
+        import ujson
+        backends.append(("ujson", ujson.loads, ujson.dumps))
+    except ImportError:
+        pass
+    return backends
+
+
+BACKENDS = _backends()
+
+
+def measure(decode, lines, repeat=3):
+    best = None
+    for _ in xrange(repeat):
+        t0 = time.time()
+        for line in lines:
+            decode(line)
+        elapsed = time.time() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def agrees(decode, lines):
+    # Whether `decode` gives what the stdlib json does on every line. Some
+    # backends are fast because they are loose: cjson keeps the backslash of
+    # an escaped "\/", older ujson rounds floats.
+    try:
+        for line in lines:
+            if decode(line) != stdlib_json.loads(line):
+                return False
+    except Exception:
+        return False
+    return True
+
+
+def fastest(lines=None):
+    lines = lines or [SAMPLE] * 200
+    sample = list(set(lines + [SAMPLE]))
+    timings = []
+    for name, decode, encode in BACKENDS:
+        if not agrees(decode, sample):
+            continue
+        timings.append((measure(decode, lines), name, decode, encode))
+    return min(timings)[1:]
+
+
+# Lazy mode relies on the key order of Twitter's stream: "created_at",
+# "id" and "text" come before the "user" object, whose first "id" is the
+# user id, and "geo" follows it. Keys quoted inside strings are escaped and
+# skipped. A key is only taken when no object opens before it, so that it
+# is not one of a nested object such as "retweeted_status": no "{" may come
+# before "user" or between it and the user id, and between the user id and
+# "geo" only the "}" closing the user. Anything that does not fit is decoded
+# in full.
+LAZY_DECODER = stdlib_json.JSONDecoder()
+
+
+def _find(line, key, start=0):
+    pos = line.find(key, start)
+    while pos > 0 and line[pos - 1] == "\\":
+        pos = line.find(key, pos + 1)
+    if pos < 0:
+        return pos
+    return WHITESPACE.match(line, pos + len(key)).end()
+
+
+def _string(line, pos):
+    return scanstring(line, pos + 1)[0]
+
+
+def _number(line, pos):
+    end = pos
+    while line[end] in "-0123456789":
+        end += 1
+    return int(line[pos:end])
+
+
+def lazy_loads(line):
+    user = _find(line, '"user":')
+    tweet_id = _find(line, '"id":')
+    created_at = _find(line, '"created_at":')
+    text = _find(line, '"text":')
+    if user < 0 or not 0 <= tweet_id < user or \
+       not 0 <= created_at < user or not 0 <= text < user or \
+       line.find("{", 1, user) >= 0:
+        return loads(line)
+    user_id = _find(line, '"id":', user)
+    if user_id < 0 or line.find("{", user + 1, user_id) >= 0:
+        return loads(line)
+    geo = _find(line, '"geo":', user_id)
+    if geo < 0 or line.find("{", user_id, geo) >= 0 or \
+       line.count("}", user_id, geo) != 1:
+        return loads(line)
+    try:
+        return {
+            "id": _number(line, tweet_id),
+            "created_at": _string(line, created_at),
+            "text": _string(line, text),
+            "user": {"id": _number(line, user_id)},
+            "geo": None if line.startswith("null", geo) else
+                   LAZY_DECODER.raw_decode(line, geo)[0],
+        }
+    except (ValueError, IndexError):
+        return loads(line)
+
+
+TWEET = "tweet"
+LIMIT = "limit"
+ERROR = "error"
+
+
+def parse_line(line):
+    # What ScraperState needs from a stream line: the tweet id, or the
+    # number of tweets a limit notice says were held back.
+    jsn = loads_tweet(line)
+    if "text" in jsn:
+        return TWEET, jsn["id"]
+    if "limit" in jsn:
+        return LIMIT, sum(jsn["limit"].values())
+    return None, None
+
+
+def parse_lines(lines):
+    # Never raises, so a pool worker always answers with one result per
+    # line: a line that cannot be parsed gives (ERROR, message).
+    results = []
+    try:
+        for line in lines:
+            try:
+                results.append(parse_line(line))
+            except Exception, e:
+                results.append((ERROR, "%s: %s" % (type(e).__name__, e)))
+    except Exception, e:
+        error = (ERROR, "%s: %s" % (type(e).__name__, e))
+        results.extend([error] * (len(lines) - len(results)))
+    return results
+
+
+def configure(backend="auto", lazy=False):
+    global BACKEND
+    global LAZY
+    global loads
+    global dumps
+    if backend == "auto":
+        BACKEND, loads, dumps = fastest()
+    else:
+        for name, decode, encode in BACKENDS:
+            if name == backend:
+                BACKEND, loads, dumps = name, decode, encode
+                break
+        else:
+            raise ValueError("JSON backend %r is not available" % backend)
+    LAZY = lazy
+
+
+def loads_tweet(line):
+    # Hot path decoder for stream lines: only the fields twstorage and
+    # ScraperState use when lazy mode is on.
+    if LAZY:
+        return lazy_loads(line)
+    return loads(line)
+
+
+BACKEND, loads, dumps = BACKENDS[0]
+LAZY = False
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+# Gambit collector
+#
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://cbg.isi.edu/>
+# For license information, see LICENSE
+
+
+import urllib
+import anyjson as json
+
+from StringIO import StringIO
+from twisted.internet import reactor
+from twisted.web.http_headers import Headers
+from twisted.web.client import Agent, HTTPConnectionPool
+from twisted.web.client import FileBodyProducer, readBody
+
+
+class JsonClient(object):
+    # JSON over HTTP on the reactor. Connections to the scrapy nodes and the
+    # broker are kept alive in a pool and reused between requests; a request
+    # that takes longer than `timeout` seconds is cancelled.
+
+    def __init__(self, max_per_host=4, timeout=30):
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = max_per_host
+        self.agent = Agent(reactor, connectTimeout=timeout, pool=self.pool)
+        self.timeout = timeout
+
+    def request(self, method, url, params=None, data=None):
+        if params:
+            url = "%s?%s" % (url, urllib.urlencode(params, doseq=True))
+        body = None
+        if data is not None:
+            body = FileBodyProducer(StringIO(json.dumps(data)))
+        d = self.agent.request(
+            method,
+            url,
+            Headers({"Content-Type": ["application/json"]}),
+            body,
+        )
+        d.addCallback(readBody)
+        d.addCallback(json.loads)
+        timeout = reactor.callLater(self.timeout, d.cancel)
+
+        def done(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+
+        return d.addBoth(done)
+
+    def get(self, url, params=None):
+        return self.request("GET", url, params=params)
+
+    def post(self, url, data):
+        return self.request("POST", url, data=data)
+
+    def close(self):
+        return self.pool.closeCachedConnections()
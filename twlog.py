@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+# Gambit collector
+#
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://cbg.isi.edu/>
+# For license information, see LICENSE
+
+
+# /log/ for the three services: the DailyLogFile is streamed in chunks
+# through a push producer, so neither the file nor the response is held in
+# memory, and the transport's flow control pauses reading when the client
+# is slow.
+
+
+import os
+import anyjson as json
+
+from twisted.web import server
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def tail_offset(fp, lines, block=CHUNK_SIZE):
+    # Offset of the start of the last `lines` lines, reading backwards.
+    fp.seek(0, os.SEEK_END)
+    end = fp.tell()
+    if lines <= 0 or end == 0:
+        return end
+    fp.seek(end - 1)
+    needed = lines + (1 if fp.read(1) == "\n" else 0)
+    pos = end
+    while pos > 0:
+        size = min(block, pos)
+        pos -= size
+        fp.seek(pos)
+        data = fp.read(size)
+        i = len(data)
+        while True:
+            i = data.rfind("\n", 0, i)
+            if i < 0:
+                break
+            needed -= 1
+            if needed == 0:
+                return pos + i + 1
+    return 0
+
+
+@implementer(IPushProducer)
+class LogProducer(object):
+    # Writes `path` from `offset` to `end` (or on and on, with `follow`,
+    # checking for new lines every `poll` seconds and moving to the new
+    # file when DailyLogFile rotates it).
+
+    def __init__(self, request, path, fp, offset, end=None, follow=False,
+                 poll=1.0, chunk_size=CHUNK_SIZE):
+        self.request = request
+        self.path = path
+        self.fp = fp
+        self.position = offset
+        self.end = end
+        self.follow = follow
+        self.poll = poll
+        self.chunk_size = chunk_size
+        self.paused = False
+        self.stopped = False
+        self.call = None
+
+    def start(self):
+        self.fp.seek(self.position)
+        self.request.registerProducer(self, True)
+        self.request.notifyFinish().addErrback(lambda _: self.stopProducing())
+        self._schedule(0)
+
+    def _schedule(self, delay):
+        if self.call is None and not self.paused and not self.stopped:
+            self.call = reactor.callLater(delay, self._produce)
+
+    def _produce(self):
+        self.call = None
+        if self.paused or self.stopped:
+            return
+        size = self.chunk_size
+        if self.end is not None:
+            size = min(size, self.end - self.position)
+        data = self.fp.read(size) if size > 0 else ""
+        if data:
+            self.position += len(data)
+            self.request.write(data)
+            self._schedule(0)
+        elif not self.follow:
+            self._finish()
+        else:
+            self._rotated()
+            self._schedule(self.poll)
+
+    def _rotated(self):
+        try:
+            current = os.stat(self.path)
+        except OSError:
+            return
+        if current.st_ino != os.fstat(self.fp.fileno()).st_ino:
+            self.fp.close()
+            self.fp = open(self.path, "rb")
+            self.position = 0
+
+    def _finish(self):
+        self.stopped = True
+        self.fp.close()
+        self.request.unregisterProducer()
+        self.request.finish()
+
+    def pauseProducing(self):
+        self.paused = True
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+
+    def resumeProducing(self):
+        self.paused = False
+        self._schedule(0)
+
+    def stopProducing(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+        self.fp.close()
+
+
+def serve(request, path, poll=1.0):
+    # GET parameters: tail=<lines>, offset=<byte> (negative: from the end),
+    # follow=1. X-Log-Offset is where the response starts and X-Log-Size the
+    # file size when it was asked for; ?offset=<size> then returns only what
+    # was written since.
+    # Parameters are checked before the file is opened, so a bad one leaves
+    # no handle behind.
+    tail = offset = None
+    try:
+        if "tail" in request.args:
+            tail = int(request.args["tail"][0])
+        else:
+            offset = int(request.args.get("offset", [0])[0])
+    except ValueError:
+        return json.dumps({
+            "error": True,
+            "message": "tail and offset must be integers",
+        })
+    if not os.path.exists(path):
+        return json.dumps({
+            "error": True,
+            "message": "No log file '%s'" % path,
+        })
+    fp = open(path, "rb")
+    fp.seek(0, os.SEEK_END)
+    size = fp.tell()
+    if tail is not None:
+        offset = tail_offset(fp, tail)
+    else:
+        if offset < 0:
+            offset = max(0, size + offset)
+        offset = min(offset, size)
+    follow = request.args.get("follow", ["0"])[0] not in ("0", "", "false")
+    request.setHeader("Content-Type", "text/plain")
+    request.setHeader("X-Log-Offset", str(offset))
+    request.setHeader("X-Log-Size", str(size))
+    end = None
+    if not follow:
+        end = size
+        request.setHeader("Content-Length", str(size - offset))
+    LogProducer(request, path, fp, offset, end, follow, poll).start()
+    return server.NOT_DONE_YET
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+# Gambit collector
+#
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://cbg.isi.edu/>
+# For license information, see LICENSE
+
+
+# Metrics in the Prometheus text format for /metrics. Counts the services
+# already keep are read by collectors when /metrics is rendered; only
+# histograms and rate windows keep state of their own. Nothing here runs per
+# tweet: rates come from totals sampled every few seconds.
+
+
+import time
+
+from bisect import bisect_left
+from collections import deque, OrderedDict
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300)
+SIZE_BUCKETS = (1, 10, 100, 500, 1000, 2000, 5000, 10000, 20000, 50000,
+                100000)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RateWindow(object):
+    # Per second rate of a growing total over the last `window` seconds. The
+    # oldest sample kept is the newest one at least `window` seconds old.
+
+    def __init__(self, window=60):
+        self.window = window
+        self.samples = deque([])
+
+    def sample(self, total, now):
+        self.samples.append((now, total))
+        while len(self.samples) > 2 and \
+              self.samples[1][0] <= now - self.window:
+            self.samples.popleft()
+
+    def ready(self):
+        return len(self.samples) >= 2
+
+    def rate(self):
+        if not self.ready():
+            return 0.0
+        t0, n0 = self.samples[0]
+        t1, n1 = self.samples[-1]
+        if t1 <= t0:
+            return 0.0
+        return (n1 - n0) / float(t1 - t0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"") \
+                     .replace("\n", "\\n")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join("%s=\"%s\"" % (key, _escape(value))
+                             for key, value in sorted(labels.items()))
+
+
+def _value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Registry(object):
+    # Histograms are created on first use and kept per label set. A
+    # collector is a function returning (name, type, help, samples) tuples,
+    # samples being (labels, value) pairs. HTTP handler latency is kept per
+    # path for the first `max_paths` paths and as "other" beyond.
+
+    def __init__(self, prefix, max_paths=64):
+        self.prefix = prefix
+        self.max_paths = max_paths
+        self.histograms = OrderedDict()
+        self.collectors = []
+        self.paths = set()
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        family = self.histograms.get(name)
+        if family is None:
+            family = self.histograms[name] = (help, buckets, {})
+        key = tuple(sorted(labels.items()))
+        histogram = family[2].get(key)
+        if histogram is None:
+            histogram = family[2][key] = Histogram(family[1])
+        return histogram
+
+    def collector(self, func):
+        self.collectors.append(func)
+
+    def time_request(self, request):
+        # Observes the time until `request` finishes, whether it is answered
+        # by render or later from a deferred.
+        path = request.path
+        if path not in self.paths:
+            if len(self.paths) < self.max_paths:
+                self.paths.add(path)
+            else:
+                path = "other"
+        histogram = self.histogram("http_request_seconds",
+                                   "HTTP API handler latency.", path=path)
+        ts_start = time.time()
+        request.notifyFinish().addBoth(
+            lambda _: histogram.observe(time.time() - ts_start))
+
+    def render(self):
+        lines = []
+        for func in self.collectors:
+            for name, kind, help, samples in func():
+                name = "%s_%s" % (self.prefix, name)
+                lines.append("# HELP %s %s" % (name, help))
+                lines.append("# TYPE %s %s" % (name, kind))
+                for labels, value in samples:
+                    lines.append("%s%s %s" % (name, _labels(labels),
+                                              _value(value)))
+        for name, (help, buckets, series) in self.histograms.items():
+            name = "%s_%s" % (self.prefix, name)
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s histogram" % name)
+            for key in sorted(series):
+                histogram = series[key]
+                labels = dict(key)
+                cumulative = 0
+                for bound, count in zip(buckets + (float("inf"),),
+                                        histogram.counts):
+                    cumulative += count
+                    labels["le"] = _value(bound)
+                    lines.append("%s_bucket%s %d" % (name, _labels(labels),
+                                                     cumulative))
+                del labels["le"]
+                lines.append("%s_sum%s %s" % (name, _labels(labels),
+                                              _value(histogram.sum)))
+                lines.append("%s_count%s %d" % (name, _labels(labels),
+                                                histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+def merge(texts):
+    # Joins /metrics pages, given as (labels, text) pairs, into one page:
+    # every sample gets the labels of its page and the samples of a metric
+    # stay under a single HELP and TYPE.
+    families = OrderedDict()
+    for labels, text in texts:
+        extra = ",".join("%s=\"%s\"" % (key, _escape(value))
+                         for key, value in sorted(labels.items()))
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("#"):
+                parts = line.split(" ", 3)
+                if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                    family = families.setdefault(parts[2], [[], []])
+                    if not any(l.startswith("# %s " % parts[1])
+                               for l in family[0]):
+                        family[0].append(line)
+                continue
+            name = line.split("{", 1)[0].split(" ", 1)[0]
+            family = name
+            for suffix in ("_bucket", "_sum", "_count"):
+                if name.endswith(suffix) and name[:-len(suffix)] in families:
+                    family = name[:-len(suffix)]
+            rest = line[len(name):]
+            if extra:
+                if rest.startswith("{"):
+                    rest = "{%s,%s" % (extra, rest[1:])
+                else:
+                    rest = "{%s}%s" % (extra, rest)
+            families.setdefault(family, [[], []])[1].append(name + rest)
+    lines = []
+    for header, samples in families.itervalues():
+        lines.extend(header)
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# Gambit collector
+#
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://cbg.isi.edu/>
+# For license information, see LICENSE
+
+
+# Placement of follow users on streams of at most `limit` users. Every change
+# to a stream's follow list means reconnecting it, which loses the tweets
+# sent meanwhile, so plans are scored by restarts first and by the number of
+# streams second:
+#
+#   * streams above `limit` are always restarted;
+#   * new users go to new streams while there are at most `spare` streams
+#     beyond the minimum needed for all users, or as many as now;
+#   * past that, they go with the users of the smallest open stream (below
+#     `limit`), which is restarted, when that takes fewer streams than
+#     launching new ones. At most one open stream is restarted per plan,
+#     the same as the policy twplan replaced, so a plan never restarts
+#     more streams than it would have.
+#
+# Streams are not repacked: a restart only to merge small streams costs
+# tweets and brings no new users.
+#
+# Users are only added: the users of a restarted stream are carried over to
+# the new streams, since follow streams of other streamers share the range.
+
+
+def _unique(user_ids, skip):
+    result = []
+    seen = set(skip)
+    for uid in user_ids:
+        if uid not in seen:
+            seen.add(uid)
+            result.append(uid)
+    return result
+
+
+def _ceil_div(a, b):
+    return (a + b - 1) // b
+
+
+def plan_follow(streams, user_ids, limit, free_fids, spare=1, locked=()):
+    # streams: {filter id: [user ids]} of the running follow streams,
+    # user_ids: users that should be followed, free_fids: filter ids that
+    # new streams may take, locked: streams that are not to be grown.
+    covered = set()
+    for follow in streams.itervalues():
+        covered.update(follow)
+    new_users = _unique(user_ids, covered)
+    total = len(covered) + len(new_users)
+    target = _ceil_div(total, limit) + spare
+
+    restart = [fid for fid, follow in streams.iteritems()
+               if len(follow) > limit]
+    open_streams = sorted(
+        (fid for fid, follow in streams.iteritems()
+         if len(follow) < limit and fid not in locked),
+        key=lambda fid: (len(streams[fid]), fid),
+    )
+    bound = max(target, len(streams))
+    pool = len(new_users) + sum(len(streams[fid]) for fid in restart)
+    kept = len(streams) - len(restart)
+    count = kept + _ceil_div(pool, limit)
+    if new_users and open_streams and count > bound:
+        smallest = open_streams[0]
+        merged = kept - 1 + _ceil_div(pool + len(streams[smallest]), limit)
+        if merged < count:
+            restart.append(smallest)
+
+    restarted = set(restart)
+    keep = sorted(fid for fid in streams if fid not in restarted)
+    kept_users = set()
+    for fid in keep:
+        kept_users.update(streams[fid])
+    moved = []
+    for fid in sorted(restart):
+        moved.extend(streams[fid])
+    users = _unique(new_users + moved, kept_users)
+
+    launch = []
+    free_fids = list(free_fids)
+    for i in xrange(0, len(users), limit):
+        if not free_fids:
+            raise ValueError("No free filter id for %d more users"
+                             % (len(users) - i))
+        launch.append({
+            "id": free_fids.pop(0),
+            "follow": users[i:i + limit],
+        })
+
+    return {
+        "keep": keep,
+        "restart": sorted(restart),
+        "launch": launch,
+        "added": len(new_users),
+        "streams": len(keep) + len(launch),
+        "target": target,
+    }
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+# Gambit collector
+#
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://cbg.isi.edu/>
+# For license information, see LICENSE
+
+
+# /profile/cpu and /profile/mem for the live process. Nothing runs until a
+# profile is asked for, and only one runs at a time.
+#
+# /profile/cpu?seconds=N samples the reactor thread's stack every `interval`
+# seconds from another thread, so the reactor is only slowed by the
+# sampling itself. /profile/mem?seconds=N uses tracemalloc when it is
+# available (Python 3, or 2.7 with pytracemalloc) and reports the lines that
+# allocated the most during the N seconds; otherwise it counts live objects
+# by type at the start and the end, which walks the heap on the reactor
+# thread twice.
+
+
+import gc
+import sys
+import hmac
+import time
+import thread
+import resource
+import anyjson as json
+
+from twisted.web import server
+from twisted.internet import reactor, threads
+from twisted.internet.task import deferLater
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def sample_stacks(thread_id, seconds, interval):
+    # {stack, outermost call first: samples}
+    stacks = {}
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s:%d(%s)" % (code.co_filename, frame.f_lineno,
+                                        code.co_name))
+            frame = frame.f_back
+        if stack:
+            stack.reverse()
+            stack = tuple(stack)
+            stacks[stack] = stacks.get(stack, 0) + 1
+        time.sleep(interval)
+    return stacks
+
+
+def cpu_report(stacks, seconds, interval, limit=30):
+    samples = sum(stacks.itervalues())
+    own = {}
+    total = {}
+    for stack, count in stacks.iteritems():
+        own[stack[-1]] = own.get(stack[-1], 0) + count
+        for call in set(stack):
+            total[call] = total.get(call, 0) + count
+
+    def top(counts):
+        calls = sorted(counts.iteritems(), key=lambda c: -c[1])[:limit]
+        return [[call, count, float(count) / samples] for call, count in calls]
+
+    return {
+        "seconds": seconds,
+        "interval": interval,
+        "samples": samples,
+        "own": top(own) if samples else [],
+        "total": top(total) if samples else [],
+    }
+
+
+def collapsed(stacks):
+    # One "outer;inner;... samples" line per stack, the input of
+    # flamegraph.pl.
+    return "\n".join("%s %d" % (";".join(stack), count)
+                     for stack, count in sorted(stacks.iteritems())) + "\n"
+
+
+def census():
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        count, size = counts.get(name, (0, 0))
+        counts[name] = (count + 1, size + sys.getsizeof(obj, 0))
+    return counts
+
+
+def max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Profiler(object):
+    # `token` must be given as ?token= on every profile request; without a
+    # token in the settings the paths are off.
+
+    def __init__(self, token=None, max_seconds=60, interval=0.005):
+        self.token = token
+        self.max_seconds = max_seconds
+        self.interval = interval
+        self.running = None
+
+    def _error(self, message):
+        return json.dumps({"error": True, "message": message})
+
+    def render(self, request):
+        if not self.token:
+            return self._error("Profiling is disabled")
+        token = request.args.get("token", [""])[0]
+        if not hmac.compare_digest(str(token), str(self.token)):
+            return self._error("Wrong profile token")
+        if self.running is not None:
+            return self._error("A %s profile is running" % self.running)
+        path = request.path.rstrip("/")
+        seconds = float(request.args.get("seconds", [10])[0])
+        seconds = max(0.0, min(seconds, self.max_seconds))
+        limit = int(request.args.get("limit", [30])[0])
+        if path == "/profile/cpu":
+            fmt = request.args.get("format", ["json"])[0]
+            d = self.cpu(seconds, limit, fmt)
+            if fmt == "collapsed":
+                request.setHeader("Content-Type", "text/plain")
+        elif path == "/profile/mem":
+            d = self.mem(seconds, limit)
+        else:
+            return self._error("Wrong API path '%s'" % request.path)
+        self.running = path.split("/")[-1]
+
+        def done(response):
+            self.running = None
+            request.write(response)
+            request.finish()
+
+        def failed(failure):
+            self.running = None
+            request.write(self._error(failure.getTraceback()))
+            request.finish()
+
+        d.addCallbacks(done, failed)
+        return server.NOT_DONE_YET
+
+    def cpu(self, seconds, limit=30, fmt="json"):
+        # The reactor thread is the one rendering this request.
+        d = threads.deferToThread(sample_stacks, thread.get_ident(), seconds,
+                                  self.interval)
+        if fmt == "collapsed":
+            return d.addCallback(collapsed)
+        return d.addCallback(lambda stacks: json.dumps(
+            cpu_report(stacks, seconds, self.interval, limit)))
+
+    def mem(self, seconds, limit=30):
+        if tracemalloc is not None:
+            return self._traced(seconds, limit)
+        return self._counted(seconds, limit)
+
+    def _traced(self, seconds, limit):
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        rss = max_rss()
+
+        def report(_):
+            snapshot = tracemalloc.take_snapshot()
+            if started:
+                tracemalloc.stop()
+            lines = snapshot.statistics("lineno")[:limit]
+            return json.dumps({
+                "seconds": seconds,
+                "mode": "tracemalloc",
+                "max_rss": [rss, max_rss()],
+                "top": [[str(stat.traceback), stat.size, stat.count]
+                        for stat in lines],
+            })
+
+        return deferLater(reactor, seconds, lambda: None).addCallback(report)
+
+    def _counted(self, seconds, limit):
+        before = census()
+        rss = max_rss()
+
+        def report(_):
+            after = census()
+            growth = []
+            for name, (count, size) in after.iteritems():
+                count0, size0 = before.get(name, (0, 0))
+                growth.append([name, count - count0, size - size0])
+            growth.sort(key=lambda g: -g[2])
+            largest = sorted(([name, count, size]
+                              for name, (count, size) in after.iteritems()),
+                             key=lambda t: -t[2])
+            return json.dumps({
+                "seconds": seconds,
+                "mode": "gc",
+                "max_rss": [rss, max_rss()],
+                "objects": sum(count for count, _ in after.itervalues()),
+                "largest": largest[:limit],
+                "growth": growth[:limit],
+            })
+
+        return deferLater(reactor, seconds, lambda: None).addCallback(report)
+
+
+def from_settings(settings):
+    profile_settings = settings.get("profile", {})
+    return Profiler(
+        token=profile_settings.get("token"),
+        max_seconds=profile_settings.get("max_seconds", 60),
+        interval=profile_settings.get("interval", 0.005),
+    )
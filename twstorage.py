@@ -8,29 +8,52 @@
 # For license information, see LICENSE
 
 
+import time
 import datetime
+import twcodec
+import twbuffer
 import anyjson as json
 
+from cStringIO import StringIO
+
 global STORAGE
 global SQL_MOVE
+global SQL_MERGE
+global SQL_PURGE
 
 
+# Only the rows written by one batch are copied; rows dropped as duplicates
+# keep the batch id they were first written with, so nothing moves twice.
+# NOT EXISTS skips the committed repeats in one anti-join; ON CONFLICT skips
+# a row another shard's storage worker committed while this one was running,
+# which NOT EXISTS cannot see.
 SQL_MOVE = \
 """
-BEGIN WORK;
-LOCK TABLE nba_tmp_tweet IN SHARE ROW EXCLUSIVE MODE;
-UPDATE nba_tmp_tweet SET status=1 WHERE STATUS=0;
-INSERT INTO nba_tweet (
-    SELECT id, user_id, timestamp, text, geo 
-    FROM nba_tmp_tweet
-    WHERE status = 1
-);
-UPDATE nba_tmp_tweet SET status=2 WHERE STATUS=1;
-DELETE FROM nba_tmp_tweet WHERE status=2 and timestamp < current_date - interval '7 days';
-COMMIT WORK;
+INSERT INTO {final_table} (id, user_id, timestamp, text, geo)
+SELECT t.id, t.user_id, t.timestamp, t.text, t.geo
+FROM {tweet_table} t
+WHERE t.batch = :batch
+AND NOT EXISTS (SELECT 1 FROM {final_table} f WHERE f.id = t.id)
+ON CONFLICT (id) DO NOTHING
 """
 
+SQL_MERGE = \
+"""
+INSERT INTO {table} ({columns})
+SELECT DISTINCT ON (s.id) {columns}
+FROM {stage} s
+WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE t.id = s.id)
+ON CONFLICT (id) DO NOTHING
+"""
 
+SQL_PURGE = \
+"""
+DELETE FROM {tweet_table} WHERE id IN (
+    SELECT id FROM {tweet_table}
+    WHERE timestamp < current_date - interval '{retention_days} days'
+    LIMIT {purge_batch}
+)
+"""
 
 
 class TwStorage(object):
@@ -55,7 +78,10 @@ class TwStorage(object):
         db_url = "postgresql+psycopg2://%s:%s@%s:%s/%s" % \
                  (user, passwd, host, port, name)
 
-        self.engine = create_engine(db_url, echo=True, pool_size=8, pool_recycle=1800)
+        twcodec.configure(**settings.get("codec", {}))
+
+        echo = settings["database"].get("echo", True)
+        self.engine = create_engine(db_url, echo=echo, pool_size=8, pool_recycle=1800)
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
 
@@ -68,6 +94,8 @@ class TwStorage(object):
             filter_id = Column(Integer, nullable=False)
             value = Column(Integer, nullable=False, default=0)
             timestamp = Column(DateTime, default=datetime.datetime.now())
+            segment = Column(String(255), nullable=True)
+            position = Column(Integer, nullable=True)
 
         class Tweet(self.Base):
             __tablename__ = settings["database"]["tweet_table"]
@@ -76,6 +104,7 @@ class TwStorage(object):
             timestamp = Column(DateTime, default=datetime.datetime.now())
             text = Column(String(140), nullable=False)
             geo = Column(Geometry(geometry_type='POINT', srid=4326), nullable=True)
+            batch = Column(BigInteger, nullable=True)
 
         class TweetJson(self.Base):
             __tablename__ = settings["database"]["jsons_table"]
@@ -89,6 +118,25 @@ class TwStorage(object):
         self.Point = lambda x, y: "SRID=4326;POINT(%f %f)" % (x, y)
         self.tz = tz.gettz("UTC")
         self.max_text_len = self.Tweet.text.property.columns[0].type.length
+        tweet_table = settings["database"]["tweet_table"]
+        final_table = settings["database"].get("final_table", "nba_tweet")
+        self.sql_batch = "SELECT nextval('%s_batch_seq')" % tweet_table
+        self.sql_move = SQL_MOVE.format(
+            tweet_table=tweet_table,
+            final_table=final_table,
+        )
+        self.purge_batch = settings["database"].get("purge_batch", 5000)
+        self.sql_purge = SQL_PURGE.format(
+            tweet_table=tweet_table,
+            retention_days=int(settings["database"].get("retention_days", 7)),
+            purge_batch=int(self.purge_batch),
+        )
+        self.writer = settings["database"].get("writer", "orm")
+        if self.writer not in WRITERS:
+            raise ValueError("Unknown database writer %r" % self.writer)
+        self.dedup = settings["database"].get("dedup", "merge")
+        if self.dedup not in DEDUP_MODES:
+            raise ValueError("Unknown de-duplication mode %r" % self.dedup)
 
 
 def init(settings):
@@ -96,65 +144,348 @@ def init(settings):
     STORAGE = TwStorage(settings)
 
 
-def save(cache):
+def next_batch():
+    return STORAGE.session.execute(STORAGE.sql_batch).scalar()
+
+
+def add_matches(raw, filters):
+    # Appends the matched filter ids to the raw JSON object without
+    # decoding and re-encoding it.
+    raw = raw.rstrip()
+    return "%s,\"matched_filters\":%s}" % (raw[:-1], json.dumps(filters))
+
+
+def update_matches(raw, filter_id, filters):
+    # Adds filter ids to the matched_filters list add_matches appended.
+    raw = raw.rstrip()
+    head, sep, tail = raw.rpartition(",\"matched_filters\":")
+    if not sep:
+        return add_matches(raw, [filter_id] + filters)
+    matched = json.loads(tail[:-1])
+    for match in filters:
+        if match not in matched:
+            matched.append(match)
+    return "%s%s%s}" % (head, sep, json.dumps(matched))
+
+
+def read_cache(data, batch=None):
+    # Returns limits, tweets and jsons to insert, and {tweet id: filter ids}
+    # for MATCH frames whose TWEET went out with an earlier batch. Limits
+    # are (filter id, value, position), position being the number of earlier
+    # notices of the filter in `data`.
+    limits = []
+    tweets = []
+    tjsons = []
+    matches = {}
+    positions = {}
+
+    for kind, filter_id, value, payload in twbuffer.frames(data):
+
+        if kind == twbuffer.LIMIT:
+            position = positions.get(filter_id, 0)
+            positions[filter_id] = position + 1
+            limits.append((filter_id, value, position))
+
+        elif kind == twbuffer.MATCH:
+            matches.setdefault(value, []).append(filter_id)
+
+        elif kind == twbuffer.TWEET:
+
+            obj = twcodec.loads_tweet(payload)
+
+            geo = None
+            if "geo" in obj and obj["geo"] and \
+               "type" in obj["geo"] and obj["geo"]["type"] == "Point":
+                lat, lng = obj["geo"]["coordinates"]
+                geo = STORAGE.Point(lat, lng)
+
+            ts = datetime.datetime.strptime(obj["created_at"],
+                                            "%a %b %d %H:%M:%S +0000 %Y")
+            text = obj["text"]
+            if len(text) > STORAGE.max_text_len:
+                text = text[0:STORAGE.max_text_len]
+
+            tweets.append((
+                value,
+                obj["user"]["id"],
+                ts.replace(tzinfo=STORAGE.tz),
+                text,
+                geo,
+                batch,
+            ))
+            tjsons.append((value, filter_id, payload))
+
+    for i, (tweet_id, filter_id, payload) in enumerate(tjsons):
+        filters = [filter_id]
+        for match in matches.pop(tweet_id, ()):
+            if match not in filters:
+                filters.append(match)
+        tjsons[i] = (tweet_id, filter_id, add_matches(payload, filters))
+
+    return limits, tweets, tjsons, matches
+
+
+TWEET_COLUMNS = ("id", "user_id", "timestamp", "text", "geo", "batch")
+TJSON_COLUMNS = ("id", "filter_id", "json")
+LIMIT_COLUMNS = ("filter_id", "value", "segment", "position", "timestamp")
+
+
+def new_limits(limits, segment):
+    # Limit rows have no id of their own, so they are keyed by (segment,
+    # filter id, position) instead: a part that is stored again, after its
+    # attempt timed out and committed late or after a crash between commit
+    # and acknowledgement, finds its limit rows and skips them. Returns the
+    # (filter id, value, segment, position) rows to insert and the number
+    # skipped. Without a segment nothing is checked.
+    if segment is None:
+        return [(f, v, None, None) for f, v, _ in limits], 0
+    Limit = STORAGE.Limit
+    stored = set(STORAGE.session.query(Limit.filter_id, Limit.position)
+                                .filter(Limit.segment == segment))
+    rows = [(f, v, segment, p) for f, v, p in limits if (f, p) not in stored]
+    return rows, len(limits) - len(rows)
+
+
+def orm_objects(limits, tweets, tjsons):
+    objects = []
+    for filter_id, value, segment, position in limits:
+        objects.append(STORAGE.Limit(filter_id=filter_id, value=value,
+                                     segment=segment, position=position))
+    for tweet_id, user_id, timestamp, text, geo, batch in tweets:
+        tweet = STORAGE.Tweet(
+            id=tweet_id,
+            user_id=user_id,
+            timestamp=timestamp,
+            text=text,
+            batch=batch
+        )
+        if geo is not None:
+            tweet.geo = geo
+        objects.append(tweet)
+    for tweet_id, filter_id, tjson in tjsons:
+        objects.append(STORAGE.TweetJson(
+            id=tweet_id,
+            filter_id=filter_id,
+            json=tjson
+        ))
+    return objects
+
+
+def count_new(model, ids):
+    # Ids of `ids` not stored yet: the rows the rules will let through.
+    from sqlalchemy import func
+
+    ids = set(ids)
+    if not ids:
+        return 0
+    stored = STORAGE.session.query(func.count(model.id)) \
+                            .filter(model.id.in_(list(ids))).scalar()
+    return len(ids) - stored
+
+
+def write_orm(limits, tweets, tjsons):
+    # The rules of tables-rules.sql skip the repeats that are committed, and
+    # the rows they let through are counted beforehand. A row another
+    # shard's storage worker committed meanwhile is a unique violation
+    # instead (rules rule out ON CONFLICT): the batch is then written again
+    # row by row, skipping the rows that collide.
+    from sqlalchemy.exc import IntegrityError
+
+    if STORAGE.dedup == "merge":
+        return write_staged(limits, tweets, tjsons, insert_rows)
+    session = STORAGE.session
+    counts = {
+        "tweets": count_new(STORAGE.Tweet, [row[0] for row in tweets]),
+        "jsons": count_new(STORAGE.TweetJson, [row[0] for row in tjsons]),
+    }
+    savepoint = session.begin_nested()
+    try:
+        session.add_all(orm_objects(limits, tweets, tjsons))
+        session.flush()
+        savepoint.commit()
+        return counts
+    except IntegrityError:
+        savepoint.rollback()
+    conflicts = 0
+    for obj in orm_objects(limits, tweets, tjsons):
+        savepoint = session.begin_nested()
+        try:
+            session.add(obj)
+            session.flush()
+            savepoint.commit()
+        except IntegrityError:
+            savepoint.rollback()
+            conflicts += 1
+            if isinstance(obj, STORAGE.Tweet):
+                counts["tweets"] -= 1
+            elif isinstance(obj, STORAGE.TweetJson):
+                counts["jsons"] -= 1
+    print "concurrent repeats skipped: %d" % conflicts
+    return counts
+
+
+def copy_value(value):
+    if value is None:
+        return u"\\N"
+    if isinstance(value, datetime.datetime):
+        return unicode(value.isoformat())
+    if isinstance(value, str):
+        value = value.decode("utf-8")
+    elif not isinstance(value, unicode):
+        value = unicode(value)
+    return value.replace(u"\\", u"\\\\") \
+                .replace(u"\t", u"\\t") \
+                .replace(u"\n", u"\\n") \
+                .replace(u"\r", u"\\r")
+
+
+def copy_rows(cursor, table, columns, rows):
+    buf = StringIO()
+    for row in rows:
+        line = u"\t".join(copy_value(v) for v in row)
+        buf.write(line.encode("utf-8"))
+        buf.write("\n")
+    buf.seek(0)
+    cursor.copy_expert("COPY %s (%s) FROM STDIN" % (
+        table,
+        ", ".join("\"%s\"" % c for c in columns),
+    ), buf)
+
+
+def insert_rows(cursor, table, columns, rows):
+    cursor.executemany("INSERT INTO %s (%s) VALUES (%s)" % (
+        table,
+        ", ".join("\"%s\"" % c for c in columns),
+        ", ".join(["%s"] * len(columns)),
+    ), list(rows))
+
+
+def merge_staged(cursor, table, columns, rows, load):
+    # Rows are loaded into a temporary table and merged with one anti-join,
+    # instead of one EXISTS lookup per inserted row. Returns rows inserted.
+    stage = "stage_%s" % table
+    cols = ", ".join("\"%s\"" % c for c in columns)
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS %s "
+                   "(LIKE %s INCLUDING DEFAULTS) ON COMMIT DELETE ROWS" %
+                   (stage, table))
+    load(cursor, stage, columns, rows)
+    cursor.execute(SQL_MERGE.format(table=table, stage=stage, columns=cols))
+    return cursor.rowcount
+
+
+def write_staged(limits, tweets, tjsons, load):
+    cursor = STORAGE.session.connection().connection.cursor()
+    now = datetime.datetime.now()
+    counts = {}
+    try:
+        if limits:
+            load(cursor, STORAGE.Limit.__tablename__, LIMIT_COLUMNS,
+                 ((f, v, s, p, now) for f, v, s, p in limits))
+        if tweets:
+            counts["tweets"] = merge_staged(
+                cursor, STORAGE.Tweet.__tablename__, TWEET_COLUMNS,
+                tweets, load)
+        if tjsons:
+            counts["jsons"] = merge_staged(
+                cursor, STORAGE.TweetJson.__tablename__, TJSON_COLUMNS,
+                tjsons, load)
+    finally:
+        cursor.close()
+    return counts
+
+
+def write_copy(limits, tweets, tjsons):
+    return write_staged(limits, tweets, tjsons, copy_rows)
+
+
+WRITERS = {
+    "orm": write_orm,
+    "copy": write_copy,
+}
+
+DEDUP_MODES = ("rule", "merge")
+
+
+def write_late_matches(matches):
+    # Adds the filters of MATCH frames that came in a later batch than their
+    # TWEET to the stored JSON. Returns (updated, not found): a tweet is not
+    # found when its own batch was dead-lettered.
+    if not matches:
+        return 0, 0
+    TweetJson = STORAGE.TweetJson
+    rows = STORAGE.session.query(TweetJson) \
+                          .filter(TweetJson.id.in_(list(matches))) \
+                          .with_for_update().all()
+    for row in rows:
+        row.json = update_matches(row.json, row.filter_id, matches[row.id])
+    STORAGE.session.flush()
+    return len(rows), len(matches) - len(rows)
+
+
+def move_batch(batch):
+    STORAGE.session.execute(STORAGE.sql_move, {"batch": batch})
+
+
+def save(data, segment=None):
+    # `segment` names where `data` was buffered, the same on every attempt
+    # to store it; see new_limits().
     try:
         global STORAGE
-        global SQL_MOVE
-
-        print "collected: %s " % len(cache)
-
-        limits = []
-        tweets = []
-        tjsons = []
 
-        for token, filter_id, obj in cache:
-
-            if isinstance(obj, int):
-                limit_value = obj
-                limit = STORAGE.Limit(filter_id=filter_id, value=limit_value)
-                limits.append(limit)
-
-            elif isinstance(obj, dict):
-
-                geo = None
-                if "geo" in obj and obj["geo"] and \
-                   "type" in obj["geo"] and obj["geo"]["type"] == "Point":
-                    lat, lng = obj["geo"]["coordinates"]
-                    geo = STORAGE.Point(lat, lng)
+        print "collected: %s bytes" % len(data)
+
+        # Stage times for the latency tracer of scrapy.py.
+        ts_start = time.time()
+        batch = next_batch()
+        limits, tweets, tjsons, matches = read_cache(data, batch)
+        limits, limits_repeated = new_limits(limits, segment)
+        counts = WRITERS[STORAGE.writer](limits, tweets, tjsons)
+        late, orphaned = write_late_matches(matches)
+        if orphaned:
+            print "orphaned matches: %d tweets not stored" % orphaned
+        ts_written = time.time()
+        move_batch(batch)
+        STORAGE.session.commit()
 
-                ts = datetime.datetime.strptime(obj["created_at"],
-                                                "%a %b %d %H:%M:%S +0000 %Y")
-                text = obj["text"]
-                if len(text) > STORAGE.max_text_len:
-                    text = text[0:STORAGE.max_text_len]
+        report = {
+            "batch": batch,
+            "limits": len(limits),
+            "limits_duplicates": limits_repeated,
+            "matches_late": late,
+            "matches_orphaned": orphaned,
+            "ts_start": ts_start,
+            "ts_written": ts_written,
+            "ts_commit": time.time(),
+        }
+        for key, rows in (("tweets", tweets), ("jsons", tjsons)):
+            report[key] = len(rows)
+            if key in counts:
+                report["%s_inserted" % key] = counts[key]
+                report["%s_duplicates" % key] = len(rows) - counts[key]
+        print "saved: %r " % report
+        return report
 
-                tweet = STORAGE.Tweet(
-                    id=obj["id"],
-                    user_id=obj["user"]["id"],
-                    timestamp=ts.replace(tzinfo=STORAGE.tz),
-                    text=text
-                )
+    except Exception:
+        import traceback
+        print traceback.format_exc()
+        STORAGE.session.rollback()
 
-                if geo is not None:
-                    tweet.geo = geo
 
-                tjson = STORAGE.TweetJson(
-                    id=obj["id"],
-                    filter_id=filter_id,
-                    json=json.dumps(obj)
-                )
+def purge():
+    # Retention runs in short transactions of purge_batch rows each, so it
+    # never holds locks for long and stays out of the save() path.
+    try:
+        global STORAGE
 
-                tweets.append(tweet)
-                tjsons.append(tjson)
+        deleted = 0
+        while True:
+            result = STORAGE.engine.execute(STORAGE.sql_purge)
+            deleted += result.rowcount
+            if result.rowcount < STORAGE.purge_batch:
+                break
 
-        STORAGE.session.add_all(limits)
-        STORAGE.session.add_all(tweets)
-        STORAGE.session.add_all(tjsons)
-        STORAGE.session.commit()
-        
-        STORAGE.engine.execute(SQL_MOVE)
+        print "purged: %s " % deleted
 
     except Exception:
         import traceback
         print traceback.format_exc()
-        STORAGE.session.rollback()
\ No newline at end of file